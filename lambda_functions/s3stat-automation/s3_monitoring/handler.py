@@ -1,63 +1,176 @@
+import argparse
 import boto3
-import datetime
+import botocore.exceptions
 import logging
 import requests
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
 bucket_name = "s3stat-monitoring"
+REPORT_URL = "https://s3.amazonaws.com/reports.s3stat.com/17448/dea-public-data/stats/"
+# Metadata of the uploaded reports, recording the validators of their source
+ETAG_METADATA = "source-etag"
+LAST_MODIFIED_METADATA = "source-last-modified"
+TIMEOUT = 60
+# Number of reports fetched at once by a backfill
+BACKFILL_WORKERS = 8
 
 LOG = logging.getLogger(__name__)
 
 
-def handler(event, context):
-    """Main Entry Point"""
-    today = datetime.date.today()
+def reports(today, base_url=None):
+    """
+    Return the (url, key) of the week and month reports of the given day
+    """
+    base_url = base_url or REPORT_URL
     week = today.strftime("%Y%V")
     month = today.strftime("%Y%m")
+    return [
+        (base_url + "week" + week + ".json", "stats/week/" + week + ".json"),
+        (base_url + "month" + month + ".json", "stats/month/" + month + ".json"),
+    ]
 
-    file_monthurl = (
-        "https://s3.amazonaws.com/reports.s3stat.com/17448/dea-public-data/stats/month"
-        + month
-        + ".json"
-    )
-    file_url = (
-        "https://s3.amazonaws.com/reports.s3stat.com/17448/dea-public-data/stats/week"
-        + week
-        + ".json"
-    )
-    o_week_file = week + ".json"
-    o_month_file = month + ".json"
 
-    # Create session
-    s = requests.Session()
+def reports_between(start, end, base_url=None):
+    """
+    Return the (url, key) of every week and month report of the days from start to end
+    """
+    found = {}
+    day = start
+    while day <= end:
+        for url, key in reports(day, base_url):
+            found.setdefault(key, url)
+        day += timedelta(days=1)
+    return [(url, key) for key, url in found.items()]
+
+
+def existing_reports(s3):
+    """
+    Return the set of report keys already in the bucket
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    return {
+        entry["Key"]
+        for prefix in ("stats/week/", "stats/month/")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for entry in page.get("Contents", [])
+    }
+
 
-    # Next thing will be to visit URL for file to download
-    # Download week file
-    r = s.get(file_url)
-    if r.status_code == requests.codes.ok:
-        LOG.info(f"Downloaded {file_url} successfully.")
+def source_validators(s3, key):
+    """
+    Return the ETag and Last-Modified of the source of an uploaded report, if any
+    """
+    try:
+        metadata = s3.head_object(Bucket=bucket_name, Key=key)["Metadata"]
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return {}
+        raise
+    return metadata
 
-        s3 = boto3.client("s3")
 
-        with open("/tmp/" + o_week_file, "wb") as output:
-            output.write(r.content)
-            output.read()
+def conditional_headers(validators):
+    headers = {}
+    if ETAG_METADATA in validators:
+        headers["If-None-Match"] = validators[ETAG_METADATA]
+    if LAST_MODIFIED_METADATA in validators:
+        headers["If-Modified-Since"] = validators[LAST_MODIFIED_METADATA]
+    return headers
 
-        s3.upload_file("/tmp/" + o_week_file, bucket_name, "stats/week/" + o_week_file)
-        r.history.clear()
 
-    # Download Month data
-    r = s.get(file_monthurl)
-    if r.status_code == requests.codes.ok:
-        LOG.info(f"Month data {file_monthurl} downloaded successfully")
+def fetch_report(s3, url, key):
+    """
+    Stream a report into S3, unless it is unchanged since it was last uploaded
 
-        s3 = boto3.client("s3")
+    :return: whether the report was uploaded
+    """
+    headers = conditional_headers(source_validators(s3, key))
+    with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == requests.codes.not_modified:
+            LOG.info(f"{url} has not changed since it was last uploaded")
+            return False
+        if r.status_code != requests.codes.ok:
+            LOG.warning(f"Could not download {url}: {r.status_code}")
+            return False
 
-        with open("/tmp/" + o_month_file, "wb") as output:
-            output.write(r.content)
+        metadata = {}
+        if "ETag" in r.headers:
+            metadata[ETAG_METADATA] = r.headers["ETag"]
+        if "Last-Modified" in r.headers:
+            metadata[LAST_MODIFIED_METADATA] = r.headers["Last-Modified"]
 
-        s3.upload_file(
-            "/tmp/" + o_month_file, bucket_name, "stats/month/" + o_month_file
+        # Undo any transfer compression while streaming the body
+        r.raw.decode_content = True
+        s3.upload_fileobj(
+            r.raw,
+            bucket_name,
+            key,
+            ExtraArgs={"ContentType": "application/json", "Metadata": metadata},
         )
-        r.history.clear()
+    LOG.info(f"Uploaded {url} to {key}")
+    return True
+
+
+def handler(event, context):
+    """Main Entry Point"""
+    s3 = boto3.client("s3")
+
+    # Fetch the week and month reports at once
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(fetch_report, s3, url, key)
+            for url, key in reports(date.today())
+        ]
+        return [future.result() for future in futures]
+
+
+def backfill(start, end, base_url=None, max_workers=BACKFILL_WORKERS, s3=None):
+    """
+    Fetch the week and month reports from start to end that are missing from the bucket
+
+    :return: the number of reports uploaded
+    """
+    s3 = s3 or boto3.client("s3")
+    existing = existing_reports(s3)
+    missing = [
+        (url, key)
+        for url, key in reports_between(start, end, base_url)
+        if key not in existing
+    ]
+    LOG.info(f"Fetching {len(missing)} missing reports")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        uploaded = executor.map(lambda report: fetch_report(s3, *report), missing)
+        return sum(uploaded)
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch the s3stat reports missing from the bucket between two dates"
+    )
+    parser.add_argument("start", type=parse_date, help="First day, as YYYY-MM-DD")
+    parser.add_argument(
+        "end", type=parse_date, nargs="?", default=date.today(), help="Last day"
+    )
+    parser.add_argument("--base-url", default=REPORT_URL, help="URL of the reports")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=BACKFILL_WORKERS,
+        help="Number of reports fetched at once",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    uploaded = backfill(args.start, args.end, args.base_url, args.workers)
+    print(f"Uploaded {uploaded} reports")
+
+
+if __name__ == "__main__":
+    main()
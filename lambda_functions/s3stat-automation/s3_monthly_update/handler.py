@@ -1,164 +1,369 @@
 import boto3
+import codecs
 import csv
-from collections import defaultdict
-from datetime import datetime, date
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+import io
 import json
 import os.path
 from pathlib import Path
 import re
 from shapely.geometry import Polygon
-import tempfile
 
 
 S3_INPUT_BUCKET = "s3stat-monitoring"
+MONTHLY_JSON_PREFIX = "stats/month"
+# Number of monthly reports downloaded and parsed at once
+MAX_WORKERS = 4
 S3_OUTPUT_BUCKET = "dea-public-data-dev"
+OUTPUT_CSV_KEY = "s3-csv/data.csv"
+# Every month is also written to its own partition
+MONTHLY_CSV_PREFIX = "s3-csv/month/"
+# Totals of each month by product, and by product and spatial id, for dashboards,
+# written to a partition per month such as s3-csv/rollup/product_month/201906.csv
+ROLLUP_PREFIX = "s3-csv/rollup/"
+ROLLUPS = {
+    "product_month": ("product",),
+    "product_spatial_month": ("product", "spatial_id"),
+}
+# Records the monthly reports already in the output
+STATE_KEY = "s3-csv/state.json"
+# 'csv' appends to data.csv and writes csv month partitions, 'csv.gz' only writes
+# gzipped month partitions
+OUTPUT_FORMAT = os.environ.get("S3STAT_OUTPUT_FORMAT", "csv")
+# Size of the parts of multipart uploads, at least the S3 minimum of 5MB
+PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Largest part that can be copied from another object
+MAX_COPY_PART_SIZE = 5 * 1024 * 1024 * 1024
 ROOT_DIR = Path(__file__).absolute().parent
 MGRS_GEOJSON_FILE = ROOT_DIR / "australian-mgrs-tiles.geojson"
 ALBERS_GEOJSON_FILE = ROOT_DIR / "albers_grid.geojson"
 s3_client = boto3.client("s3")
 
 
-def read_json(reader):
-    reader_files = reader["Files"]
-    today = date.today()
-    results = []
-    for i, v in reader_files.items():
-        if (
-            str(i).endswith(".TIF")
-            or str(i).endswith(".tif")
-            or str(i).endswith(".tiff")
-        ):
-            results.append(
-                {"folder": str(i), "hits": int(v[0]), "bytes": int(v[1]), "date": today}
-            )
-    return results
+TIF_SUFFIXES = (".TIF", ".tif", ".tiff")
+# Size of the reads from a monthly report
+CHUNK_SIZE = 1024 * 1024
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE = re.compile(r"\s*")
+# A 'Files' entry of a monthly report, such as '"path/to/file.tif": [12, 3456],'
+FILE_ENTRY = re.compile(
+    r'\s*"([^"\\]*(?:\\.[^"\\]*)*)"\s*:\s*\[\s*(\d+)\s*,\s*(\d+)\s*\]\s*([,}])'
+)
+MAX_ENTRY_SIZE = 64 * 1024
+# A whole string, a bracket, or the opening quote of a string that continues past the
+# end of the buffer
+SKIP_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]|"')
+
+
+class JsonStream:
+    """
+    Reads JSON values one at a time from a binary stream, such as an S3 object body
+    """
+
+    def __init__(self, body, chunk_size=CHUNK_SIZE):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+
+    def fill(self):
+        """
+        Read more text into the buffer, and return whether there was any
+        """
+        chunk = self.body.read(self.chunk_size)
+        text = self.decoder.decode(chunk, final=not chunk)
+        if not chunk and not text:
+            return False
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Return the next character after any whitespace, or '' at the end of the stream
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, *chars):
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(f"Expected one of {chars} in JSON, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = JSON_DECODER.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip(self):
+        """
+        Skip the next value without decoding it
+
+        Objects and arrays are skipped by counting brackets outside strings, keeping the
+        position across reads, so large values take linear time and build no objects.
+        """
+        if self.peek() not in ("{", "["):
+            self.value()
+            return
+        depth = 0
+        while True:
+            match = SKIP_TOKEN.search(self.buffer, self.pos)
+            if match is None or match.group() == '"':
+                # Keep any unfinished string in the buffer, and read more
+                self.pos = len(self.buffer) if match is None else match.start()
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON")
+                continue
+            self.pos = match.end()
+            token = match.group()
+            if token in ("{", "["):
+                depth += 1
+            elif token in ("}", "]"):
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def members(self):
+        """
+        Yield the (name, value) members of an object, calling 'value' or 'skip' for each
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            name = self.value()
+            self.expect(":")
+            yield name, self
+            if self.expect(",", "}") == "}":
+                return
+
+
+def report_files(body):
+    """
+    Yield the (path, [hits, bytes]) entries of the 'Files' of a monthly report
+
+    The report is read incrementally, so it is never held in memory as a whole.
+    """
+    stream = JsonStream(body)
+    for name, member in stream.members():
+        if name == "Files":
+            yield from file_entries(member)
+        else:
+            member.skip()
+
+
+def file_entries(stream):
+    """
+    Yield the (path, [hits, bytes]) entries of the 'Files' object next in a stream
+
+    Entries are matched with one regular expression where possible, falling back to
+    decoding each name and value.
+    """
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.pos += 1
+        return
+    while True:
+        match = FILE_ENTRY.match(stream.buffer, stream.pos)
+        if match is None:
+            # The entry may continue in the next chunk
+            if len(stream.buffer) - stream.pos < MAX_ENTRY_SIZE and stream.fill():
+                continue
+            path = stream.value()
+            stream.expect(":")
+            yield path, stream.value()
+            end = stream.expect(",", "}")
+        else:
+            path = match.group(1)
+            if "\\" in path:
+                path = json.loads(f'"{path}"')
+            stream.pos = match.end()
+            yield path, [int(match.group(2)), int(match.group(3))]
+            end = match.group(4)
+        if end == "}":
+            return
+
+
+def folder_totals(files):
+    """
+    Return the maximum hits and total bytes of each TIF file, in order of appearance
+    """
+    totals = {}
+    for path, (hits, nbytes) in files:
+        if not path.endswith(TIF_SUFFIXES):
+            continue
+        total = totals.get(path)
+        if total is None:
+            totals[path] = [int(hits), int(nbytes)]
+        else:
+            total[0] = max(total[0], int(hits))
+            total[1] += int(nbytes)
+    return totals
 
 
-def tile_index_from_path(path):
-    def go(part):
-        pattern = r"(?P<key>[xy])_(?P<num>.*)"
-        match = re.match(pattern, part, re.IGNORECASE)
-        if match is None:
-            return {}
-        gd = match.groupdict()
-        return {gd["key"]: gd["num"]}
+TILE_SEGMENT = re.compile(r"(?P<key>[xy])_(?P<num>.*)", re.IGNORECASE)
+BAND_DIRECTORIES = ("NBAR", "NBART", "QA", "SUPPLEMENTARY", "LAMBERTIAN")
+NO_LOCATION = ("<none>", "<none>", "<none>")
+# Number of parent directories whose parsed parts are kept
+PATH_CACHE_SIZE = 65536
+
 
+def tile_segments(segments):
     result = {}
-    for part in path.split("/"):
-        result.update(go(part))
+    for part in segments:
+        match = TILE_SEGMENT.match(part)
+        if match is not None:
+            result[match.group("key")] = match.group("num")
+    return result
+
+
+def tile_index_from_path(path):
+    result = tile_segments(path.split("/"))
     return result["x"], result["y"]
 
 
-def product_name(folder):
-    parts = Path(folder).parts
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def parent_parts(parent):
+    return Path(parent).parts, tile_segments(parent.split("/"))
+
+
+def split_path(folder):
+    """
+    Return the parts of a path, as 'Path(folder).parts', and its tile index segments
+
+    The parent directory of the path is parsed once for all the files in it.
+    """
+    parent, _, name = folder.rpartition("/")
+    if not parent.strip("/") or name in ("", "."):
+        return Path(folder).parts, tile_segments(folder.split("/"))
+
+    parts, tiles = parent_parts(parent)
+    match = TILE_SEGMENT.match(name)
+    if match is not None:
+        tiles = dict(tiles, **{match.group("key"): match.group("num")})
+    return parts + (name,), tiles
+
+
+def sentinel_2_location(folder, parts, tiles):
+    if parts[1] != "sentinel-2-nrt" or parts[-2] not in BAND_DIRECTORIES:
+        return NO_LOCATION
+    try:
+        return parts[-3].split("_")[-2][1:], "<none>", "<none>"
+    except IndexError:
+        print(folder)
+        return NO_LOCATION
+
+
+def scene_location(folder, parts, tiles):
+    fields = parts[-1].split("_")
+    try:
+        spatial = fields[2]
+    except IndexError:
+        print(folder)
+        spatial = "<none>"
+    return spatial, parts[-1].split(".tif")[0].split("_")[4], fields[3]
+
+
+def nidem_location(folder, parts, tiles):
+    fields = parts[-1].split("_")
+    try:
+        spatial = fields[1]
+    except IndexError:
+        print(folder)
+        spatial = None
+    return spatial, fields[3], fields[2]
+
+
+def tile_location(folder, parts, tiles):
+    return ",".join((tiles["x"], tiles["y"])), "<none>", "<none>"
+
+
+def blank_location(folder, parts, tiles):
+    return " ", " ", " "
+
+
+# Top level directory: (whether the path must be more than two levels deep, rule
+# returning the spatial id, latitude and longitude)
+PATH_RULES = {
+    "L2": (True, sentinel_2_location),
+    "hltc": (True, scene_location),
+    "item_v2": (False, scene_location),
+    "nidem": (True, nidem_location),
+    "bare-earth": (True, tile_location),
+    "geomedian-australia": (False, tile_location),
+    "WOfS": (False, tile_location),
+    "fractional-cover": (False, tile_location),
+    "projects": (True, blank_location),
+    "weathering-intensity": (False, blank_location),
+    "multi-scale-topographic-position": (True, blank_location),
+}
+
+
+def classify_path(folder):
+    """
+    Return the product, spatial id, latitude and longitude of a file path
+    """
+    parts, tiles = split_path(folder)
     if parts[0] == "mangrove_cover":
-        return parts[0]
-    return os.path.join(*parts[:2])
-
-
-def spatial_id(folder):
-    parts = Path(folder).parts
-    if parts[-2] in ["NBAR", "NBART", "QA", "SUPPLEMENTARY", "LAMBERTIAN"]:
-        pass
-    if (
-        len(parts) > 2
-        and parts[0] == "L2"
-        and parts[1] == "sentinel-2-nrt"
-        and parts[-2] in ["NBAR", "NBART", "QA", "SUPPLEMENTARY", "LAMBERTIAN"]
-    ):
-        try:
-            return parts[-3].split("_")[-2][1:]
-        except IndexError:
-            print(folder)
-    if len(parts) > 2 and parts[0] == "hltc" or parts[0] == "item_v2":
-        try:
-            return parts[-1].split("_")[2]
-        except IndexError:
-            print(folder)
-    if len(parts) > 2 and parts[0] == "nidem":
-        try:
-            return parts[-1].split("_")[1]
-        except IndexError:
-            print(folder)
-    elif (
-        len(parts) > 2
-        and parts[0] == "bare-earth"
-        or parts[0] == "geomedian-australia"
-        or parts[0] == "WOfS"
-        or parts[0] == "fractional-cover"
-    ):
-        return ",".join(tile_index_from_path(folder))
-    elif (
-        len(parts) > 2 and parts[0] == "projects" or parts[0] == "weathering-intensity"
-    ):
-        return " "
-    elif len(parts) > 2 and parts[0] == "multi-scale-topographic-position":
-        return " "
-    else:
-        return "<none>"
-
-
-def latcord(folder):
-    parts = Path(folder).parts
-
-    if len(parts) > 2 and parts[0] == "hltc" or parts[0] == "item_v2":
-        return (parts[-1].split(".tif"))[0].split("_")[4]
-    elif len(parts) > 2 and parts[0] == "nidem":
-        return parts[-1].split("_")[3]
-    elif (
-        len(parts) > 2 and parts[0] == "projects" or parts[0] == "weathering-intensity"
-    ):
-        return " "
-    elif len(parts) > 2 and parts[0] == "multi-scale-topographic-position":
-        return " "
-    else:
-        return "<none>"
-
-
-def loncord(folder):
-    parts = Path(folder).parts
-    if len(parts) > 2 and parts[0] == "hltc" or parts[0] == "item_v2":
-        return parts[-1].split("_")[3]
-    elif len(parts) > 2 and parts[0] == "nidem":
-        return parts[-1].split("_")[2]
-    elif (
-        len(parts) > 2 and parts[0] == "projects" or parts[0] == "weathering-intensity"
-    ):
-        return " "
-    elif len(parts) > 2 and parts[0] == "multi-scale-topographic-position":
-        return " "
+        product = parts[0]
     else:
-        return "<none>"
+        product = os.path.join(*parts[:2])
+
+    # Files in the top level directory have never been classified
+    if len(parts) < 2:
+        raise IndexError(f"Path has no directory: {folder}")
+
+    needs_depth, rule = PATH_RULES.get(parts[0], (False, None))
+    if rule is None or (needs_depth and len(parts) <= 2):
+        return (product,) + NO_LOCATION
+    return (product,) + rule(folder, parts, tiles)
 
 
-def merge_pre(folder_name, dicts, file_date):
-    dt = datetime.strptime(file_date + "01", "%Y%m%d")
+def merge_pre(folder_name, hits, nbytes, report_date):
+    product, spatial, lat, lon = classify_path(folder_name)
     return {
-        "date": dt.strftime("%d-%B-%Y"),
-        "product": product_name(folder_name),
-        "spatial_id": spatial_id(folder_name),
-        "Lat": latcord(folder_name),
-        "Lon": loncord(folder_name),
-        "hits": str(max(int(d["hits"]) for d in dicts)),
-        "bytes/GB": f"{(sum(int(d['bytes']) for d in dicts) / 1000000000):.2f}",
+        "date": report_date,
+        "product": product,
+        "spatial_id": spatial,
+        "Lat": lat,
+        "Lon": lon,
+        "hits": str(hits),
+        "bytes/GB": f"{(nbytes / 1000000000):.2f}",
         "folder": str(folder_name),
     }
 
 
-def group(entry_list, key):
-    lookup = defaultdict(list)
-
-    for d in entry_list:
-        lookup[d[key]].append(d)
-
-    return lookup
-
-
 def get_monthly_jsons(s3_client):
+    paginator = s3_client.get_paginator("list_objects_v2")
     every = [
         entry["Key"]
-        for entry in s3_client.list_objects(Bucket=S3_INPUT_BUCKET)["Contents"]
-        if entry["Key"].startswith("stats/month")
+        for page in paginator.paginate(
+            Bucket=S3_INPUT_BUCKET, Prefix=MONTHLY_JSON_PREFIX
+        )
+        for entry in page.get("Contents", [])
     ]
 
     assert (
@@ -167,66 +372,404 @@ def get_monthly_jsons(s3_client):
     return every[:-1]
 
 
-def stats(monthly_json, s3_client, features):
-    json_body = read_json(
-        json.loads(
-            s3_client.get_object(Bucket=S3_INPUT_BUCKET, Key=monthly_json)["Body"]
-            .read()
-            .decode("utf-8")
-        )
-    )
-    file_date = monthly_json.split(".")[0].split("/")[2]
-    stage2 = [
-        merge_pre(key, value, file_date)
-        for key, value in group(json_body, "folder").items()
-    ]
+def feature_label(feature):
+    properties = feature["properties"]
+    if "label" in properties:
+        return properties["label"]
+    if "MGRS" in properties:
+        return properties["MGRS"]
+    raise ValueError(f"Grid feature has no label or MGRS property: {properties}")
 
-    products = [d for d in stage2]
-    for feat in features:
-        if "label" in feat["properties"]:
-            label = feat["properties"]["label"]
-        elif "MGRS" in feat["properties"]:
-            label = feat["properties"]["MGRS"]
-        else:
-            raise
 
-        for dict_item in products:
-            if dict_item["spatial_id"] == label:
-                polygon = Polygon(feat["geometry"]["coordinates"][0])
-                dict_item["Lat"] = f"{polygon.centroid.y:.2f}"
-                dict_item["Lon"] = f"{polygon.centroid.x:.2f}"
+def centroid_index(features):
+    """
+    Map the label of each grid feature to the latitude and longitude of its centroid
 
-    return products, list(stage2[0])
+    Later features replace earlier ones with the same label.
+    """
+    index = {}
+    for feat in features:
+        centroid = Polygon(feat["geometry"]["coordinates"][0]).centroid
+        index[feature_label(feat)] = (f"{centroid.y:.2f}", f"{centroid.x:.2f}")
+    return index
 
 
-def handler(event, context):
-    """Main Entry Point"""
-    jsons = get_monthly_jsons(s3_client)
+@lru_cache(maxsize=None)
+def grid_centroids():
+    """
+    Centroids of the Albers and MGRS grid tiles, read once per Lambda container
+    """
+    # Extract albers grid features
+    with open(ALBERS_GEOJSON_FILE) as fl:
+        albers_features = json.load(fl)["features"]
 
     # Extract MGRS tiles features
     with open(MGRS_GEOJSON_FILE) as fl:
         mgrs_features = json.load(fl)["features"]
 
-    # Extract albers grid features
-    with open(ALBERS_GEOJSON_FILE) as fl:
-        albers_features = json.load(fl)["features"]
+    return centroid_index(albers_features + mgrs_features)
 
-    # Loop through files within s3stat-monitoring/stats/month bucket and process monthly
-    first_file = False
-    with tempfile.NamedTemporaryFile(
-        mode="w", suffix=".csv", encoding="utf-8", delete=False
-    ) as output_file:
-        for monthly_json in jsons:
-            products, header = stats(
-                monthly_json, s3_client, albers_features + mgrs_features
+
+def report_month(monthly_json):
+    """
+    Return the month of a monthly report key, such as 201906 for stats/month/201906.json
+    """
+    return monthly_json.split(".")[0].split("/")[2]
+
+
+def read_state(s3_client):
+    """
+    Return the state of the output, with the list of monthly reports already processed
+    """
+    try:
+        body = s3_client.get_object(Bucket=S3_OUTPUT_BUCKET, Key=STATE_KEY)["Body"]
+    except s3_client.exceptions.NoSuchKey:
+        return {"processed": []}
+    return json.loads(body.read().decode("utf-8"))
+
+
+def write_state(s3_client, state):
+    s3_client.put_object(
+        Bucket=S3_OUTPUT_BUCKET,
+        Key=STATE_KEY,
+        Body=json.dumps(state, indent=2).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Writable binary stream uploaded to an S3 object in parts as it is written
+
+    Objects smaller than one part are uploaded with a single put instead. The upload is
+    completed when the stream is closed, or aborted if the 'with' block raises. The size
+    attribute is the number of bytes of the object so far.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=PART_SIZE, **put_args):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.put_args = put_args
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    def copy(self, key, size):
+        """
+        Start the object with the first 'size' bytes of another object of the bucket
+
+        Ranges of at least MIN_PART_SIZE are copied within S3 as parts of the upload,
+        without downloading them. Smaller ones are read and written like other data.
+        """
+        if self.size:
+            raise ValueError("copy must start the S3MultipartWriter")
+        if size < MIN_PART_SIZE:
+            if size:
+                body = self.s3_client.get_object(
+                    Bucket=self.bucket, Key=key, Range=f"bytes=0-{size - 1}"
+                )["Body"]
+                self.write(body.read())
+            return
+
+        # Split the range into equal parts, none larger than S3 can copy
+        count = -(-size // MAX_COPY_PART_SIZE)
+        copy_part_size = -(-size // count)
+        for start in range(0, size, copy_part_size):
+            end = min(start + copy_part_size, size) - 1
+            number = self._next_part()
+            response = self.s3_client.upload_part_copy(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                CopySource={"Bucket": self.bucket, "Key": key},
+                CopySourceRange=f"bytes={start}-{end}",
+            )
+            self.parts.append(
+                {"ETag": response["CopyPartResult"]["ETag"], "PartNumber": number}
+            )
+        self.size = size
+
+    def _next_part(self):
+        """
+        Return the number of the next part, starting the upload if needed
+        """
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.put_args
+            )["UploadId"]
+        return len(self.parts) + 1
+
+    def _upload_part(self, body):
+        number = self._next_part()
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                **self.put_args,
+            )
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        self.buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def write_month(s3_client, monthly_json, products, header, compress=False):
+    """
+    Write the stats of one month to its partition of the output, gzipped if 'compress'
+    """
+    key = f"{MONTHLY_CSV_PREFIX}{report_month(monthly_json)}.csv"
+    if compress:
+        key += ".gz"
+    content_type = "application/gzip" if compress else "text/csv"
+
+    with S3MultipartWriter(
+        s3_client, S3_OUTPUT_BUCKET, key, ContentType=content_type
+    ) as month_file:
+        stream = (
+            gzip.GzipFile(fileobj=month_file, mode="wb") if compress else month_file
+        )
+        text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        dict_writer = csv.DictWriter(text, header)
+        dict_writer.writeheader()
+        dict_writer.writerows(products)
+        # Flush the text without closing the S3 object, which the 'with' block
+        # completes
+        text.detach()
+        if compress:
+            # Writes the gzip trailer, a gzip stream does not close its fileobj
+            stream.close()
+
+
+def stats(monthly_json, s3_client, centroids):
+    body = s3_client.get_object(Bucket=S3_INPUT_BUCKET, Key=monthly_json)["Body"]
+    totals = folder_totals(report_files(body))
+    dt = datetime.strptime(report_month(monthly_json) + "01", "%Y%m%d")
+    report_date = dt.strftime("%d-%B-%Y")
+    stage2 = [
+        merge_pre(key, hits, nbytes, report_date)
+        for key, (hits, nbytes) in totals.items()
+    ]
+
+    products = [d for d in stage2]
+    for dict_item in products:
+        centroid = centroids.get(dict_item["spatial_id"])
+        if centroid is not None:
+            dict_item["Lat"], dict_item["Lon"] = centroid
+
+    return products, list(stage2[0]), rollups(products, totals.values())
+
+
+def rollups(products, totals):
+    """
+    Return the rows of each of ROLLUPS, totalling a month's folders by its columns
+
+    :param products: the rows of the month's folders
+    :param totals: the (hits, bytes) of each folder, in the same order
+    """
+    tables = {}
+    for name, columns in ROLLUPS.items():
+        groups = {}
+        for row, (hits, nbytes) in zip(products, totals):
+            key = tuple(row[column] for column in columns)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [row, 0, 0, 0]
+            group[1] += 1
+            group[2] += hits
+            group[3] += nbytes
+
+        # Locations are those of the first folder of each spatial id
+        labels = columns + (("Lat", "Lon") if "spatial_id" in columns else ())
+        tables[name] = [
+            {
+                "date": row["date"],
+                **{label: row[label] for label in labels},
+                "folders": str(folders),
+                "hits": str(hits),
+                "bytes/GB": f"{(nbytes / 1000000000):.2f}",
+            }
+            for key, (row, folders, hits, nbytes) in sorted(
+                groups.items(), key=lambda item: [str(value) for value in item[0]]
             )
-            dict_writer = csv.DictWriter(output_file, header)
-            if not first_file:
+        ]
+    return tables
+
+
+def ordered_map(func, items, max_workers=MAX_WORKERS):
+    """
+    Yield func(item) for each item in order, running up to max_workers calls at once
+
+    Only max_workers results are held ahead of the one being yielded.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def output_size(s3_client, state):
+    """
+    Return the size of the part of data.csv holding the months recorded in the state
+    """
+    if "output_size" in state:
+        return state["output_size"]
+    if not state["processed"]:
+        return 0
+    # The state was saved before the size was recorded, when data.csv was replaced
+    # together with it
+    return s3_client.head_object(Bucket=S3_OUTPUT_BUCKET, Key=OUTPUT_CSV_KEY)[
+        "ContentLength"
+    ]
+
+
+def append_to_output(s3_client, monthly_stats, size):
+    """
+    Write the stats of each month to its partition, and append them to data.csv
+
+    The first 'size' bytes of data.csv, the months recorded in the state, are copied
+    within S3 as the start of the new object, so only the new months are uploaded.
+    Anything after them was written by a run that failed before saving the state, and
+    is replaced rather than appended to again.
+
+    :return: the new size of data.csv
+    """
+    with S3MultipartWriter(
+        s3_client, S3_OUTPUT_BUCKET, OUTPUT_CSV_KEY, ContentType="text/csv"
+    ) as output_file:
+        output_file.copy(OUTPUT_CSV_KEY, size)
+        text = io.TextIOWrapper(output_file, encoding="utf-8", newline="")
+        first_file = not size
+        for monthly_json, (products, header) in monthly_stats:
+            write_month(s3_client, monthly_json, products, header)
+            dict_writer = csv.DictWriter(text, header)
+            if first_file:
                 dict_writer.writeheader()  # file doesn't exist yet, write a header
-                first_file = True
-                dict_writer.writerows(products)
-            else:
-                dict_writer.writerows(products)
+                first_file = False
+            dict_writer.writerows(products)
+        # Flush the text, leaving the upload to be completed by the 'with' block
+        text.detach()
+    return output_file.size
+
+
+def write_rollups(s3_client, monthly_json, tables):
+    """
+    Write the rollup rows of one month to its partition of each rollup table
+
+    A partition is replaced when its month is processed again, such as by a retry.
+    """
+    month = report_month(monthly_json)
+    for name, rows in tables.items():
+        if not rows:
+            continue
+        output = io.StringIO()
+        dict_writer = csv.DictWriter(output, list(rows[0]))
+        dict_writer.writeheader()
+        dict_writer.writerows(rows)
+        s3_client.put_object(
+            Bucket=S3_OUTPUT_BUCKET,
+            Key=f"{ROLLUP_PREFIX}{name}/{month}.csv",
+            Body=output.getvalue().encode("utf-8"),
+            ContentType="text/csv",
+        )
+
+
+def with_rollups_written(s3_client, monthly_stats):
+    """
+    Yield the month and stats of each report, after writing its rollup partitions
+    """
+    for monthly_json, (products, header, tables) in monthly_stats:
+        write_rollups(s3_client, monthly_json, tables)
+        yield monthly_json, (products, header)
+
+
+def handler(event, context):
+    """Main Entry Point"""
+    state = read_state(s3_client)
+    processed = set(state["processed"])
+    jsons = [key for key in get_monthly_jsons(s3_client) if key not in processed]
+    if not jsons:
+        print("No new monthly reports to process")
+        return
+
+    centroids = grid_centroids()
+
+    # Loop through new files within s3stat-monitoring/stats/month and process monthly
+    monthly_stats = with_rollups_written(
+        s3_client,
+        zip(
+            jsons,
+            ordered_map(
+                lambda monthly_json: stats(monthly_json, s3_client, centroids), jsons
+            ),
+        ),
+    )
+    if OUTPUT_FORMAT == "csv.gz":
+        # Only the compressed month partitions are written
+        for monthly_json, (products, header) in monthly_stats:
+            write_month(s3_client, monthly_json, products, header, compress=True)
+    else:
+        state["output_size"] = append_to_output(
+            s3_client, monthly_stats, output_size(s3_client, state)
+        )
 
-        # Update the actual csv file
-        s3_client.upload_file(output_file.name, S3_OUTPUT_BUCKET, "s3-csv/data.csv")
+    # Saving the state commits the new months, a failed run is retried from the last
+    # state
+    state["processed"] = sorted(processed.union(jsons))
+    write_state(s3_client, state)
+    print(f"Processed {len(jsons)} new monthly reports")
@@ -1,36 +1,472 @@
 import boto3
+import gzip
+import io
 import json
+import random
+import time
 from pathlib import Path
 
 from unittest.mock import patch, call
+import pytest
 from moto import mock_s3
-from s3_monthly_update.handler import handler
+from s3_monthly_update.handler import (
+    JsonStream,
+    S3MultipartWriter,
+    centroid_index,
+    classify_path,
+    file_entries,
+    folder_totals,
+    get_monthly_jsons,
+    handler,
+    ordered_map,
+    report_files,
+    rollups,
+    stats,
+)
 
 
 @mock_s3
 @patch("s3_monthly_update.handler.get_monthly_jsons")
 @patch("s3_monthly_update.handler.stats")
+@patch("s3_monthly_update.handler.grid_centroids", dict)
 @patch("s3_monthly_update.handler.S3_OUTPUT_BUCKET", "s3_stat")
-def test_handler(get_monthly_jsons_mock, stats_mock):
+def test_handler(stats_mock, get_monthly_jsons_mock):
     bucket_name = "s3_stat"
-    key = "stats/month"
     s3 = boto3.resource("s3")
     # Create the bucket since this is all in Moto's 'virtual' AWS account
     bucket = s3.create_bucket(Bucket=bucket_name)
 
-    bucket.upload_file(str(Path(__file__).parent / "sample.json"), key)
+    header = ["date", "product", "hits"]
 
-    event_body = {
-        "Records": [{"s3": {"bucket": {"name": bucket_name}, "object": {"key": key}}}]
+    def month_stats(monthly_json, s3_client, centroids):
+        month = monthly_json.split(".")[0].split("/")[2]
+        rollup = [{"date": month, "product": "WOfS", "hits": "1"}]
+        return (
+            [{"date": month, "product": "WOfS", "hits": "1"}],
+            header,
+            {"product_month": rollup},
+        )
+
+    stats_mock.side_effect = month_stats
+    get_monthly_jsons_mock.return_value = [
+        "stats/month/201905.json",
+        "stats/month/201906.json",
+    ]
+
+    # Run the Function
+    handler({}, None)
+    assert stats_mock.call_count == 2
+
+    def read_csv(key):
+        return bucket.Object(key).get()["Body"].read().decode("utf-8").splitlines()
+
+    assert read_csv("s3-csv/data.csv") == [
+        "date,product,hits",
+        "201905,WOfS,1",
+        "201906,WOfS,1",
+    ]
+    assert read_csv("s3-csv/month/201906.csv") == ["date,product,hits", "201906,WOfS,1"]
+
+    # Only new months are processed, and appended to the output
+    get_monthly_jsons_mock.return_value.append("stats/month/201907.json")
+    handler({}, None)
+    assert stats_mock.call_count == 3
+    assert read_csv("s3-csv/data.csv")[1:] == [
+        "201905,WOfS,1",
+        "201906,WOfS,1",
+        "201907,WOfS,1",
+    ]
+    assert read_csv("s3-csv/rollup/product_month/201907.csv") == [
+        "date,product,hits",
+        "201907,WOfS,1",
+    ]
+    state = json.loads(bucket.Object("s3-csv/state.json").get()["Body"].read())
+    assert state["processed"] == [
+        "stats/month/201905.json",
+        "stats/month/201906.json",
+        "stats/month/201907.json",
+    ]
+
+    handler({}, None)
+    assert stats_mock.call_count == 3
+
+
+@mock_s3
+@patch("s3_monthly_update.handler.get_monthly_jsons")
+@patch("s3_monthly_update.handler.stats")
+@patch("s3_monthly_update.handler.grid_centroids", dict)
+@patch("s3_monthly_update.handler.S3_OUTPUT_BUCKET", "s3_stat")
+def test_handler_retry(stats_mock, get_monthly_jsons_mock):
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="s3_stat")
+    stats_mock.side_effect = lambda monthly_json, s3_client, centroids: (
+        [{"date": monthly_json[12:18], "hits": "1"}],
+        ["date", "hits"],
+        {"product_month": [{"date": monthly_json[12:18], "hits": "1"}]},
+    )
+    get_monthly_jsons_mock.return_value = ["stats/month/201905.json"]
+    handler({}, None)
+
+    # The run fails after data.csv is written, but before the state is saved
+    get_monthly_jsons_mock.return_value.append("stats/month/201906.json")
+    with patch("s3_monthly_update.handler.write_state", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            handler({}, None)
+
+    # The retry replaces the month written by the failed run
+    handler({}, None)
+    body = bucket.Object("s3-csv/data.csv").get()["Body"].read()
+    assert body.decode("utf-8").splitlines() == ["date,hits", "201905,1", "201906,1"]
+    state = json.loads(bucket.Object("s3-csv/state.json").get()["Body"].read())
+    assert state["output_size"] == len(body)
+    assert sorted(o.key for o in bucket.objects.filter(Prefix="s3-csv/rollup/")) == [
+        "s3-csv/rollup/product_month/201905.csv",
+        "s3-csv/rollup/product_month/201906.csv",
+    ]
+    rollup = bucket.Object("s3-csv/rollup/product_month/201906.csv").get()["Body"]
+    assert rollup.read().decode("utf-8").splitlines() == ["date,hits", "201906,1"]
+
+
+def square(label_property, label, x, y):
+    return {
+        "properties": {label_property: label},
+        "geometry": {
+            "coordinates": [[[x, y], [x + 1, y], [x + 1, y + 1], [x, y + 1], [x, y]]]
+        },
     }
-    event = {"Records": [{"body": json.dumps(event_body)}]}
 
-    sample_json = (Path(__file__).parent / "sample.json").read_bytes().decode("utf-8")
 
-    get_monthly_jsons_mock.return_value = [sample_json]
+def test_centroid_index():
+    features = [
+        square("label", "10,-20", 120, -30),
+        square("MGRS", "55HCC", 145, -35),
+        square("label", "10,-20", 121, -31),
+    ]
+    # Later features replace earlier ones with the same label
+    assert centroid_index(features) == {
+        "10,-20": ("-30.50", "121.50"),
+        "55HCC": ("-34.50", "145.50"),
+    }
 
-    # Run the Function
-    handler(event, None)
 
-    assert stats_mock.called
-    assert stats_mock.call_count == 1
+@mock_s3
+def test_stats():
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(Bucket="s3stat-monitoring")
+    s3_client.upload_file(
+        str(Path(__file__).parent / "sample.json"),
+        "s3stat-monitoring",
+        "stats/month/201906.json",
+    )
+
+    products, header, tables = stats(
+        "stats/month/201906.json", s3_client, {"55HCC": ("-34.50", "145.50")}
+    )
+    assert header == [
+        "date",
+        "product",
+        "spatial_id",
+        "Lat",
+        "Lon",
+        "hits",
+        "bytes/GB",
+        "folder",
+    ]
+    located = [p for p in products if p["spatial_id"] == "55HCC"]
+    assert located
+    assert all((p["Lat"], p["Lon"]) == ("-34.50", "145.50") for p in located)
+    assert all(p["date"] == "01-June-2019" for p in products)
+
+    by_product = tables["product_month"]
+    assert [r["product"] for r in by_product] == sorted(
+        set(p["product"] for p in products)
+    )
+    assert sum(int(r["folders"]) for r in by_product) == len(products)
+    assert sum(int(r["hits"]) for r in by_product) == sum(
+        int(p["hits"]) for p in products
+    )
+    by_spatial = tables["product_spatial_month"]
+    assert list(by_spatial[0]) == [
+        "date",
+        "product",
+        "spatial_id",
+        "Lat",
+        "Lon",
+        "folders",
+        "hits",
+        "bytes/GB",
+    ]
+    assert sum(int(r["folders"]) for r in by_spatial) == len(products)
+    assert [(r["Lat"], r["Lon"]) for r in by_spatial if r["spatial_id"] == "55HCC"] == [
+        ("-34.50", "145.50")
+    ] * len(set(p["product"] for p in located))
+
+
+def test_rollups():
+    products = [
+        {"date": "d", "product": "a", "spatial_id": "2", "Lat": "1", "Lon": "2"},
+        {"date": "d", "product": "b", "spatial_id": None, "Lat": "", "Lon": ""},
+        {"date": "d", "product": "a", "spatial_id": "1", "Lat": "3", "Lon": "4"},
+        {"date": "d", "product": "a", "spatial_id": "2", "Lat": "5", "Lon": "6"},
+    ]
+    totals = [(1, 10 ** 9), (2, 0), (3, 5 * 10 ** 8), (4, 2 * 10 ** 9)]
+    tables = rollups(products, totals)
+    assert tables["product_month"] == [
+        {"date": "d", "product": "a", "folders": "3", "hits": "8", "bytes/GB": "3.50"},
+        {"date": "d", "product": "b", "folders": "1", "hits": "2", "bytes/GB": "0.00"},
+    ]
+    assert [
+        (r["product"], r["spatial_id"], r["Lat"], r["folders"], r["hits"])
+        for r in tables["product_spatial_month"]
+    ] == [
+        ("a", "1", "3", "1", "3"),
+        ("a", "2", "1", "2", "5"),
+        ("b", None, "", "1", "2"),
+    ]
+
+
+@mock_s3
+def test_get_monthly_jsons():
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(Bucket="s3stat-monitoring")
+    # More than one page of a listing
+    keys = [
+        f"stats/month/{year}{month:02}.json"
+        for year in range(1940, 2025)
+        for month in range(1, 13)
+    ]
+    for key in keys + ["stats/week/201906-1.json", "index.html"]:
+        s3_client.put_object(Bucket="s3stat-monitoring", Key=key, Body=b"{}")
+
+    # The latest month is not complete yet
+    assert get_monthly_jsons(s3_client) == keys[:-1]
+
+
+def test_ordered_map():
+    def slow_square(n):
+        time.sleep(random.random() / 100)
+        return n * n
+
+    assert list(ordered_map(slow_square, range(20), max_workers=4)) == [
+        n * n for n in range(20)
+    ]
+
+
+@pytest.mark.parametrize(
+    "folder, expected",
+    [
+        (
+            "L2/sentinel-2-nrt/S2MSIARD/2019-05-26/"
+            "S2A_OPER_MSI_ARD_TL_EPAE_20190526T023858_A020491_T53KNV_N02.07/"
+            "NBART/NBART_B04.TIF",
+            ("L2/sentinel-2-nrt", "53KNV", "<none>", "<none>"),
+        ),
+        (
+            "WOfS/WOFLs/v2.1.5/combined/x_-12/y_-20/2019/05/26/"
+            "LS_WATER_3577_-12_-20_20190526.tif",
+            ("WOfS/WOFLs", "-12,-20", "<none>", "<none>"),
+        ),
+        (
+            "hltc/composite/COMPOSITE_HIGH_123_130.5_-12.3_20000101_PER_20.tif",
+            ("hltc/composite", "123", "-12.3", "130.5"),
+        ),
+        # Too shallow for the nidem rule
+        (
+            "nidem/NIDEM_33_130.91_-12.26.tif",
+            ("nidem/NIDEM_33_130.91_-12.26.tif", "<none>", "<none>", "<none>"),
+        ),
+        (
+            "nidem/v1/NIDEM_33_130.91_-12.26.tif",
+            ("nidem/v1", "33", "-12.26.tif", "130.91"),
+        ),
+        ("projects/foo/bar.tif", ("projects/foo", " ", " ", " ")),
+        (
+            "weathering-intensity/wii.tif",
+            ("weathering-intensity/wii.tif", " ", " ", " "),
+        ),
+        (
+            "mangrove_cover/x_1/y_2/a.tif",
+            ("mangrove_cover", "<none>", "<none>", "<none>"),
+        ),
+        ("unknown/a/b.tif", ("unknown/a", "<none>", "<none>", "<none>")),
+    ],
+)
+def test_classify_path(folder, expected):
+    assert classify_path(folder) == expected
+
+
+def test_classify_path_shared_parent():
+    # Files in the same directory reuse its parsed parts, but not each other's tiles
+    assert classify_path("WOfS/a/x_1/y_2/x_3.tif")[1] == "3.tif,2"
+    assert classify_path("WOfS/a/x_1/y_2/b.tif")[1] == "1,2"
+
+
+def test_report_files():
+    report = {
+        "Key": "month201906",
+        "Nested": {"a": [1, {"b": None}]},
+        "Files": {
+            "-": [6149875, 132666781643],
+            "WOfS/x_1/y_2/a.tif": [3, 1000],
+            'WOfS/x_1/y_2/"quoted" \u00e9.tif': [4, 2000],
+            "WOfS/x_1/y_2/b.TIF": [5.0, 3000],
+            "WOfS/x_1/y_2/a.yaml": [6, 4000],
+        },
+        "Hits": 115183007,
+    }
+    body = json.dumps(report, indent=1, ensure_ascii=False).encode("utf-8")
+
+    assert list(report_files(io.BytesIO(body))) == [
+        (path, list(entry)) for path, entry in report["Files"].items()
+    ]
+    # Every chunk boundary, including inside multi-byte characters
+    for chunk_size in range(1, 12):
+        stream = JsonStream(io.BytesIO(body), chunk_size=chunk_size)
+        for name, member in stream.members():
+            if name == "Files":
+                assert dict(file_entries(member)) == report["Files"]
+            else:
+                assert member.value() == report[name]
+
+    assert list(report_files(io.BytesIO(b'{"Files": {}}'))) == []
+
+
+def test_skip():
+    tricky = {
+        "Errors": {'a "[quoted]" {name}\\': ["}", "\\", [{"]": "{"}]], "b": []},
+        "Referers": ["x\u00e9\"]", 1.5, None, {"": {}}],
+        "Hits": 12,
+    }
+    body = json.dumps(tricky, ensure_ascii=False).encode("utf-8") + b"7"
+    # Every chunk boundary, including inside strings and after escapes
+    for chunk_size in range(1, 12):
+        stream = JsonStream(io.BytesIO(body), chunk_size=chunk_size)
+        names = []
+        for name, member in stream.members():
+            member.skip()
+            names.append(name)
+        assert names == ["Errors", "Referers", "Hits"]
+        assert stream.value() == 7
+
+
+class RecordingStream(JsonStream):
+    max_buffer = 0
+
+    def fill(self):
+        filled = super().fill()
+        self.max_buffer = max(self.max_buffer, len(self.buffer))
+        return filled
+
+
+def test_report_files_large_member():
+    # Large members before the files are skipped without holding them in memory
+    ips = {f"10.0.{n // 256}.{n % 256}": [n, n * 1000] for n in range(100000)}
+    files = {f"WOfS/x_{n}/y_2/a.tif": [n, 1000] for n in range(1000)}
+    body = json.dumps({"IPs": ips, "Files": files, "UserAgents": ips}).encode("utf-8")
+    assert len(body) > 4 * 1024 * 1024
+
+    stream = RecordingStream(io.BytesIO(body), chunk_size=64 * 1024)
+    totals = {}
+    for name, member in stream.members():
+        if name == "Files":
+            totals = dict(file_entries(member))
+        else:
+            member.skip()
+    assert totals == files
+    assert stream.max_buffer <= 2 * 64 * 1024
+
+
+def test_folder_totals():
+    files = [
+        ("b.tif", [3, 1000]),
+        ("a.tif", [1, 10]),
+        ("a.yaml", [9, 10]),
+        ("b.tif", ["7", "24"]),
+    ]
+    assert folder_totals(files) == {"b.tif": [7, 1024], "a.tif": [1, 10]}
+    assert list(folder_totals(files)) == ["b.tif", "a.tif"]
+
+
+@mock_s3
+def test_s3_multipart_writer(monkeypatch):
+    # Upload parts without the streaming checksums of recent botocore, which moto
+    # stores verbatim
+    monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(Bucket="s3_stat")
+    part_size = 5 * 1024 * 1024
+    data = bytes(range(256)) * (2 * part_size // 256) + b"0123456789"
+
+    with S3MultipartWriter(s3_client, "s3_stat", "big", part_size=part_size) as writer:
+        for start in range(0, len(data), 1000000):
+            writer.write(data[start:start + 1000000])
+    assert len(writer.parts) == 3
+    assert s3_client.get_object(Bucket="s3_stat", Key="big")["Body"].read() == data
+
+    # Small objects are put in one request
+    with S3MultipartWriter(
+        s3_client, "s3_stat", "small", ContentType="text/csv"
+    ) as writer:
+        writer.write(b"a,b\n")
+    small = s3_client.get_object(Bucket="s3_stat", Key="small")
+    assert small["Body"].read() == b"a,b\n"
+    assert small["ContentType"] == "text/csv"
+
+    # Nothing is written if the block fails
+    with pytest.raises(RuntimeError):
+        with S3MultipartWriter(
+            s3_client, "s3_stat", "failed", part_size=part_size
+        ) as writer:
+            writer.write(data)
+            raise RuntimeError()
+    assert "Contents" not in s3_client.list_objects_v2(
+        Bucket="s3_stat", Prefix="failed"
+    )
+    assert s3_client.list_multipart_uploads(Bucket="s3_stat").get("Uploads", []) == []
+
+    # The start of an object is copied within S3, or read if it is too small to be a part
+    size = part_size + 10
+    with S3MultipartWriter(s3_client, "s3_stat", "big", part_size=part_size) as writer:
+        writer.copy("big", size)
+        writer.write(b"tail")
+    assert len(writer.parts) == 2
+    assert writer.size == size + 4
+    body = s3_client.get_object(Bucket="s3_stat", Key="big")["Body"].read()
+    assert body == data[:size] + b"tail"
+
+    with S3MultipartWriter(s3_client, "s3_stat", "small") as writer:
+        writer.copy("small", 2)
+        writer.write(b"c\n")
+    assert writer.parts == []
+    body = s3_client.get_object(Bucket="s3_stat", Key="small")["Body"].read()
+    assert body == b"a,c\n"
+
+
+@mock_s3
+@patch("s3_monthly_update.handler.get_monthly_jsons")
+@patch("s3_monthly_update.handler.stats")
+@patch("s3_monthly_update.handler.grid_centroids", dict)
+@patch("s3_monthly_update.handler.S3_OUTPUT_BUCKET", "s3_stat")
+@patch("s3_monthly_update.handler.OUTPUT_FORMAT", "csv.gz")
+def test_handler_compressed(stats_mock, get_monthly_jsons_mock):
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="s3_stat")
+    stats_mock.return_value = (
+        [{"date": "201905", "hits": "1"}],
+        ["date", "hits"],
+        {"product_month": [{"date": "201905", "hits": "1"}]},
+    )
+    get_monthly_jsons_mock.return_value = ["stats/month/201905.json"]
+
+    handler({}, None)
+
+    assert sorted(o.key for o in bucket.objects.all()) == [
+        "s3-csv/month/201905.csv.gz",
+        "s3-csv/rollup/product_month/201905.csv",
+        "s3-csv/state.json",
+    ]
+    body = bucket.Object("s3-csv/month/201905.csv.gz").get()["Body"].read()
+    assert gzip.decompress(body).decode("utf-8").splitlines() == [
+        "date,hits",
+        "201905,1",
+    ]
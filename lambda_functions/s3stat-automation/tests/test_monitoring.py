@@ -0,0 +1,118 @@
+import boto3
+import threading
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from unittest.mock import patch
+import pytest
+from moto import mock_s3
+from s3_monitoring.handler import backfill, handler, reports, reports_between
+
+REPORT = b'{"files": {}}'
+ETAG = '"abc"'
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    requested = []
+
+    def do_GET(self):
+        self.requested.append(self.path)
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(REPORT)))
+        self.end_headers()
+        self.wfile.write(REPORT)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def report_url():
+    ReportRequestHandler.requested = []
+    server = HTTPServer(("127.0.0.1", 0), ReportRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_reports():
+    assert reports(date(2019, 6, 12)) == [
+        (
+            "https://s3.amazonaws.com/reports.s3stat.com/17448/dea-public-data/stats/"
+            "week201924.json",
+            "stats/week/201924.json",
+        ),
+        (
+            "https://s3.amazonaws.com/reports.s3stat.com/17448/dea-public-data/stats/"
+            "month201906.json",
+            "stats/month/201906.json",
+        ),
+    ]
+
+
+@mock_s3
+def test_handler(report_url, monkeypatch):
+    monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="s3stat-monitoring")
+
+    with patch("s3_monitoring.handler.REPORT_URL", report_url):
+        assert handler({}, None) == [True, True]
+        keys = sorted(o.key for o in bucket.objects.all())
+        assert [key.split("/")[1] for key in keys] == ["month", "week"]
+        for key in keys:
+            report = bucket.Object(key).get()
+            assert report["Body"].read() == REPORT
+            assert report["Metadata"]["source-etag"] == ETAG
+
+        # Unchanged reports are not uploaded again
+        assert handler({}, None) == [False, False]
+
+
+def test_reports_between():
+    keys = [key for _, key in reports_between(date(2019, 5, 30), date(2019, 6, 12))]
+    assert keys == [
+        "stats/week/201922.json",
+        "stats/month/201905.json",
+        "stats/month/201906.json",
+        "stats/week/201923.json",
+        "stats/week/201924.json",
+    ]
+
+
+@mock_s3
+def test_backfill(report_url, monkeypatch):
+    monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    s3_client = boto3.client("s3")
+    s3_client.create_bucket(Bucket="s3stat-monitoring")
+    s3_client.put_object(
+        Bucket="s3stat-monitoring", Key="stats/month/201905.json", Body=b"old"
+    )
+
+    uploaded = backfill(
+        date(2019, 5, 30), date(2019, 6, 12), report_url, max_workers=3, s3=s3_client
+    )
+
+    # The report already in the bucket is neither fetched nor replaced
+    assert uploaded == 4
+    assert sorted(ReportRequestHandler.requested) == [
+        "/month201906.json",
+        "/week201922.json",
+        "/week201923.json",
+        "/week201924.json",
+    ]
+    old = s3_client.get_object(
+        Bucket="s3stat-monitoring", Key="stats/month/201905.json"
+    )
+    assert old["Body"].read() == b"old"
+    new = s3_client.get_object(Bucket="s3stat-monitoring", Key="stats/week/201923.json")
+    assert new["Body"].read() == REPORT
+
+    assert backfill(date(2019, 5, 30), date(2019, 6, 12), report_url, s3=s3_client) == 0
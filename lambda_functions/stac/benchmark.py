@@ -5,32 +5,438 @@ sizes.
 
 import argparse
 import base64
+import importlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+import resource
+import statistics
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 import boto3
-import math
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Lambda prices in $, per GB-second of billed duration by architecture and per request
+PRICE_PER_GB_SECOND = {"x86_64": 0.0000166667, "arm64": 0.0000133334}
+PRICE_PER_REQUEST = 0.0000002
+# Billing granularity, in ms
+BILLING_INTERVAL = 1
+MEMORY_SIZES = "128,256,512,1024,1536,1769,2048,3008,4096,6144,8192,10240"
+MIN_MEMORY_SIZE = 128
+MAX_MEMORY_SIZE = 10240
+# Step between the memory sizes considered for the recommendation, in MB
+RECOMMENDATION_STEP = 64
+INVOCATIONS_COUNT = 20
+COLD_STARTS_COUNT = 3
+PERCENTILES = (50, 90, 99)
+# Memory size at which a Lambda function has the equivalent of one full vCPU
+FULL_CPU_MEMORY = 1769
+COLD_START_VARIABLE = "BENCHMARK_COLD_START"
+# Time to wait for a configuration update to complete, and between checks, in seconds
+UPDATE_TIMEOUT = 300
+UPDATE_POLL_INTERVAL = 1
+CSV_HEADER = (
+    "Memory Size,Invocations,Duration (in ms),p50 Duration (in ms),"
+    "p90 Duration (in ms),p99 Duration (in ms),p50 Billed Duration (in ms),"
+    "Max Memory Used (in MB),Cold Starts,p50 Cold Duration (in ms),"
+    "p50 Init Duration (in ms),Price Per 1M Invocations (in $),Pareto Optimal\n"
+)
 
-MEMORY_TO_PRICE = {
-    128: 0.000000208,
-    256: 0.000000417,
-    512: 0.000000834,
-    1024: 0.000001667,
-    1536: 0.000002501,
-    2048: 0.000003334,
-    2560: 0.000004168,
-    3008: 0.000004897,
+PriceModel = namedtuple("PriceModel", ["gb_second", "request", "interval"])
+
+# Fields of the REPORT line of a Lambda log, such as
+# "REPORT RequestId: ...\tDuration: 12.34 ms\tBilled Duration: 100 ms\t..."
+REPORT_FIELDS = {
+    "Duration": "duration",
+    "Billed Duration": "billed_duration",
+    "Memory Size": "memory_size",
+    "Max Memory Used": "max_memory_used",
+    "Init Duration": "init_duration",
 }
-PRICE_INTERVAL = 100
-INVOCATIONS_COUNT = 5
-CSV_HEADER = "Memory Size,Duration (in ms),Price Per 1M Invocations (in $)\n"
+REPORT_FIELD_RE = re.compile(r"([A-Za-z ]+): ([0-9.]+)")
 
+CONCURRENCY_LEVELS = "1,2,5,10,20,50"
+THROTTLE_ERRORS = ("TooManyRequestsException", "ThrottlingException")
+CONCURRENCY_CSV_HEADER = (
+    "Concurrency,Invocations,Errors,Throttles,Cold Starts,Throughput (per s),"
+    "p50 Latency (in ms),p90 Latency (in ms),p99 Latency (in ms),"
+    "p50 Duration (in ms),p90 Duration (in ms),p99 Duration (in ms)\n"
+)
 
-def invoke_lambda_and_get_duration(lambda_client, payload, function_name):
+
+class LocalLambdaClient:
     """
-    Invokes Lambda and return the duration.
+    Stand-in for a boto3 Lambda client that runs a handler in this process.
+
+    Invocations are answered like the Lambda API, with a REPORT line in the log tail,
+    so the benchmarks run unchanged without AWS. The handler module is imported on the
+    first invocation, which is reported as a cold start with its init duration.
+    """
+
+    def __init__(self, handler, memory_size=128):
+        """
+        :param handler: handler function, or its name such as 'stac.stac_handler'.
+        :param memory_size: memory size to report, in MB.
+        """
+        self._handler = handler
+        self._lock = threading.Lock()
+        self.config = {"MemorySize": memory_size, "Environment": {"Variables": {}}}
+
+    def _load_handler(self):
+        """
+        Return the handler function, and the time taken to import it on the first call.
+        """
+        with self._lock:
+            if callable(self._handler):
+                return self._handler, None
+            start = time.perf_counter()
+            module_name, function_name = self._handler.rsplit(".", 1)
+            self._handler = getattr(importlib.import_module(module_name), function_name)
+            return self._handler, (time.perf_counter() - start) * 1000
+
+    # Method and argument names follow the boto3 Lambda client
+    # pylint: disable=invalid-name,unused-argument
+
+    def get_function_configuration(self, FunctionName):
+        return dict(self.config, FunctionName=FunctionName)
+
+    def update_function_configuration(self, FunctionName, **config):
+        self.config.update(config)
+        return self.get_function_configuration(FunctionName)
+
+    def invoke(self, FunctionName, Payload, **kwargs):
+        handler, init_duration = self._load_handler()
+        request_id = str(uuid.uuid4())
+        context = lambda_context(FunctionName, self.config["MemorySize"], request_id)
+
+        error, result, duration = run_handler(handler, json.loads(Payload), context)
+        return local_response(
+            request_id,
+            error,
+            result,
+            local_report(
+                request_id,
+                duration,
+                self.config["MemorySize"],
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                init_duration,
+            ),
+        )
+
+    def close(self):
+        pass
+
+
+class EmulatedLambdaClient(LocalLambdaClient):
+    """
+    Stand-in for a boto3 Lambda client that emulates Lambda execution environments.
+
+    Each execution environment is a subprocess that imports the handler, so its first
+    invocation is a cold start, and then serves one invocation at a time. Environments
+    are reused while idle, and replaced when the configuration changes.
+
+    The CPU share of an environment is its memory size over FULL_CPU_MEMORY, as in
+    Lambda. A handler that gets less than a full CPU is held back in proportion to the
+    CPU time it used, so its duration is what it would be on the smaller share. An
+    environment that uses more memory than its memory size fails its invocation and is
+    discarded.
+    """
+
+    def __init__(self, handler, memory_size=128):
+        """
+        :param handler: handler name, such as 'stac.stac_handler'.
+        :param memory_size: initial memory size, in MB.
+        """
+        super().__init__(handler, memory_size)
+        self._idle = []
+        self._generation = 0
+        self._context = multiprocessing.get_context("spawn")
+
+    def update_function_configuration(self, FunctionName, **config):
+        with self._lock:
+            self.config.update(config)
+            self._generation += 1
+            idle, self._idle = self._idle, []
+        for environment in idle:
+            environment.close()
+        return self.get_function_configuration(FunctionName)
+
+    def _start_environment(self):
+        """
+        Start an execution environment with the current configuration.
+        """
+        parent, child = self._context.Pipe()
+        process = self._context.Process(
+            target=serve_environment,
+            args=(
+                child,
+                self._handler,
+                self.config["MemorySize"],
+                self.config.get("Environment", {}).get("Variables", {}),
+            ),
+            daemon=True,
+        )
+        process.start()
+        child.close()
+        return SimpleNamespace(
+            process=process,
+            connection=parent,
+            generation=self._generation,
+            close=lambda: close_environment(process, parent),
+        )
+
+    def invoke(self, FunctionName, Payload, **kwargs):
+        with self._lock:
+            environment = self._idle.pop() if self._idle else self._start_environment()
+            memory_size = self.config["MemorySize"]
+
+        request_id = str(uuid.uuid4())
+        try:
+            environment.connection.send((FunctionName, request_id, Payload))
+            error, result, duration, max_memory, init_duration = (
+                environment.connection.recv()
+            )
+        except (EOFError, OSError):
+            # The subprocess died, for example from an exception while importing
+            environment.process.join()
+            error, result, duration, max_memory, init_duration = (
+                True,
+                {
+                    "errorMessage": "Runtime exited with code {0}".format(
+                        environment.process.exitcode
+                    ),
+                    "errorType": "Runtime.ExitError",
+                },
+                0.0,
+                0.0,
+                None,
+            )
+
+        with self._lock:
+            reuse = (
+                environment.generation == self._generation
+                and environment.process.is_alive()
+                and max_memory <= memory_size
+            )
+            if reuse:
+                self._idle.append(environment)
+        if not reuse:
+            environment.close()
+
+        return local_response(
+            request_id,
+            error,
+            result,
+            local_report(request_id, duration, memory_size, max_memory, init_duration),
+        )
+
+    def close(self):
+        with self._lock:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+        for environment in idle:
+            environment.close()
+
+
+def lambda_context(function_name, memory_size, request_id):
+    """
+    Return a stand-in for the context object passed to a Lambda handler.
+    """
+    return SimpleNamespace(
+        function_name=function_name,
+        memory_limit_in_mb=memory_size,
+        aws_request_id=request_id,
+        get_remaining_time_in_millis=lambda: 900000,
+    )
+
+
+def run_handler(handler, event, context):
+    """
+    Run a Lambda handler.
+    :return: tuple of whether it raised an error, its result or error, and its
+        duration in ms.
+    """
+    start = time.perf_counter()
+    try:
+        return False, handler(event, context), (time.perf_counter() - start) * 1000
+    except Exception as error:  # pylint: disable=broad-except
+        result = {"errorMessage": str(error), "errorType": type(error).__name__}
+        return True, result, (time.perf_counter() - start) * 1000
+
+
+def serve_environment(connection, handler_name, memory_size, variables):
+    """
+    Serve invocations of a handler in an emulated execution environment subprocess.
+
+    Each invocation is answered with a tuple of whether it raised an error, its result
+    or error, its duration in ms, the peak memory of the environment in MB and, for
+    the first invocation only, the init duration in ms.
+    """
+    os.environ.update(variables)
+    cpu_share = min(memory_size / FULL_CPU_MEMORY, 1.0)
+
+    start = time.perf_counter()
+    module_name, function_name = handler_name.rsplit(".", 1)
+    handler = getattr(importlib.import_module(module_name), function_name)
+    init_duration = (time.perf_counter() - start) * 1000
+
+    while True:
+        try:
+            function_name, request_id, payload = connection.recv()
+        except EOFError:
+            return
+
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        context = lambda_context(function_name, memory_size, request_id)
+        error, result, _ = run_handler(handler, json.loads(payload), context)
+        # Hold the handler back as if it ran on its share of a CPU
+        time.sleep((time.process_time() - cpu_start) * (1 / cpu_share - 1))
+        duration = (time.perf_counter() - start) * 1000
+
+        max_memory = peak_memory()
+        if max_memory > memory_size:
+            error, result = (
+                True,
+                {
+                    "errorMessage": "Runtime exited with error: memory limit of "
+                    "{0} MB exceeded".format(memory_size),
+                    "errorType": "Runtime.OutOfMemory",
+                },
+            )
+        result = json.dumps(result, default=str)
+        connection.send((error, result, duration, max_memory, init_duration))
+        init_duration = None
+
+
+def peak_memory():
+    """
+    Return the peak resident memory of this process, in MB.
+
+    The peak of the process image is read from /proc where possible, since the
+    maximum RSS from getrusage includes the parent process of a spawned subprocess.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def close_environment(process, connection):
+    """
+    Stop an execution environment subprocess.
+    """
+    connection.close()
+    process.join(timeout=5)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def local_response(request_id, error, result, log):
+    """
+    Return a response like that of the Lambda 'invoke' API.
+    :param request_id: request ID.
+    :param error: whether the handler raised an error.
+    :param result: handler result or error, or its JSON text.
+    :param log: log tail.
+    :return: response dict.
+    """
+    if not isinstance(result, str):
+        result = json.dumps(result, default=str)
+    response = {
+        "StatusCode": 200,
+        "Payload": io.BytesIO(result.encode()),
+        "LogResult": base64.b64encode(log.encode()).decode(),
+    }
+    if error:
+        response["FunctionError"] = "Unhandled"
+    return response
+
+
+def local_report(request_id, duration, memory_size, max_memory_used, init_duration):
+    """
+    Return a Lambda log tail with a REPORT line for a local invocation.
+    :return: log text.
+    """
+    report = [
+        "REPORT RequestId: {0}".format(request_id),
+        "Duration: {0:.2f} ms".format(duration),
+        "Billed Duration: {0} ms".format(math.ceil(duration)),
+        "Memory Size: {0} MB".format(memory_size),
+        "Max Memory Used: {0:.0f} MB".format(max_memory_used),
+    ]
+    if init_duration is not None:
+        report.append("Init Duration: {0:.2f} ms".format(init_duration))
+    return "\t".join(report) + "\t\n"
+
+
+def make_lambda_client(args, max_concurrency=None):
+    """
+    Create the Lambda client to benchmark with.
+    :param args: arguments.
+    :param max_concurrency: number of concurrent invocations, which disables retries
+        so throttling is reported.
+    :return: boto3 Lambda client, or a LocalLambdaClient if a handler is given.
+    """
+    if args.handler and args.emulate:
+        return EmulatedLambdaClient(args.handler)
+    if args.handler:
+        return LocalLambdaClient(args.handler)
+
+    if args.aws_profile:
+        aws_session = boto3.Session(profile_name=args.aws_profile)
+    else:
+        aws_session = boto3.Session()
+
+    config = None
+    if max_concurrency:
+        config = Config(
+            max_pool_connections=max(max_concurrency, 10),
+            retries={"max_attempts": 0},
+            read_timeout=900,
+        )
+    return aws_session.client("lambda", region_name=args.region, config=config)
+
+
+def parse_report(lambda_log):
+    """
+    Parse the REPORT line of a Lambda log.
+    :param lambda_log: decoded log tail of an invocation.
+    :return: dict of duration, billed_duration, memory_size, max_memory_used and
+        init_duration, which is None unless the invocation was a cold start.
+    """
+    report_data = [
+        line for line in lambda_log.split("\n") if line.startswith("REPORT")
+    ][0]
+    report = dict.fromkeys(REPORT_FIELDS.values())
+    for col in report_data.split("\t"):
+        match = REPORT_FIELD_RE.match(col.strip())
+        if match and match.group(1) in REPORT_FIELDS:
+            report[REPORT_FIELDS[match.group(1)]] = float(match.group(2))
+    return report
+
+
+def invoke_lambda(lambda_client, payload, function_name):
+    """
+    Invokes Lambda and return its report.
     :param lambda_client: Lambda client.
     :param payload: payload to send.
     :param function_name: function name.
-    :return: duration.
+    :return: report parsed by parse_report.
     """
     response = lambda_client.invoke(
         FunctionName=function_name,
@@ -38,87 +444,552 @@ def invoke_lambda_and_get_duration(lambda_client, payload, function_name):
         LogType="Tail",
         Payload=payload,
     )
-
-    # Extract duration from Lambda log
     lambda_log = base64.b64decode(response["LogResult"]).decode("utf-8")
-    report_data = [
-        line for line in lambda_log.split("\n") if line.startswith("REPORT")
-    ][0]
-    duration = [col for col in report_data.split("\t") if col.startswith("Duration")][0]
-    duration = float(duration.split()[1])
-    return duration
+    return parse_report(lambda_log)
+
+
+def invoke_lambda_and_get_duration(lambda_client, payload, function_name):
+    """
+    Invokes Lambda and return the duration.
+    :param lambda_client: Lambda client.
+    :param payload: payload to send.
+    :param function_name: function name.
+    :return: duration.
+    """
+    return invoke_lambda(lambda_client, payload, function_name)["duration"]
+
+
+def percentile(values, percent):
+    """
+    Return a percentile of the values, interpolating linearly between the closest ranks.
+    :param values: non-empty list of numbers.
+    :param percent: percentile, from 0 to 100.
+    :return: percentile value.
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100
+    low = math.floor(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarise(values):
+    """
+    Summarise samples with their count, mean and percentiles.
+    :param values: list of numbers.
+    :return: dict of count, mean and p50, p90 and p99, which are None without samples.
+    """
+    summary = {"count": len(values)}
+    summary["mean"] = statistics.mean(values) if values else None
+    for percent in PERCENTILES:
+        summary["p{0}".format(percent)] = (
+            percentile(values, percent) if values else None
+        )
+    return summary
 
 
-def run_benchmark(args):
+def update_configuration(lambda_client, function_name, **config):
+    """
+    Update the function configuration and wait until the update has completed.
+
+    The configuration is polled, as the pinned boto3 has no waiter for updates.
+    :param lambda_client: Lambda client.
+    :param function_name: function name.
+    :param config: configuration to change.
+    :return: None.
+    """
+    lambda_client.update_function_configuration(FunctionName=function_name, **config)
+    deadline = time.monotonic() + UPDATE_TIMEOUT
+    while True:
+        status = lambda_client.get_function_configuration(
+            FunctionName=function_name
+        ).get("LastUpdateStatus")
+        if status != "InProgress":
+            break
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                "Update of {0} still in progress after {1}s".format(
+                    function_name, UPDATE_TIMEOUT
+                )
+            )
+        time.sleep(UPDATE_POLL_INTERVAL)
+    if status == "Failed":
+        raise ValueError("Update of {0} failed".format(function_name))
+
+
+def force_cold_start(lambda_client, function_name, variables, count):
+    """
+    Change an environment variable of the function, so its next invocation starts
+    a new execution environment.
+    :param lambda_client: Lambda client.
+    :param function_name: function name.
+    :param variables: original environment variables of the function.
+    :param count: value to set, distinct for each cold start.
+    :return: None.
+    """
+    update_configuration(
+        lambda_client,
+        function_name,
+        Environment={"Variables": dict(variables, **{COLD_START_VARIABLE: str(count)})},
+    )
+
+
+def benchmark_memory_size(lambda_client, payload, args, variables):
+    """
+    Measure cold and warm invocations of the function at its current memory size.
+    :param lambda_client: Lambda client.
+    :param payload: payload to send.
+    :param args: arguments.
+    :param variables: original environment variables of the function.
+    :return: tuple of lists of cold and warm invocation reports.
+    """
+    cold = []
+    for _ in range(args.cold_starts):
+        force_cold_start(lambda_client, args.function_name, variables, time.time_ns())
+        cold.append(invoke_lambda(lambda_client, payload, args.function_name))
+
+    if not cold:
+        print("Warming Lambda")
+        lambda_client.invoke(
+            FunctionName=args.function_name, Payload=payload,
+        )
+
+    warm = [
+        invoke_lambda(lambda_client, payload, args.function_name)
+        for _ in range(args.invocations)
+    ]
+    # A warm invocation can still land in a new execution environment
+    cold += [report for report in warm if report["init_duration"] is not None]
+    warm = [report for report in warm if report["init_duration"] is None]
+    return cold, warm
+
+
+def run_benchmark(args, lambda_client=None):
     """
     Run benchmark.
     :param args: arguments.
+    :param lambda_client: Lambda client, created from the arguments by default.
     :return: None.
     """
 
-    if args.aws_profile:
-        aws_session = boto3.Session(profile_name=args.aws_profile)
-    else:
-        aws_session = boto3.Session()
-
-    lambda_client = aws_session.client("lambda", region_name=args.region)
-    sorted_memory_sizes = sorted(MEMORY_TO_PRICE)
+    lambda_client = lambda_client or make_lambda_client(args)
+    sorted_memory_sizes = parse_memory_sizes(args.memory_sizes)
     results = {}
 
     # Load payload
     with open(args.payload_file, "rt") as input_data:
         payload = input_data.read()
 
-    # Read Original memory size
-    original_memory_size = lambda_client.get_function_configuration(
+    # Read Original configuration
+    original_config = lambda_client.get_function_configuration(
         FunctionName=args.function_name,
-    )["MemorySize"]
+    )
+    original_memory_size = original_config["MemorySize"]
+    variables = original_config.get("Environment", {}).get("Variables", {})
+    architecture = (
+        args.architecture or original_config.get("Architectures", ["x86_64"])[0]
+    )
     print("Original memory size: {0}".format(original_memory_size))
 
     # Benchmark
-    for memory_size in sorted_memory_sizes:
-        print("Setting memory size: {0}MB".format(memory_size))
-        lambda_client.update_function_configuration(
-            FunctionName=args.function_name, MemorySize=memory_size,
-        )
+    try:
+        for memory_size in sorted_memory_sizes:
+            print("Setting memory size: {0}MB".format(memory_size))
+            update_configuration(
+                lambda_client, args.function_name, MemorySize=memory_size
+            )
 
-        print("Warming Lambda")
-        lambda_client.invoke(
-            FunctionName=args.function_name, Payload=payload,
+            cold, warm = benchmark_memory_size(lambda_client, payload, args, variables)
+            results[memory_size] = (cold, warm)
+            if warm:
+                print(
+                    "Result: p50 {p50:.2f}ms, p90 {p90:.2f}ms, p99 {p99:.2f}ms "
+                    "over {count} warm invocations".format(
+                        **summarise([r["duration"] for r in warm])
+                    )
+                )
+            print("-" * 20)
+    finally:
+        print("Restoring original configuration")
+        update_configuration(
+            lambda_client,
+            args.function_name,
+            MemorySize=original_memory_size,
+            Environment={"Variables": variables},
         )
 
-        # Run several times
-        duration_sum = 0
-        for _ in range(INVOCATIONS_COUNT):
-            duration_sum += invoke_lambda_and_get_duration(
-                lambda_client, payload, args.function_name
+    model = PriceModel(
+        args.price_per_gb_second or PRICE_PER_GB_SECOND[architecture],
+        PRICE_PER_REQUEST,
+        args.billing_interval,
+    )
+    analysis = analyse_results(
+        results, model, args.latency_percentile, args.latency_target
+    )
+    print_analysis(analysis, args.latency_percentile, args.latency_target)
+    write_results(args.output_file, results, analysis)
+    return analysis
+
+
+def parse_memory_sizes(memory_sizes):
+    """
+    Parse a comma separated list of memory sizes.
+    :param memory_sizes: memory sizes in MB, such as '128,1024'.
+    :return: sorted list of memory sizes.
+    """
+    sizes = sorted(int(size) for size in memory_sizes.split(","))
+    for size in sizes:
+        if not MIN_MEMORY_SIZE <= size <= MAX_MEMORY_SIZE:
+            raise ValueError(
+                "Memory size {0}MB is outside {1}MB to {2}MB".format(
+                    size, MIN_MEMORY_SIZE, MAX_MEMORY_SIZE
+                )
             )
+    return sizes
+
+
+def invocation_price(model, memory_size, duration):
+    """
+    Return the price of an invocation.
+    :param model: PriceModel.
+    :param memory_size: memory size in MB.
+    :param duration: duration in ms, rounded up to the billing interval.
+    :return: price in $.
+    """
+    billed = math.ceil(duration / model.interval) * model.interval
+    return billed / 1000 * memory_size / 1024 * model.gb_second + model.request
+
+
+def fit_duration_curve(points):
+    """
+    Fit durations to 'a + b / min(memory, FULL_CPU_MEMORY)' by least squares.
+
+    Compute bound work scales with the CPU share, which grows with memory up to one
+    full vCPU, while the constant term covers waiting for I/O.
+    :param points: list of (memory size, duration) tuples.
+    :return: tuple of the coefficients (a, b).
+    """
+    xs = [1 / min(memory_size, FULL_CPU_MEMORY) for memory_size, _ in points]
+    ys = [duration for _, duration in points]
+    mean_x, mean_y = statistics.mean(xs), statistics.mean(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return mean_y, 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+    return mean_y - slope * mean_x, slope
+
+
+def predict_duration(curve, memory_size):
+    """
+    Return the duration predicted by a fitted curve, in ms.
+    """
+    intercept, slope = curve
+    return max(intercept + slope / min(memory_size, FULL_CPU_MEMORY), 0.0)
 
-        duration = duration_sum / INVOCATIONS_COUNT
-        results[memory_size] = duration
-        print("Result: {0}".format(duration))
-        print("-" * 20)
 
-    print("Restoring original memory size")
-    lambda_client.update_function_configuration(
-        FunctionName=args.function_name, MemorySize=original_memory_size,
+def pareto_frontier(points):
+    """
+    Return the memory sizes for which no other is both cheaper and faster.
+    :param points: dict of memory size to (latency, price) tuples.
+    :return: sorted list of memory sizes.
+    """
+    frontier = []
+    best_latency = math.inf
+    for memory_size, (latency, _) in sorted(
+        points.items(), key=lambda item: (item[1][1], item[1][0])
+    ):
+        if latency < best_latency:
+            frontier.append(memory_size)
+            best_latency = latency
+    return sorted(frontier)
+
+
+def recommend_memory_size(latency_curve, mean_curve, model, target=None):
+    """
+    Return the cheapest memory size whose predicted latency meets a target.
+
+    Memory sizes from MIN_MEMORY_SIZE to MAX_MEMORY_SIZE in steps of
+    RECOMMENDATION_STEP are considered, priced at their predicted mean duration.
+    :param latency_curve: fitted curve of the latency percentile.
+    :param mean_curve: fitted curve of the mean duration.
+    :param model: PriceModel.
+    :param target: latency target in ms, or None for the cheapest memory size.
+    :return: tuple of memory size, predicted latency and price per 1M invocations,
+        or None if no memory size meets the target.
+    """
+    candidates = []
+    for memory_size in range(MIN_MEMORY_SIZE, MAX_MEMORY_SIZE + 1, RECOMMENDATION_STEP):
+        latency = predict_duration(latency_curve, memory_size)
+        if target is not None and latency > target:
+            continue
+        price = (
+            invocation_price(
+                model, memory_size, predict_duration(mean_curve, memory_size)
+            )
+            * 1000000
+        )
+        candidates.append((price, latency, memory_size))
+    if not candidates:
+        return None
+    price, latency, memory_size = min(candidates)
+    return memory_size, latency, price
+
+
+def analyse_results(results, model, percent, target=None):
+    """
+    Price the warm invocations of each memory size and recommend a memory size.
+    :param results: dict of memory size to lists of cold and warm invocation reports.
+    :param model: PriceModel.
+    :param percent: latency percentile to compare memory sizes with.
+    :param target: latency target in ms, or None.
+    :return: dict of 'points', a dict of memory size to latency and price per 1M
+        invocations, 'frontier', 'latency_curve', 'mean_curve' and 'recommendation'.
+    """
+    points = {}
+    means = []
+    for memory_size, (_, warm) in results.items():
+        durations = [r["duration"] for r in warm]
+        if not durations:
+            continue
+        price = statistics.mean(
+            invocation_price(model, memory_size, duration) for duration in durations
+        )
+        points[memory_size] = (percentile(durations, percent), price * 1000000)
+        means.append((memory_size, statistics.mean(durations)))
+
+    analysis = {
+        "points": points,
+        "frontier": pareto_frontier(points),
+        "latency_curve": None,
+        "mean_curve": None,
+        "recommendation": None,
+    }
+    if points:
+        analysis["latency_curve"] = fit_duration_curve(
+            [(memory_size, latency) for memory_size, (latency, _) in points.items()]
+        )
+        analysis["mean_curve"] = fit_duration_curve(means)
+        analysis["recommendation"] = recommend_memory_size(
+            analysis["latency_curve"], analysis["mean_curve"], model, target
+        )
+    return analysis
+
+
+def print_analysis(analysis, percent, target=None):
+    """
+    Print the fitted curve, Pareto frontier and recommended memory size.
+    :return: None.
+    """
+    if not analysis["points"]:
+        print("No successful warm invocations to analyse")
+        return
+
+    intercept, slope = analysis["latency_curve"]
+    print(
+        "Fitted p{0} duration: {1:.2f} + {2:.0f} / min(memory, {3}) ms".format(
+            percent, intercept, slope, FULL_CPU_MEMORY
+        )
     )
+    print("Pareto frontier:")
+    for memory_size in analysis["frontier"]:
+        latency, price = analysis["points"][memory_size]
+        print(
+            "  {0}MB: p{1} {2:.2f}ms, ${3:.2f} per 1M invocations".format(
+                memory_size, percent, latency, price
+            )
+        )
+
+    if analysis["recommendation"] is None:
+        print("No memory size meets the p{0} target of {1}ms".format(percent, target))
+    else:
+        memory_size, latency, price = analysis["recommendation"]
+        print(
+            "Recommended memory size: {0}MB, predicted p{1} {2:.2f}ms, "
+            "${3:.2f} per 1M invocations".format(memory_size, percent, latency, price)
+        )
+
 
-    with open(args.output_file, "wt") as output_results:
+def write_results(output_file, results, analysis):
+    """
+    Write the statistics of each memory size to a CSV file.
+    :param output_file: output file name.
+    :param results: dict of memory size to lists of cold and warm invocation reports.
+    :param analysis: analyse_results result.
+    :return: None.
+    """
+
+    def value(number):
+        return "" if number is None else "%.2f" % (number,)
+
+    with open(output_file, "wt") as output_results:
         output_results.write(CSV_HEADER)
-        for memory_size in sorted_memory_sizes:
-            price = (
-                math.ceil(results[memory_size] / PRICE_INTERVAL)
-                * MEMORY_TO_PRICE[memory_size]
-                * 1000000
+        for memory_size in sorted(results):
+            cold, warm = results[memory_size]
+            durations = summarise([r["duration"] for r in warm])
+            billed = summarise([r["billed_duration"] for r in warm])
+            max_memory = max((r["max_memory_used"] for r in cold + warm), default=None)
+            cold_durations = summarise([r["duration"] for r in cold])
+            init_durations = summarise(
+                [r["init_duration"] for r in cold if r["init_duration"] is not None]
+            )
+            price = analysis["points"].get(memory_size, (None, None))[1]
+
+            output_results.write(
+                ",".join(
+                    [
+                        "{0}MB".format(memory_size),
+                        str(durations["count"]),
+                        value(durations["mean"]),
+                        value(durations["p50"]),
+                        value(durations["p90"]),
+                        value(durations["p99"]),
+                        value(billed["p50"]),
+                        value(max_memory),
+                        str(cold_durations["count"]),
+                        value(cold_durations["p50"]),
+                        value(init_durations["p50"]),
+                        value(price),
+                        "yes" if memory_size in analysis["frontier"] else "no",
+                    ]
+                )
+                + "\n"
+            )
+
+
+def timed_invoke(lambda_client, payload, function_name):
+    """
+    Invoke Lambda and measure the latency seen by the caller.
+    :param lambda_client: Lambda client.
+    :param payload: payload to send.
+    :param function_name: function name.
+    :return: tuple of status ('ok', 'error' or 'throttled'), latency in ms and the
+        report parsed by parse_report, or None if there is no log.
+    """
+    start = time.perf_counter()
+    try:
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="RequestResponse",
+            LogType="Tail",
+            Payload=payload,
+        )
+    except ClientError as error:
+        latency = (time.perf_counter() - start) * 1000
+        if error.response["Error"]["Code"] in THROTTLE_ERRORS:
+            return "throttled", latency, None
+        return "error", latency, None
+    latency = (time.perf_counter() - start) * 1000
+
+    report = None
+    if "LogResult" in response:
+        report = parse_report(base64.b64decode(response["LogResult"]).decode("utf-8"))
+    status = "error" if "FunctionError" in response else "ok"
+    return status, latency, report
+
+
+def invoke_concurrently(lambda_client, payload, function_name, concurrency, count):
+    """
+    Invoke Lambda a number of times with up to 'concurrency' invocations in flight.
+    :param lambda_client: Lambda client.
+    :param payload: payload to send.
+    :param function_name: function name.
+    :param concurrency: number of concurrent invocations.
+    :param count: total number of invocations.
+    :return: tuple of the list of timed_invoke results and the elapsed seconds.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(
+            executor.map(
+                lambda _: timed_invoke(lambda_client, payload, function_name),
+                range(count),
+            )
+        )
+    return outcomes, time.perf_counter() - start
+
+
+def summarise_concurrency(outcomes, seconds):
+    """
+    Summarise the invocations at one concurrency level.
+    :param outcomes: list of timed_invoke results.
+    :param seconds: elapsed seconds.
+    :return: dict of counts, throughput and latency and duration summaries.
+    """
+    succeeded = [o for o in outcomes if o[0] == "ok"]
+    reports = [report for _, _, report in succeeded if report is not None]
+    return {
+        "invocations": len(outcomes),
+        "errors": sum(1 for o in outcomes if o[0] == "error"),
+        "throttles": sum(1 for o in outcomes if o[0] == "throttled"),
+        "cold_starts": sum(1 for r in reports if r["init_duration"] is not None),
+        "throughput": len(succeeded) / seconds if seconds else 0.0,
+        "latency": summarise([latency for _, latency, _ in succeeded]),
+        "duration": summarise([r["duration"] for r in reports]),
+    }
+
+
+def run_concurrency_sweep(args, lambda_client=None):
+    """
+    Run invocations at each concurrency level, as SQS does when scaling the function.
+    :param args: arguments.
+    :param lambda_client: Lambda client, created from the arguments by default.
+    :return: dict of concurrency level to summarise_concurrency results.
+    """
+    levels = sorted(int(level) for level in args.concurrency.split(","))
+    lambda_client = lambda_client or make_lambda_client(args, max(levels))
+
+    with open(args.payload_file, "rt") as input_data:
+        payload = input_data.read()
+
+    results = {}
+    for concurrency in levels:
+        # At least one round of invocations at full concurrency
+        count = max(args.invocations, concurrency)
+        print("Invoking {0} times, {1} at once".format(count, concurrency))
+        outcomes, seconds = invoke_concurrently(
+            lambda_client, payload, args.function_name, concurrency, count
+        )
+        results[concurrency] = summarise_concurrency(outcomes, seconds)
+        print(
+            "Result: {throughput:.2f}/s, {errors} errors, {throttles} throttles".format(
+                **results[concurrency]
             )
+        )
+        print("-" * 20)
+
+    write_concurrency_results(args.output_file, results)
+    return results
+
+
+def write_concurrency_results(output_file, results):
+    """
+    Write the statistics of each concurrency level to a CSV file.
+    :param output_file: output file name.
+    :param results: dict of concurrency level to summarise_concurrency results.
+    :return: None.
+    """
 
+    def value(number):
+        return "" if number is None else "%.2f" % (number,)
+
+    with open(output_file, "wt") as output_results:
+        output_results.write(CONCURRENCY_CSV_HEADER)
+        for concurrency in sorted(results):
+            result = results[concurrency]
             output_results.write(
-                "{0},{1},{2}\n".format(
-                    "{0}MB".format(memory_size),
-                    "%.2f" % (results[memory_size],),
-                    "%.2f" % (price,),
+                ",".join(
+                    [
+                        str(concurrency),
+                        str(result["invocations"]),
+                        str(result["errors"]),
+                        str(result["throttles"]),
+                        str(result["cold_starts"]),
+                        value(result["throughput"]),
+                    ]
+                    + [value(result["latency"]["p%d" % p]) for p in PERCENTILES]
+                    + [value(result["duration"]["p%d" % p]) for p in PERCENTILES]
                 )
+                + "\n"
             )
 
 
@@ -132,7 +1003,6 @@ def main():
         "--function",
         dest="function_name",
         default=False,
-        required=True,
         help="Tested function name.",
     )
     parser.add_argument(
@@ -140,9 +1010,35 @@ def main():
         "--region",
         dest="region",
         default=False,
-        required=True,
         help="Tested function region.",
     )
+    parser.add_argument(
+        "--handler",
+        dest="handler",
+        help="Run this handler locally instead of invoking AWS Lambda, such as "
+        "'stac.stac_handler'.",
+    )
+    parser.add_argument(
+        "--emulate",
+        dest="emulate",
+        action="store_true",
+        help="Run the --handler in subprocesses emulating Lambda execution "
+        "environments, with the memory limit and CPU share of each memory size.",
+    )
+    parser.add_argument(
+        "--mode",
+        dest="mode",
+        choices=["memory", "concurrency"],
+        default="memory",
+        help="Benchmark each memory size, or each level of concurrent invocations.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        default=CONCURRENCY_LEVELS,
+        help="Comma separated numbers of concurrent invocations for the "
+        "concurrency mode.",
+    )
     parser.add_argument(
         "-p",
         "--payload_file",
@@ -151,6 +1047,46 @@ def main():
         required=True,
         help="JSON Payload filename to send to the function.",
     )
+    parser.add_argument(
+        "--memory-sizes",
+        dest="memory_sizes",
+        default=MEMORY_SIZES,
+        help="Comma separated memory sizes to benchmark, in MB.",
+    )
+    parser.add_argument(
+        "--architecture",
+        dest="architecture",
+        choices=sorted(PRICE_PER_GB_SECOND),
+        help="Architecture to price the function at (default: the function's).",
+    )
+    parser.add_argument(
+        "--price-per-gb-second",
+        dest="price_per_gb_second",
+        type=float,
+        help="Price per GB-second of billed duration in $, instead of the price "
+        "for the architecture.",
+    )
+    parser.add_argument(
+        "--billing-interval",
+        dest="billing_interval",
+        type=int,
+        default=BILLING_INTERVAL,
+        help="Billing granularity in ms.",
+    )
+    parser.add_argument(
+        "--latency-target",
+        dest="latency_target",
+        type=float,
+        help="Recommend the cheapest memory size meeting this duration in ms.",
+    )
+    parser.add_argument(
+        "--latency-percentile",
+        dest="latency_percentile",
+        type=int,
+        choices=PERCENTILES,
+        default=90,
+        help="Duration percentile to compare with the latency target.",
+    )
     parser.add_argument(
         "--profile",
         dest="aws_profile",
@@ -158,6 +1094,23 @@ def main():
         required=False,
         help="A specific AWS Named Profile configured within your AWS Credentials file.",
     )
+    parser.add_argument(
+        "-n",
+        "--invocations",
+        dest="invocations",
+        type=int,
+        default=INVOCATIONS_COUNT,
+        help="Number of warm invocations for each memory size, or invocations "
+        "for each concurrency level.",
+    )
+    parser.add_argument(
+        "--cold-starts",
+        dest="cold_starts",
+        type=int,
+        default=COLD_STARTS_COUNT,
+        help="Number of cold starts to force for each memory size, by changing an "
+        "environment variable of the function.",
+    )
     parser.add_argument(
         "--output",
         dest="output_file",
@@ -165,7 +1118,19 @@ def main():
         help="Output results filename.",
     )
     arguments = parser.parse_args()
-    run_benchmark(arguments)
+    if arguments.handler:
+        arguments.function_name = arguments.function_name or arguments.handler
+    elif not (arguments.function_name and arguments.region):
+        parser.error("--function and --region are required without --handler")
+    try:
+        parse_memory_sizes(arguments.memory_sizes)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if arguments.mode == "concurrency":
+        run_concurrency_sweep(arguments)
+    else:
+        run_benchmark(arguments)
 
 
 if __name__ == "__main__":
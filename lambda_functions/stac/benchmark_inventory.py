@@ -0,0 +1,111 @@
+"""
+Benchmark S3 inventory key filtering against a synthetic inventory.
+
+Compares the per-prefix scan previously used by 'yamls_in_inventory_list' with the
+precompiled prefix matcher, on an inventory generated from the products configured in
+the given config file. No AWS access is needed.
+"""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import ruamel.yaml
+
+from stac_utils import yamls_in_inventory_list
+
+YAML = ruamel.yaml.YAML(typ="safe")
+SUFFIXES = [".yaml", "_STAC.json", "_BS.tif", "_PV.tif", "_NPV.tif", "_UE.tif"]
+OTHER_PREFIXES = ["L2/sentinel-2-nbar", "baseline/ga_ls8c_ard_3", "projects/unknown"]
+
+
+def synthetic_inventory(prefixes, rows, seed=0):
+    """
+    Return a list of inventory records similar to those from 'odc.aws.inventory.list_inventory'
+    """
+
+    rng = random.Random(seed)
+    prefixes = list(prefixes) + OTHER_PREFIXES
+    items = []
+    for n in range(rows):
+        x, y = rng.randint(-20, 20), rng.randint(-50, -10)
+        key = (
+            f"{rng.choice(prefixes)}/x_{x}/y_{y}/2010/02/13/"
+            f"DATASET_3577_{x}_{y}_{n}{rng.choice(SUFFIXES)}"
+        )
+        items.append(
+            SimpleNamespace(
+                Bucket="dea-public-data",
+                Key=key,
+                Size=str(rng.randint(1000, 100000000)),
+                LastModifiedDate="2019-05-21T03:43:25.000Z",
+            )
+        )
+    return items
+
+
+def scan_prefixes(keys, cfg):
+    """
+    The previous implementation, checking every configured prefix for every key
+    """
+    prefixes = set(p["prefix"] for p in cfg["products"])
+    for item in keys:
+        if item.Key.endswith(".yaml") and any(
+            item.Key.startswith(prefix) for prefix in prefixes
+        ):
+            yield item.Key
+
+
+def time_filter(filter_func, inventory, cfg):
+    start = time.perf_counter()
+    count = sum(1 for _ in filter_func(inventory, cfg))
+    return time.perf_counter() - start, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="stac_config.yaml", help="The config file")
+    parser.add_argument(
+        "--rows", type=int, default=1000000, help="Number of inventory rows"
+    )
+    parser.add_argument(
+        "--extra-products",
+        type=int,
+        default=50,
+        help="Number of synthetic products to add to those configured",
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as cfg_file:
+        cfg = YAML.load(cfg_file)
+    cfg["products"] += [
+        {"prefix": f"synthetic/product_{n}/v1.0.0"} for n in range(args.extra_products)
+    ]
+
+    inventory = synthetic_inventory((p["prefix"] for p in cfg["products"]), args.rows)
+    print(
+        "{0} inventory rows, {1} configured products".format(
+            len(inventory), len(cfg["products"])
+        )
+    )
+
+    results = {}
+    for name, filter_func in [
+        ("prefix scan", scan_prefixes),
+        ("prefix matcher", yamls_in_inventory_list),
+    ]:
+        duration, count = time_filter(filter_func, inventory, cfg)
+        results[name] = duration
+        print(
+            "{0}: {1:.2f}s, {2:.0f} rows/s, {3} keys selected".format(
+                name, duration, len(inventory) / duration, count
+            )
+        )
+
+    speedup = results["prefix scan"] / results["prefix matcher"]
+    print("Speedup: {0:.1f}x".format(speedup))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""
+Offline benchmark suite for STAC conversion and catalog generation.
+
+Times the STAC Item conversion of synthetic ODC dataset documents, the selection of
+dataset keys from a synthetic S3 inventory and the generation of parent catalogs
+against an in-memory stand-in for S3, at several sizes. No network access is needed.
+
+Throughput and peak Python memory are reported for each benchmark, and compared with
+a stored baseline file if there is one.
+
+With --geometry-report, the size of STAC Items with full precision geometries is
+compared with their size under the configured geometry precision and simplification
+instead, over synthetic datasets or a sample of ODC metadata documents.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import ruamel.yaml
+
+from benchmark_inventory import synthetic_inventory
+from stac_utils import yamls_in_inventory_list
+
+YAML = ruamel.yaml.YAML(typ="safe")
+
+# Number of datasets at each size. Inventories have 20 rows per dataset.
+SIZES = {"small": 100, "medium": 1000, "large": 10000}
+INVENTORY_ROWS_PER_DATASET = 20
+VALID_DATA_VERTICES = 50
+TILE_SIZE = 100000.0
+DEFAULT_BASELINE = "benchmark_baseline.json"
+DEFAULT_TOLERANCE = 0.2
+
+
+def synthetic_dataset(prefix, n, rng, vertices=VALID_DATA_VERTICES):
+    """
+    Return the S3 key and ODC metadata document of a synthetic Albers tiled dataset
+    """
+
+    x, y = rng.randint(-20, 20), rng.randint(-50, -10)
+    day = rng.randint(1, 28)
+    name = f"LS_SYNTHETIC_3577_{x}_{y}_201001{day:02}{n:06}"
+    key = f"{prefix}/x_{x}/y_{y}/2010/01/{day:02}/{name}.yaml"
+
+    # A roughly circular valid data polygon inside the tile
+    x0, y0 = x * TILE_SIZE, y * TILE_SIZE
+    radius = TILE_SIZE / 2
+    ring = [
+        [
+            x0 + radius + radius * 0.9 * math.cos(2 * math.pi * i / vertices),
+            y0 + radius + radius * 0.9 * math.sin(2 * math.pi * i / vertices),
+        ]
+        for i in range(vertices)
+    ]
+    ring.append(list(ring[0]))
+
+    corners = {
+        "ll": {"x": x0, "y": y0},
+        "lr": {"x": x0 + TILE_SIZE, "y": y0},
+        "ul": {"x": x0, "y": y0 + TILE_SIZE},
+        "ur": {"x": x0 + TILE_SIZE, "y": y0 + TILE_SIZE},
+    }
+    doc = {
+        "id": f"00000000-0000-0000-0000-{n:012}",
+        "product_type": "fractional_cover",
+        "extent": {
+            "center_dt": f"2010-01-{day:02}T01:22:40",
+            "coord": {
+                "ll": {"lat": -21.3 + y / 10, "lon": 127.1 + x / 10},
+                "ur": {"lat": -20.9 + y / 10, "lon": 128.0 + x / 10},
+            },
+        },
+        "grid_spatial": {
+            "projection": {
+                "geo_ref_points": corners,
+                "spatial_reference": "EPSG:3577",
+                "valid_data": {"type": "Polygon", "coordinates": [ring]},
+            }
+        },
+        "image": {
+            "bands": {
+                band: {"path": f"{name}_{band}.tif"}
+                for band in ("BS", "NPV", "PV", "UE")
+            }
+        },
+    }
+    return key, doc
+
+
+class InMemoryS3:
+    """
+    Stand-in for a boto3 S3 resource, keeping objects put by StacCollections in a dict
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def Object(self, bucket, key):  # pylint: disable=invalid-name
+        store = self.objects
+
+        def put(Body, ContentType=None):  # pylint: disable=invalid-name,unused-argument
+            store[(bucket, key)] = Body
+
+        return SimpleNamespace(put=put)
+
+
+# Each benchmark returns a setup function, called before each untimed run to
+# prepare its input, and the function to time.
+
+
+def bench_stac_dataset(datasets, cfg):
+    import stac
+
+    def setup():
+        # The conversion modifies the valid data coordinates in place
+        return copy.deepcopy(datasets)
+
+    def run(docs):
+        for key, doc in docs:
+            stac.stac_dataset(doc, f"{cfg['aws-domain']}/{key}", "/catalog.json")
+
+    return setup, run
+
+
+def bench_valid_coord_to_geojson(datasets):
+    import stac
+
+    def setup():
+        return [
+            copy.deepcopy(doc["grid_spatial"]["projection"]) for _, doc in datasets
+        ]
+
+    def run(projections):
+        for projection in projections:
+            stac.valid_coord_to_geojson(
+                projection["valid_data"], projection["spatial_reference"]
+            )
+
+    return setup, run
+
+
+def bench_yamls_in_inventory_list(inventory, cfg):
+    def run(items):
+        for _ in yamls_in_inventory_list(items, cfg):
+            pass
+
+    return lambda: inventory, run
+
+
+def bench_catalogs(datasets, cfg):
+    from stac_parent_update import StacCollections
+
+    keys = [key for key, _ in datasets]
+
+    def run(items):
+        collections = StacCollections(cfg, dry_run=True)
+        collections.s3_res = InMemoryS3()
+        collections.add_items(items)
+        collections.persist_all_catalogs("dea-public-data", dry_run=False)
+
+    return lambda: keys, run
+
+
+def geometry_size_report(datasets, cfg):
+    """
+    Print the total size of the STAC Items of the datasets with each geometry setting
+
+    :return: dict of the total size in bytes by setting
+    """
+    import stac
+
+    geometry_cfg = cfg.get("geometry") or {}
+    settings = [
+        ("full precision", None, None),
+        ("precision 8", 8, None),
+        ("precision 6", 6, None),
+        (
+            "configured",
+            geometry_cfg.get("precision"),
+            geometry_cfg.get("simplify-tolerance"),
+        ),
+    ]
+
+    # Convert with full precision geometries, then reduce them with each setting
+    stac_cfg = stac.CFG
+    stac.CFG = dict(cfg, geometry=None)
+    try:
+        items = [
+            stac.stac_dataset(copy.deepcopy(doc), f"{cfg['aws-domain']}/{key}", "/")
+            for key, doc in datasets
+        ]
+    finally:
+        stac.CFG = stac_cfg
+
+    sizes = {}
+    for name, precision, tolerance in settings:
+        sizes[name] = sum(
+            len(
+                json.dumps(
+                    dict(
+                        item,
+                        geometry=stac.reduce_geometry(
+                            item["geometry"], precision, tolerance
+                        ),
+                    )
+                )
+            )
+            for item in items
+        )
+        print(
+            "{0:<16} {1:>12} bytes {2:>10.0f} per item {3:>7.1%} smaller".format(
+                name,
+                sizes[name],
+                sizes[name] / len(items),
+                1 - sizes[name] / sizes["full precision"],
+            )
+        )
+    return sizes
+
+
+def measure(benchmark, count):
+    """
+    Time a benchmark, then run it again to measure its peak memory
+
+    Memory is measured separately since tracing allocations slows the code down.
+    """
+    setup, run = benchmark
+
+    data = setup()
+    start = time.perf_counter()
+    run(data)
+    duration = time.perf_counter() - start
+
+    data = setup()
+    tracemalloc.start()
+    try:
+        run(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "count": count,
+        "seconds": duration,
+        "per_second": count / duration if duration else float("inf"),
+        "peak_mb": peak / 1e6,
+    }
+
+
+def run_benchmarks(cfg, sizes, seed=0):
+    """
+    Run every benchmark at each of the given sizes and return the results keyed by 'name/size'
+    """
+    prefix = cfg["products"][0]["prefix"]
+    results = {}
+    for size in sizes:
+        count = SIZES[size]
+        rng = random.Random(seed)
+        datasets = [synthetic_dataset(prefix, n, rng) for n in range(count)]
+        inventory = synthetic_inventory(
+            (p["prefix"] for p in cfg["products"]),
+            count * INVENTORY_ROWS_PER_DATASET,
+            seed,
+        )
+
+        benchmarks = [
+            ("stac_dataset", bench_stac_dataset(datasets, cfg), count),
+            (
+                "valid_coord_to_geojson",
+                bench_valid_coord_to_geojson(datasets),
+                count,
+            ),
+            (
+                "yamls_in_inventory_list",
+                bench_yamls_in_inventory_list(inventory, cfg),
+                len(inventory),
+            ),
+            ("catalogs", bench_catalogs(datasets, cfg), count),
+        ]
+        for name, benchmark, items in benchmarks:
+            result = measure(benchmark, items)
+            results[f"{name}/{size}"] = result
+            print(
+                "{0:<32} {1:>10} items {2:>12.0f} /s {3:>9.2f} MB peak".format(
+                    f"{name}/{size}", items, result["per_second"], result["peak_mb"]
+                )
+            )
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Print the change in throughput and peak memory from the baseline
+
+    :return: the names of benchmarks that are slower or use more memory than the tolerance allows
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        speed = result["per_second"] / before["per_second"]
+        memory = result["peak_mb"] / before["peak_mb"] if before["peak_mb"] else 1.0
+        regressed = speed < 1 - tolerance or memory > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print(
+            "{0:<32} throughput {1:>6.2f}x  peak memory {2:>6.2f}x{3}".format(
+                name, speed, memory, "  REGRESSION" if regressed else ""
+            )
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="stac_config.yaml", help="The config file")
+    parser.add_argument(
+        "--sizes",
+        default="small,medium",
+        help="Comma separated sizes to run, from: " + ", ".join(SIZES),
+    )
+    parser.add_argument(
+        "--baseline", default=DEFAULT_BASELINE, help="Baseline results file"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Allowed fractional loss of throughput or growth of peak memory",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--geometry-report",
+        action="store_true",
+        help="Report the STAC Item size reduction of the geometry settings instead",
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=SIZES["small"],
+        help="Number of synthetic datasets in the geometry report",
+    )
+    parser.add_argument(
+        "--documents",
+        nargs="+",
+        help="ODC metadata documents to use in the geometry report instead of "
+        "synthetic datasets",
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as cfg_file:
+        cfg = YAML.load(cfg_file)
+
+    if args.geometry_report:
+        if args.documents:
+            datasets = []
+            for path in args.documents:
+                with open(path) as fin:
+                    datasets.append((os.path.basename(path), YAML.load(fin)))
+        else:
+            rng = random.Random(0)
+            prefix = cfg["products"][0]["prefix"]
+            datasets = [synthetic_dataset(prefix, n, rng) for n in range(args.sample)]
+        geometry_size_report(datasets, cfg)
+        return
+
+    # The catalog code logs every catalog it writes
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sizes = args.sizes.split(",")
+    unknown = set(sizes) - set(SIZES)
+    if unknown:
+        parser.error("Unknown sizes: " + ", ".join(sorted(unknown)))
+
+    results = run_benchmarks(cfg, sizes)
+
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fout:
+            json.dump(results, fout, indent=2)
+        print("Saved baseline to {0}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        print("-" * 20)
+        if compare_with_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
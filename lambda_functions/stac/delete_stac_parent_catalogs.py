@@ -1,15 +1,33 @@
 """
 Delete parent catalog files in s3 bucket that correspond to given product prefix.
-The list of files with names 'catalog.json' is obtained from s3 inventory lists.
+The list of files with names 'catalog.json' is obtained from s3 inventory lists, or,
+for narrow prefixes, by listing the objects under the prefix.
+
+Files are deleted in batches of 1000 keys, several batches at a time.
 """
 
+import logging
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import boto3
 import click
-from odc.aws import make_s3_client
-from odc.aws.inventory import list_inventory
-from pathlib import PurePosixPath
+
+from inventory_table import inventory_table_keys
+from notify_to_stac_queue import chunks
+from stac_utils import list_inventory_keys
+
+FORMAT = "%(asctime)-15s %(message)s"
+logging.basicConfig(format=FORMAT)
+LOG = logging.getLogger()
+LOG.setLevel(logging.INFO)
 
 AWS_DELETE_LIMIT = 1000
+DELETE_RETRIES = 3
+# Prefixes with at least this many path segments are listed rather than found in the inventory
+LISTING_MIN_DEPTH = 3
+LISTING_SPLIT_LEVELS = 2
 
 
 @click.command(help=__doc__)
@@ -20,27 +38,191 @@ AWS_DELETE_LIMIT = 1000
 )
 @click.option("--bucket", "-b", default="dea-public-data", help="AWS bucket")
 @click.option("--inventory-bucket", default="dea-public-data-inventory")
-def delete_stac_catalog_parents(aws_product_prefix, bucket, inventory_bucket):
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of processes reading the inventory list (default: number of CPUs)",
+)
+@click.option(
+    "--inventory-table",
+    type=click.Path(dir_okay=False),
+    help="Local Parquet file caching the filtered inventory list as a columnar table. "
+    "It is read instead of the inventory list if it exists, otherwise it is written",
+)
+@click.option(
+    "--mode",
+    type=click.Choice(["auto", "inventory", "listing"]),
+    default="auto",
+    show_default=True,
+    help="Find catalogs in the inventory list, or by listing the objects under the prefix. "
+    f"'auto' lists prefixes of {LISTING_MIN_DEPTH} or more path segments",
+)
+@click.option(
+    "--delete-threads",
+    type=int,
+    default=8,
+    show_default=True,
+    help="Number of delete requests to run at a time",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    flag_value=True,
+    help="Print the files to delete and count them, without deleting anything",
+)
+def delete_stac_catalog_parents(
+    aws_product_prefix,
+    bucket,
+    inventory_bucket,
+    workers,
+    inventory_table,
+    mode,
+    delete_threads,
+    dry_run,
+):
     s3_client = boto3.client("s3")
-    delete_files = dict(Objects=[])
-    for item in list_inventory(
-        f"s3://{inventory_bucket}/{bucket}/{bucket}-csv-inventory/", s3=make_s3_client()
-    ):
-        s3_key_file = PurePosixPath(item.Key)
-
-        # add to delete list
-        if s3_key_file.name == "catalog.json" and aws_product_prefix in item.Key:
-            print(item.Key)
-            delete_files["Objects"].append(dict(Key=item.Key))
-
-        # flush out the delete list if aws limit reached
-        if len(delete_files["Objects"]) >= AWS_DELETE_LIMIT:
-            s3_client.delete_objects(Bucket=bucket, Delete=delete_files)
-            delete_files = dict(Objects=[])
-
-    # flush out the remaining
-    if len(delete_files["Objects"]) >= AWS_DELETE_LIMIT:
-        s3_client.delete_objects(Bucket=bucket, Delete=delete_files)
+    manifest = f"s3://{inventory_bucket}/{bucket}/{bucket}-csv-inventory/"
+    if mode == "auto":
+        depth = len([part for part in aws_product_prefix.split("/") if part])
+        mode = "listing" if depth >= LISTING_MIN_DEPTH else "inventory"
+        LOG.info("Finding catalogs by %s", mode)
+
+    if mode == "listing":
+        keys = list_catalogs(s3_client, bucket, aws_product_prefix, delete_threads)
+    elif inventory_table:
+        keys = inventory_table_keys(
+            manifest,
+            inventory_table,
+            prefixes=[aws_product_prefix],
+            suffix="/catalog.json",
+            workers=workers,
+        )
+    else:
+        keys = list_inventory_keys(
+            manifest,
+            prefixes=[aws_product_prefix],
+            suffix="/catalog.json",
+            workers=workers,
+        )
+
+    if dry_run:
+        count = 0
+        for key in keys:
+            print(key)
+            count += 1
+        click.echo(
+            f"Would delete {count} files in {math.ceil(count / AWS_DELETE_LIMIT)} requests"
+        )
+        return
+
+    deleted, failed = delete_keys(s3_client, bucket, keys, delete_threads)
+    click.echo(f"Deleted {deleted} files, failed to delete {failed} files")
+
+
+def list_catalogs(s3_client, bucket, prefix, threads=8):
+    """
+    Return generator of the catalog.json keys under a prefix, listing sub-prefixes in parallel
+
+    The prefix is split into sub-prefixes, up to LISTING_SPLIT_LEVELS levels deep, until there
+    are enough to keep 'threads' paginated listings busy.
+    """
+    prefixes = [prefix]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in range(LISTING_SPLIT_LEVELS):
+            if len(prefixes) >= threads:
+                break
+            sub_prefixes = []
+            for keys, common_prefixes in executor.map(
+                lambda p: list_prefix(s3_client, bucket, p, delimiter="/"), prefixes
+            ):
+                yield from keys
+                sub_prefixes += common_prefixes
+            prefixes = sub_prefixes
+
+        for keys, _ in executor.map(
+            lambda p: list_prefix(s3_client, bucket, p), prefixes
+        ):
+            yield from keys
+
+
+def list_prefix(s3_client, bucket, prefix, delimiter=""):
+    """
+    List the objects under a prefix
+
+    :return: the catalog.json keys found, and the common prefixes if a delimiter is given
+    """
+    keys, common_prefixes = [], []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+        keys += [
+            obj["Key"]
+            for obj in page.get("Contents", [])
+            if obj["Key"].endswith("/catalog.json")
+        ]
+        common_prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+    return keys, common_prefixes
+
+
+def delete_keys(s3_client, bucket, keys, threads=8, retries=DELETE_RETRIES):
+    """
+    Delete the given keys in batches, running up to 'threads' delete requests at a time
+
+    Keys reported as errors by S3 are retried up to 'retries' times.
+
+    :return: the number of keys deleted and the number that could not be deleted
+    """
+    deleted, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = set()
+        for batch in chunks(keys, AWS_DELETE_LIMIT):
+            # Don't read ahead of the delete requests by more than a batch per thread
+            if len(pending) >= 2 * threads:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_deleted, batch_failed = future.result()
+                    deleted += batch_deleted
+                    failed += batch_failed
+            pending.add(
+                executor.submit(delete_batch, s3_client, bucket, batch, retries)
+            )
+
+        for future in pending:
+            batch_deleted, batch_failed = future.result()
+            deleted += batch_deleted
+            failed += batch_failed
+
+    return deleted, failed
+
+
+def delete_batch(s3_client, bucket, keys, retries=DELETE_RETRIES):
+    """
+    Delete up to AWS_DELETE_LIMIT keys with one request, retrying keys that S3 failed to delete
+
+    :return: the number of keys deleted and the number that could not be deleted
+    """
+    remaining = list(keys)
+    errors = []
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(0.1 * 2 ** attempt)
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in remaining], "Quiet": True},
+        )
+        errors = response.get("Errors", [])
+        remaining = [error["Key"] for error in errors]
+        if not remaining:
+            break
+
+    for error in errors:
+        LOG.error(
+            "Failed to delete s3://%s/%s: %s %s",
+            bucket,
+            error["Key"],
+            error.get("Code"),
+            error.get("Message"),
+        )
+    return len(keys) - len(remaining), len(remaining)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""
+Columnar tables of S3 inventory lists.
+
+The filtered rows of an S3 inventory are loaded into an Arrow table, held in memory or
+cached in a local Parquet file, so that key prefix, suffix and date filters run as
+vectorised operations over whole columns instead of row by row.
+"""
+
+import datetime
+import json
+import logging
+import os
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from stac_utils import SNAPSHOT_FIELDS, list_inventory_rows, resolve_manifest
+
+LOG = logging.getLogger(__name__)
+
+INVENTORY_SCHEMA = pa.schema(
+    [
+        ("key", pa.string()),
+        ("size", pa.int64()),
+        ("last_modified", pa.timestamp("ms", tz="UTC")),
+        ("etag", pa.string()),
+    ]
+)
+BATCH_SIZE = 1000000
+
+
+def load_inventory_table(manifest, prefixes=None, suffix="", workers=None, cache=None):
+    """
+    Return an Arrow table of the key, size, last modified date and ETag of matching inventory rows
+
+    If 'cache' is the path of a Parquet file built by an earlier call from the same
+    manifest, with the same prefixes and suffix, it is read instead of the inventory.
+    Otherwise the inventory is read and, if 'cache' is given, saved there. A manifest
+    folder is resolved to its latest manifest first, so a newer inventory replaces the
+    cached table.
+    """
+    manifest = resolve_manifest(manifest)
+    filters = {
+        "prefixes": None if prefixes is None else sorted(prefixes),
+        "suffix": suffix if isinstance(suffix, str) else sorted(suffix),
+    }
+
+    if cache and os.path.exists(cache):
+        table = pq.read_table(cache)
+        metadata = table.schema.metadata or {}
+        if json.loads(metadata.get(b"filters", b"null")) != filters:
+            LOG.info("Inventory table %s was built with different filters", cache)
+        elif metadata.get(b"manifest", b"").decode("utf8") != manifest:
+            LOG.info("Inventory table %s was built from another inventory", cache)
+        else:
+            LOG.info("Read %s inventory rows from %s", table.num_rows, cache)
+            return table
+
+    rows = list_inventory_rows(
+        manifest, SNAPSHOT_FIELDS, prefixes, suffix, workers=workers
+    )
+    table = inventory_table(rows).replace_schema_metadata(
+        {"filters": json.dumps(filters), "manifest": manifest}
+    )
+
+    if cache:
+        pq.write_table(table, cache, compression="zstd")
+        LOG.info("Wrote %s inventory rows to %s", table.num_rows, cache)
+    return table
+
+
+def inventory_table(rows):
+    """
+    Return an Arrow table from an iterable of (key, size, last modified date, ETag) string tuples
+    """
+    rows = iter(rows)
+    batches = []
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        keys, sizes, dates, etags = zip(*batch)
+        batches.append(
+            pa.record_batch(
+                [
+                    pa.array(keys, pa.string()),
+                    _non_empty(sizes).cast(pa.int64()),
+                    _non_empty(dates).cast(pa.timestamp("ms", tz="UTC")),
+                    _non_empty(etags),
+                ],
+                schema=INVENTORY_SCHEMA,
+            )
+        )
+    return pa.Table.from_batches(batches, schema=INVENTORY_SCHEMA)
+
+
+def _non_empty(values):
+    """
+    Return a string array with empty strings, from fields missing in the inventory, as nulls
+    """
+    array = pa.array(values, pa.string())
+    return pc.if_else(pc.equal(array, ""), pa.scalar(None, pa.string()), array)
+
+
+def filter_inventory_table(table, prefixes=None, suffix=None, from_date=None):
+    """
+    Return the rows of an inventory table matching any of the prefixes, the suffix and modified after a date
+
+    A date without a time zone is taken to be in UTC.
+    """
+    keys = table.column("key")
+    masks = []
+
+    if suffix:
+        suffixes = [suffix] if isinstance(suffix, str) else suffix
+        masks.append(_match_any(keys, pc.ends_with, suffixes))
+
+    if prefixes is not None:
+        masks.append(_match_any(keys, pc.starts_with, prefixes))
+
+    if from_date:
+        if from_date.tzinfo is None:
+            from_date = from_date.replace(tzinfo=datetime.timezone.utc)
+        masks.append(
+            pc.greater(
+                table.column("last_modified"),
+                pa.scalar(from_date, pa.timestamp("ms", tz="UTC")),
+            )
+        )
+
+    if not masks:
+        return table
+    mask = masks[0]
+    for other in masks[1:]:
+        mask = pc.and_(mask, other)
+    return table.filter(mask)
+
+
+def _match_any(keys, match, patterns):
+    """
+    Return a mask of the keys matching any of the patterns with the given string compute function
+    """
+    mask = pa.repeat(False, len(keys))
+    for pattern in patterns:
+        mask = pc.or_(mask, match(keys, pattern=pattern))
+    return mask
+
+
+def inventory_table_keys(
+    manifest, cache, prefixes=None, suffix="", from_date=None, workers=None
+):
+    """
+    Return a list of the keys in an inventory that match the filters, using a cached inventory table
+
+    The table is cached with the given prefixes and suffix, so the date filter can change between runs.
+    """
+    table = load_inventory_table(manifest, prefixes, suffix, workers, cache)
+    return filter_inventory_table(table, from_date=from_date).column("key").to_pylist()
+
+
+def yamls_in_inventory_table(manifest, cfg, cache, from_date=None, workers=None):
+    """
+    Return a list of yaml files of configured products in an S3 inventory, using a cached inventory table
+    """
+    return inventory_table_keys(
+        manifest,
+        cache,
+        prefixes=[p["prefix"] for p in cfg["products"]],
+        suffix=".yaml",
+        from_date=from_date,
+        workers=workers,
+    )
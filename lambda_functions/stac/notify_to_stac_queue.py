@@ -3,7 +3,9 @@ Send notification messages to 'static_stac_queue' for each yaml file uploaded to
 corresponding to datasets that belong to products specified in GLOBAL_CONFIG
 
 Incremental updates can be done by using the 'from-date' option to limit the
-selected dataset yaml files modified by a date later than the specified date.
+selected dataset yaml files modified by a date later than the specified date, or
+by using the 'snapshot' option to select only the yaml files added or modified since
+a local snapshot of a previous inventory list was saved.
 
 The s3 yaml file list is obtained from the specified s3 inventory list unless a file
 list is provided in the command line.
@@ -14,13 +16,16 @@ import logging
 
 import boto3
 import click
-import dateutil.parser
 import ruamel.yaml
 from itertools import islice
 
-from odc.aws import make_s3_client
-from odc.aws.inventory import list_inventory
-from stac_utils import yamls_in_inventory_list, parse_date
+from inventory_table import yamls_in_inventory_table
+from stac_utils import (
+    inventory_changes,
+    parse_date,
+    write_snapshot,
+    yamls_in_inventory,
+)
 
 FORMAT = "%(asctime)-15s %(message)s"
 logging.basicConfig(format=FORMAT)
@@ -53,45 +58,91 @@ YAML = ruamel.yaml.YAML(typ="safe")
 @click.option(
     "--from-date", callback=parse_date, help="The date from which to update the catalog"
 )
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of processes reading the inventory list (default: number of CPUs)",
+)
+@click.option(
+    "--snapshot",
+    type=click.Path(dir_okay=False),
+    help="Local inventory snapshot file. Only yaml files added or modified since the "
+    "snapshot was saved are sent, and the snapshot is then updated",
+)
+@click.option(
+    "--inventory-table",
+    type=click.Path(dir_okay=False),
+    help="Local Parquet file caching the filtered inventory list as a columnar table. "
+    "It is read instead of the inventory list if it exists, otherwise it is written",
+)
 @click.argument("s3-keys", nargs=-1, type=str)
-def cli(config, inventory_manifest, queue_url, bucket, from_date, s3_keys=None):
+def cli(
+    config,
+    inventory_manifest,
+    queue_url,
+    bucket,
+    from_date,
+    workers,
+    snapshot,
+    inventory_table,
+    s3_keys=None,
+):
     """
     Send messages (yaml s3 keys) to stac_queue
     """
 
+    if snapshot and from_date:
+        raise click.UsageError("--snapshot and --from-date can't be used together")
+
     with open(config, "r") as cfg_file:
         cfg = YAML.load(cfg_file)
 
-    if not s3_keys:
-        s3_client = make_s3_client()
-        inventory_items = list_inventory(inventory_manifest, s3=s3_client)
-
-        if from_date:
-            inventory_items = (
-                item
-                for item in inventory_items
-                if dateutil.parser.parse(item.LastModifiedDate) > from_date
-            )
-
-        s3_keys = yamls_in_inventory_list(inventory_items, cfg)
-    else:
+    new_snapshot = None
+    if s3_keys:
         # Filter out non yaml keys
         s3_keys = [item for item in s3_keys if item.endswith(".yaml")]
+    elif snapshot:
+        diff, new_snapshot = inventory_changes(
+            inventory_manifest, cfg, snapshot, workers
+        )
+        LOG.info(
+            "Since the snapshot %s yaml files were added, %s modified and %s removed",
+            len(diff.added),
+            len(diff.modified),
+            len(diff.removed),
+        )
+        s3_keys = diff.added + diff.modified
+    elif inventory_table:
+        s3_keys = yamls_in_inventory_table(
+            inventory_manifest, cfg, inventory_table, from_date, workers
+        )
+    else:
+        s3_keys = yamls_in_inventory(inventory_manifest, cfg, from_date, workers)
 
-    LOG.info("Sending %s update messages", len(s3_keys))
+    failed = []
+    sent = messages_to_sqs(s3_keys, bucket, queue_url, failed)
 
-    messages_to_sqs(s3_keys, bucket, queue_url)
+    LOG.info("Sent %s update messages", sent)
 
-    LOG.info("Done")
+    if new_snapshot is not None:
+        # Leave out the keys that failed, so the next run sends them again
+        for key in failed:
+            new_snapshot.pop(key, None)
+        write_snapshot(snapshot, new_snapshot)
+        LOG.info("Updated inventory snapshot %s", snapshot)
 
 
-def messages_to_sqs(s3_keys, bucket, queue_url):
+def messages_to_sqs(s3_keys, bucket, queue_url, failed=None):
     """
     Send messages to stac queue for all the s3 keys in the given list
+
+    :param failed: if given, a list the keys of messages that failed are appended to
+    :return: the number of messages sent
     """
 
     sqs = boto3.client("sqs")
 
+    sent = 0
     for batch in chunks(s3_keys, 10):
 
         batch_request = [
@@ -102,6 +153,11 @@ def messages_to_sqs(s3_keys, bucket, queue_url):
 
         if "Failed" in response:
             LOG.error("Failed messages: %s", response["Failed"])
+            if failed is not None:
+                failed.extend(batch[int(entry["Id"])] for entry in response["Failed"])
+        sent += len(response.get("Successful", []))
+
+    return sent
 
 
 def s3_key_event(bucket, s3_key):
@@ -0,0 +1,153 @@
+"""
+Find dataset yaml files in S3 whose STAC item is missing or out of date, and bring them up to date.
+
+A single scan of the S3 inventory list joins each dataset yaml file of the configured products
+with its '<stem>_STAC.json' sibling. Only the yaml files with no STAC item, or with a STAC item
+older than the yaml file, are selected. They can be listed, sent to 'static_stac_queue' like
+notify_to_stac_queue.py does, or converted to STAC locally.
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import ruamel.yaml
+
+from notify_to_stac_queue import messages_to_sqs, s3_key_event
+from stac_utils import list_inventory_rows
+
+FORMAT = "%(asctime)-15s %(message)s"
+logging.basicConfig(format=FORMAT)
+LOG = logging.getLogger()
+LOG.setLevel(logging.INFO)
+
+YAML = ruamel.yaml.YAML(typ="safe")
+STAC_SUFFIX = "_STAC.json"
+
+
+@click.command(help=__doc__)
+@click.option(
+    "--config",
+    type=click.Path(exists=True),
+    default="stac_config.yaml",
+    help="The config file",
+)
+@click.option(
+    "--inventory-manifest",
+    "-i",
+    default="s3://dea-public-data-inventory/dea-public-data/dea-public-data-csv-inventory/",
+    help="The manifest of AWS inventory list",
+)
+@click.option(
+    "--queue-url",
+    "-q",
+    default="https://sqs.ap-southeast-2.amazonaws.com/451924316694/static-stac-queue",
+    help="AWS sqs url",
+)
+@click.option("--bucket", "-b", required=True, help="AWS bucket")
+@click.option(
+    "--mode",
+    type=click.Choice(["list", "notify", "convert"]),
+    default="list",
+    help="Print the stale yaml keys, send them to the stac queue or convert them locally",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of processes reading the inventory list and converting datasets "
+    "(default: number of CPUs)",
+)
+def cli(config, inventory_manifest, queue_url, bucket, mode, workers):
+    """
+    Select the yaml keys with a missing or outdated STAC item and process them
+    """
+
+    with open(config, "r") as cfg_file:
+        cfg = YAML.load(cfg_file)
+
+    s3_keys = list(stale_stac_yamls(inventory_manifest, cfg, workers))
+    LOG.info("Found %s yaml files with a missing or outdated STAC item", len(s3_keys))
+
+    if mode == "list":
+        for key in s3_keys:
+            print(key)
+    elif mode == "notify":
+        sent = messages_to_sqs(s3_keys, bucket, queue_url)
+        LOG.info("Sent %s update messages", sent)
+    else:
+        converted = convert_locally(s3_keys, bucket, cfg, workers)
+        LOG.info("Converted %s ODC Datasets to STAC", converted)
+
+
+def stale_stac_yamls(inventory_manifest, cfg, workers=None):
+    """
+    Return generator of yaml keys of configured products with a missing or outdated STAC item
+    """
+    prefixes = [p["prefix"] for p in cfg["products"]]
+    rows = list_inventory_rows(
+        inventory_manifest,
+        ("Key", "LastModifiedDate"),
+        prefixes=prefixes,
+        suffix=(".yaml", STAC_SUFFIX),
+        workers=workers,
+    )
+    # Yaml files in the top level directory of a product could be product definitions
+    top_levels = {prefix.rstrip("/") for prefix in prefixes}
+    return (
+        key
+        for key in join_stac_items(rows)
+        if key.rsplit("/", 1)[0] not in top_levels
+    )
+
+
+def join_stac_items(rows):
+    """
+    Return generator of yaml keys whose STAC item is missing or older than the yaml file
+
+    :param rows: (key, last modified date) tuples of yaml and STAC item keys, in any order.
+        Dates are ISO 8601 strings in the same format, as in an S3 inventory list.
+    """
+    yamls = []
+    stac_dates = {}
+    for key, modified in rows:
+        if key.endswith(".yaml"):
+            yamls.append((key, modified))
+        elif key.endswith(STAC_SUFFIX):
+            stac_dates[key[: -len(STAC_SUFFIX)]] = modified
+
+    for key, modified in yamls:
+        stac_modified = stac_dates.get(key[: -len(".yaml")])
+        if stac_modified is None or stac_modified < modified:
+            yield key
+
+
+def convert_locally(s3_keys, bucket, cfg, workers=None):
+    """
+    Convert the given yaml keys to STAC items with the STAC Lambda function code
+
+    :return: the number of datasets converted
+    """
+    # Import here, since the Lambda module connects to S3 and reads its own config on import
+    import stac
+
+    messages = ({"body": s3_key_event(bucket, key)} for key in s3_keys)
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=set_stac_config, initargs=(cfg,)
+    ) as executor:
+        return sum(executor.map(stac.convert_yaml, messages, chunksize=100))
+
+
+def set_stac_config(cfg):
+    """
+    Set the config of the STAC Lambda function code in a worker process
+
+    Workers started by spawning, rather than forking, import the module afresh with its
+    bundled config.
+    """
+    import stac
+
+    stac.CFG = cfg
+
+
+if __name__ == "__main__":
+    cli()
@@ -144,6 +144,11 @@ def stac_dataset(metadata_doc, item_abs_path, parent_abs_path):
             metadata_doc["grid_spatial"]["projection"]["spatial_reference"],
         )
 
+    geometry_cfg = CFG.get("geometry") or {}
+    geodata = reduce_geometry(
+        geodata, geometry_cfg.get("precision"), geometry_cfg.get("simplify-tolerance")
+    )
+
     # Convert the date to add time zone.
     center_dt = parse(metadata_doc["extent"]["center_dt"])
     center_dt = center_dt.replace(microsecond=0)
@@ -221,6 +226,45 @@ def valid_coord_to_geojson(valid_coord, spatial_reference):
     return {"type": "Polygon", "coordinates": coords}
 
 
+def reduce_geometry(geometry, precision=None, simplify_tolerance=None):
+    """
+    Return a GeoJSON geometry simplified and with its coordinates rounded
+
+    :param precision: number of decimal places to round coordinates to, or None to keep them
+    :param simplify_tolerance: tolerance in degrees of a topology preserving
+        simplification, or None to keep every vertex
+    """
+    if simplify_tolerance:
+        # Only needed if simplification is configured
+        from shapely.geometry import mapping, shape
+
+        simplified = shape(geometry).simplify(simplify_tolerance, preserve_topology=True)
+        if not simplified.is_empty:
+            geometry = {
+                "type": geometry["type"],
+                "coordinates": _as_lists(mapping(simplified)["coordinates"]),
+            }
+
+    if precision is not None:
+        geometry = {
+            "type": geometry["type"],
+            "coordinates": _round_coordinates(geometry["coordinates"], precision),
+        }
+    return geometry
+
+
+def _as_lists(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        return list(coordinates)
+    return [_as_lists(part) for part in coordinates]
+
+
+def _round_coordinates(coordinates, precision):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(value, precision) for value in coordinates]
+    return [_round_coordinates(part, precision) for part in coordinates]
+
+
 def get_stac_item_parent(s3_key):
     """
     Parse the parent stac catalog from the given s3 key
@@ -0,0 +1,159 @@
+"""
+Compact search indexes of the STAC Items of a collection.
+
+The index is a JSON lines file of [datetime, id, bbox, href] rows, sorted by datetime
+and id. A JSON header lists the byte range, time range and bounding box of each chunk
+of rows, so a client can read the header and then range-read only the chunks that
+match its search, instead of walking the catalogs link by link.
+
+The name of the index file is derived from its contents, and the header links to it,
+so writing the header switches readers to a new index at once.
+"""
+
+import hashlib
+import json
+
+import dateutil.parser
+
+INDEX_FIELDS = ("datetime", "id", "bbox", "href")
+HEADER_KEY = "stac-index.json"
+CHUNK_ROWS = 1000
+
+
+def index_row(item, href):
+    """
+    Return the index row of a STAC Item
+    """
+    return [item["properties"].get("datetime"), item["id"], item.get("bbox"), href]
+
+
+def union_bbox(bboxes):
+    """
+    Return the bounding box of the given [west, south, east, north] boxes, or None if there are none
+    """
+    bboxes = [bbox for bbox in bboxes if bbox]
+    if not bboxes:
+        return None
+    return [
+        min(bbox[0] for bbox in bboxes),
+        min(bbox[1] for bbox in bboxes),
+        max(bbox[2] for bbox in bboxes),
+        max(bbox[3] for bbox in bboxes),
+    ]
+
+
+def rows_extent(rows):
+    """
+    Return the spatial and temporal extent of index rows, or None if there are no rows
+    """
+    rows = list(rows)
+    if not rows:
+        return None
+    datetimes = [row[0] for row in rows if row[0]]
+    temporal = [None, None]
+    if datetimes:
+        temporal = [
+            min(datetimes, key=dateutil.parser.parse),
+            max(datetimes, key=dateutil.parser.parse),
+        ]
+    return {"spatial": union_bbox(row[2] for row in rows), "temporal": temporal}
+
+
+def merge_extents(extent, other):
+    """
+    Return the union of two collection extents
+
+    A missing bound in either temporal extent is open ended, so the union is too.
+    """
+    (start, end), (other_start, other_end) = extent["temporal"], other["temporal"]
+    if start and other_start:
+        start = min(start, other_start, key=dateutil.parser.parse)
+    else:
+        start = None
+    if end and other_end:
+        end = max(end, other_end, key=dateutil.parser.parse)
+    else:
+        end = None
+    return {
+        "spatial": union_bbox([extent["spatial"], other["spatial"]]),
+        "temporal": [start, end],
+    }
+
+
+def build_index(rows, index_href=None, chunk_rows=None):
+    """
+    Return the header and the body of an index of the given rows
+    """
+    chunk_rows = chunk_rows or CHUNK_ROWS
+    rows = sorted(rows, key=lambda row: (row[0] or "", row[1]))
+
+    chunks = []
+    data = []
+    offset = 0
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        lines = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in chunk)
+        encoded = lines.encode("utf8")
+        chunks.append(
+            {
+                "offset": offset,
+                "length": len(encoded),
+                "count": len(chunk),
+                "start": chunk[0][0],
+                "end": chunk[-1][0],
+                "bbox": union_bbox(row[2] for row in chunk),
+            }
+        )
+        data.append(encoded)
+        offset += len(encoded)
+
+    header = {
+        "fields": list(INDEX_FIELDS),
+        "index": index_href,
+        "count": len(rows),
+        "chunks": chunks,
+    }
+    return header, b"".join(data)
+
+
+def index_name(body):
+    """
+    Return the file name of an index body, which changes with its contents
+    """
+    return f"stac-index-{hashlib.sha256(body).hexdigest()[:16]}.jsonl"
+
+
+def read_index(body):
+    """
+    Return the rows of an index body, or of a range of it holding whole chunks
+    """
+    return [json.loads(line) for line in body.decode("utf8").splitlines() if line]
+
+
+def merge_rows(old_rows, new_rows):
+    """
+    Return the rows of an existing index updated with new rows, matched by href
+    """
+    rows = {row[3]: row for row in old_rows}
+    rows.update((row[3], row) for row in new_rows)
+    return list(rows.values())
+
+
+def matching_chunks(header, bbox=None, start=None, end=None):
+    """
+    Return the chunks of an index that may hold items in the bounding box and time range
+
+    Times are ISO 8601 strings in the same format as the item datetimes.
+    """
+    matches = []
+    for chunk in header["chunks"]:
+        if start and chunk["end"] and chunk["end"] < start:
+            continue
+        if end and chunk["start"] and chunk["start"] > end:
+            continue
+        if bbox and chunk["bbox"]:
+            west, south, east, north = chunk["bbox"]
+            if west > bbox[2] or east < bbox[0] or south > bbox[3] or north < bbox[1]:
+                continue
+        matches.append(chunk)
+    return matches
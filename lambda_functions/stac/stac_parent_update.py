@@ -3,7 +3,8 @@ Update parent catalogs based on YAML files corresponding to datasets uploaded in
 
  - File lists are obtained from S3 inventory lists.
  - Incremental updates can be done by using the '--from-date' option to limit the selected dataset yaml files
-   modified by a date later than the specified date.
+   modified by a date later than the specified date, or the '--snapshot' option to select only the yaml files
+   added or modified since a local snapshot of a previous inventory list was saved.
  - Updated catalog files are uploaded to the specified bucket.
 
 The S3 YAML file list is obtained from S3 inventory list unless a file list is provided in the command line.
@@ -12,23 +13,41 @@ The S3 YAML file list is obtained from S3 inventory list unless a file list is p
 import json
 import logging
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import PurePosixPath
 
 import boto3
 import click
-import dateutil.parser
 import ruamel.yaml
 from parse import parse as pparse
 
-from odc.aws import make_s3_client
-from odc.aws.inventory import list_inventory
-from stac_utils import yamls_in_inventory_list, parse_date
+from inventory_table import yamls_in_inventory_table
+from stac_index import (
+    HEADER_KEY,
+    build_index,
+    index_name,
+    index_row,
+    merge_extents,
+    merge_rows,
+    read_index,
+    rows_extent,
+)
+from stac_utils import (
+    inventory_changes,
+    parse_date,
+    write_snapshot,
+    yamls_in_inventory,
+)
 
 FORMAT = "%(asctime)-15s %(message)s"
 logging.basicConfig(format=FORMAT)
 LOG = logging.getLogger()
 LOG.setLevel(logging.INFO)
 YAML = ruamel.yaml.YAML(typ="safe")
+# Number of STAC Items read from S3 at once
+ITEM_READ_THREADS = 16
+# Marks collection catalogs whose extent was computed from their items
+COMPUTED_EXTENT = "dea:computed_extent"
 
 
 @click.command(help=__doc__)
@@ -52,6 +71,38 @@ YAML = ruamel.yaml.YAML(typ="safe")
 @click.option(
     "--dry-run", is_flag=True, flag_value=True, help="Don't persist anything to S3"
 )
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of processes reading the inventory list (default: number of CPUs)",
+)
+@click.option(
+    "--snapshot",
+    type=click.Path(dir_okay=False),
+    help="Local inventory snapshot file. Only yaml files added or modified since the "
+    "snapshot was saved are used, and the snapshot is then updated",
+)
+@click.option(
+    "--inventory-table",
+    type=click.Path(dir_okay=False),
+    help="Local Parquet file caching the filtered inventory list as a columnar table. "
+    "It is read instead of the inventory list if it exists, otherwise it is written",
+)
+@click.option(
+    "--search-index",
+    is_flag=True,
+    help="Also write a search index of the items of each collection, merged with "
+    "the existing index. Only STAC Items missing from the index, or added or "
+    "modified in incremental updates, are read to build it",
+)
+@click.option(
+    "--computed-extents",
+    is_flag=True,
+    help="Compute the extents of collections from the bbox and datetime of their "
+    "STAC Items, instead of using the configured extents. In incremental updates "
+    "they are merged with the existing computed collection extents, so run a full "
+    "update with this option first",
+)
 @click.argument("s3-keys", nargs=-1, type=str)
 def cli(
     config,
@@ -61,17 +112,36 @@ def cli(
     contents_file,
     s3_keys=None,
     dry_run=False,
+    workers=None,
+    snapshot=None,
+    inventory_table=None,
+    search_index=False,
+    computed_extents=False,
 ):
     """
     Update parent catalogs of datasets based on S3 keys ending in .yaml
     """
 
+    if snapshot and from_date:
+        raise click.UsageError("--snapshot and --from-date can't be used together")
+
     with open(config, "r") as cfg_file:
         cfg = YAML.load(cfg_file)
 
     # Call a non-click function for testability
     update_parent_catalogs(
-        bucket, cfg, from_date, inventory_manifest, contents_file, s3_keys, dry_run
+        bucket,
+        cfg,
+        from_date,
+        inventory_manifest,
+        contents_file,
+        s3_keys,
+        dry_run,
+        workers,
+        snapshot,
+        inventory_table,
+        search_index,
+        computed_extents,
     )
 
 
@@ -83,37 +153,83 @@ def update_parent_catalogs(
     contents_file,
     s3_keys=None,
     dry_run=False,
+    workers=None,
+    snapshot=None,
+    inventory_table=None,
+    search_index=False,
+    computed_extents=False,
 ):
+    # Only a full update, from the whole inventory list, sees every item
+    incremental = bool(contents_file or s3_keys or from_date or snapshot)
+    new_snapshot = None
     if contents_file is not None:
         with open(contents_file) as fin:
             s3_keys = (line.strip() for line in fin.readlines())
 
-    elif not s3_keys:
-        s3_client = make_s3_client()
-        inventory_items = list_inventory(inventory_manifest, s3=s3_client)
-        if from_date:
-            inventory_items = (
-                item
-                for item in inventory_items
-                if dateutil.parser.parse(item.LastModifiedDate) > from_date
-            )
-        s3_keys = yamls_in_inventory_list(inventory_items, cfg)
+    elif snapshot and not s3_keys:
+        diff, new_snapshot = inventory_changes(
+            inventory_manifest, cfg, snapshot, workers
+        )
+        LOG.info(
+            "Since the snapshot %s yaml files were added, %s modified and %s removed",
+            len(diff.added),
+            len(diff.modified),
+            len(diff.removed),
+        )
+        for key in diff.removed:
+            LOG.info("Removed since the snapshot: %s", key)
+        s3_keys = diff.added + diff.modified
+
+    elif inventory_table and not s3_keys:
+        s3_keys = yamls_in_inventory_table(
+            inventory_manifest, cfg, inventory_table, from_date, workers
+        )
 
-    cu = StacCollections(cfg, dry_run)
+    elif not s3_keys:
+        s3_keys = yamls_in_inventory(inventory_manifest, cfg, from_date, workers)
+
+    cu = StacCollections(
+        cfg,
+        dry_run,
+        search_index,
+        computed_extents,
+        incremental=incremental,
+    )
     cu.add_items(s3_keys)
     cu.persist_all_catalogs(bucket, dry_run=dry_run)
 
+    if new_snapshot is not None and not dry_run:
+        write_snapshot(snapshot, new_snapshot)
+        LOG.info("Updated inventory snapshot %s", snapshot)
+
 
 class StacCollections:
     """
     Collate all the new links to be added and then update S3
     """
 
-    def __init__(self, config, dry_run=False):
+    def __init__(
+        self,
+        config,
+        dry_run=False,
+        search_index=False,
+        computed_extents=False,
+        incremental=False,
+    ):
         self.config = config
         self.items_catalogs = {}
         self.mid_level_catalogs = {}
         self.collection_catalogs = {}
+        # STAC Item keys of each collection, kept only for the search indexes and
+        # computed extents, the index rows of the items once they are found, and the
+        # existing search indexes once they are read
+        self.search_index = search_index
+        self.computed_extents = computed_extents
+        # Whether the items are only those added or modified since the last update
+        self.incremental = incremental
+        self.collection_items = {}
+        self.collection_rows = {}
+        self.search_indexes = {}
 
         if dry_run:
             self.s3_res = None
@@ -145,6 +261,7 @@ class StacCollections:
             collection_prefix = str(PurePosixPath(prefixes[0]).parent)
 
             s3_key = PurePosixPath(item)
+            stac_key = f"{s3_key.parent}/{s3_key.stem}_STAC.json"
 
             # Add to the top mid level catalogs which have parent pointing to collection catalog
             if len(prefixes) > 1:
@@ -165,7 +282,7 @@ class StacCollections:
                 self.items_catalogs,
                 prefixes[-1],
                 parent_catalog_name,
-                f"{s3_key.parent}/{s3_key.stem}_STAC.json",
+                stac_key,
             )
 
             # Add to in between top level and item level catalogs
@@ -187,12 +304,17 @@ class StacCollections:
                     f"{prefixes[0]}/catalog.json"
                 }
 
+            if self.search_index or self.computed_extents:
+                self.collection_items.setdefault(collection_prefix, set()).add(stac_key)
+
     def persist_all_catalogs(self, bucket, dry_run=False):
 
         # Update catalog files in s3 bucket now
         self.persist_collection_catalogs(bucket, dry_run)
         self.persist_mid_level_catalogs(bucket, dry_run)
         self.persist_item_catalogs(bucket, dry_run)
+        if self.search_index:
+            self.persist_search_indexes(bucket, dry_run)
 
     @staticmethod
     def get_prefixes(templates, item):
@@ -310,6 +432,131 @@ class StacCollections:
             ]
         )
 
+    def read_items(self, bucket, keys):
+        """
+        Return a dict of the STAC Items at the given keys, read concurrently
+
+        Items missing from the bucket are logged and left out.
+        """
+        client = self.s3_res.meta.client
+
+        def read_item(key):
+            try:
+                body = client.get_object(Bucket=bucket, Key=key)["Body"]
+            except client.exceptions.NoSuchKey:
+                LOG.warning("STAC Item not found: s3://%s/%s", bucket, key)
+                return key, None
+            return key, json.load(body)
+
+        with ThreadPoolExecutor(max_workers=ITEM_READ_THREADS) as executor:
+            return {
+                key: item
+                for key, item in executor.map(read_item, sorted(keys))
+                if item is not None
+            }
+
+    def read_collection_rows(self, bucket, collection_prefix):
+        """
+        Return the index rows of the items added to a collection, finding them once
+
+        A full update takes the rows of the items already in the existing search index
+        from it, and only reads the other items. An incremental update reads all of its
+        items, since they were added or modified since the last update.
+        """
+        if collection_prefix not in self.collection_rows:
+            domain = self.config["aws-domain"]
+            keys = self.collection_items[collection_prefix]
+            rows = []
+            if not self.incremental:
+                indexed = {
+                    row[3]: row
+                    for row in self.read_search_index(bucket, collection_prefix)[0]
+                }
+                rows = [
+                    indexed[f"{domain}/{key}"]
+                    for key in keys
+                    if f"{domain}/{key}" in indexed
+                ]
+                keys = [key for key in keys if f"{domain}/{key}" not in indexed]
+
+            items = self.read_items(bucket, keys)
+            rows.extend(index_row(item, f"{domain}/{key}") for key, item in items.items())
+            self.collection_rows[collection_prefix] = rows
+        return self.collection_rows[collection_prefix]
+
+    def read_object(self, bucket, key):
+        """
+        Return the contents of an S3 object, or None if it doesn't exist
+        """
+        client = self.s3_res.meta.client
+        try:
+            return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        except client.exceptions.NoSuchKey:
+            return None
+
+    def read_search_index(self, bucket, collection_prefix):
+        """
+        Return the rows of the existing search index of a collection, and the key of
+        the index file, or None if there is no index. The index is read once.
+        """
+        if collection_prefix not in self.search_indexes:
+            self.search_indexes[collection_prefix] = self._read_search_index(
+                bucket, collection_prefix
+            )
+        return self.search_indexes[collection_prefix]
+
+    def _read_search_index(self, bucket, collection_prefix):
+        header = self.read_object(bucket, f"{collection_prefix}/{HEADER_KEY}")
+        if header is None:
+            return [], None
+        index_key = json.loads(header)["index"][len(self.config["aws-domain"]) + 1:]
+        body = self.read_object(bucket, index_key)
+        if body is None:
+            LOG.warning("Search index not found: s3://%s/%s", bucket, index_key)
+            return [], None
+        return read_index(body), index_key
+
+    def persist_search_indexes(self, bucket, dry_run):
+        """
+        Update the search index of each collection with the items added to it
+
+        See stac_index.py for the format of the index.
+        """
+
+        for collection_prefix, stac_keys in self.collection_items.items():
+            header_key = f"{collection_prefix}/{HEADER_KEY}"
+            if dry_run:
+                LOG.info("Would index %s items in s3://%s", len(stac_keys), header_key)
+                continue
+
+            existing_rows, existing_key = self.read_search_index(
+                bucket, collection_prefix
+            )
+            rows = merge_rows(
+                existing_rows, self.read_collection_rows(bucket, collection_prefix)
+            )
+
+            header, body = build_index(rows)
+            index_key = f"{collection_prefix}/{index_name(body)}"
+            header["index"] = f'{self.config["aws-domain"]}/{index_key}'
+            info = self.search_product_in_config(collection_prefix)
+            header["collection"] = info["name"]
+
+            # The index is written under a new name, and the header linking to it is
+            # then the only file replaced, so readers see either the old or new index
+            if index_key != existing_key:
+                self.s3_res.Object(bucket, index_key).put(
+                    Body=body, ContentType="application/x-ndjson"
+                )
+            self.s3_res.Object(bucket, header_key).put(
+                Body=json.dumps(header), ContentType="application/json"
+            )
+            # Readers of the old header fail to read its index, rather than read the
+            # wrong rows, and can read the header again
+            if existing_key is not None and existing_key != index_key:
+                self.s3_res.Object(bucket, existing_key).delete()
+            LOG.info("Wrote search index of %s items s3://%s", len(rows), index_key)
+
     def search_product_in_config(self, prefix):
         """
         Search the product list in the config and return the product dict that matches the given prefix.
@@ -321,6 +568,31 @@ class StacCollections:
                     return product_dict
         return None
 
+    def collection_extent(self, bucket, collection_prefix):
+        """
+        Return the extent of the items added to a collection, merged with its existing
+        extent in incremental updates, or None if none of the items could be found
+
+        Only an existing extent computed from items can be merged with, since configured
+        extents are broader than the items.
+        """
+        extent = rows_extent(self.read_collection_rows(bucket, collection_prefix))
+        if extent is None or not self.incremental:
+            return extent
+
+        catalog_key = f"{collection_prefix}/catalog.json"
+        existing = self.read_object(bucket, catalog_key)
+        if existing is None:
+            # A new collection
+            return extent
+        existing = json.loads(existing)
+        if not existing.get(COMPUTED_EXTENT):
+            raise ValueError(
+                f"The extent of s3://{bucket}/{catalog_key} was not computed from its "
+                "items, run a full update with --computed-extents first"
+            )
+        return merge_extents(extent, existing["extent"])
+
     def persist_collection_catalogs(self, bucket, dry_run):
         """
         Update all the parent catalogs one level above x dir in s3. These are STAC Collections.
@@ -329,6 +601,14 @@ class StacCollections:
         for more information on Collections.
         """
 
+        # Compute the extents first, so no catalog is written if one can't be merged
+        computed_extents = {}
+        if self.computed_extents and not dry_run:
+            for collection_prefix in self.collection_catalogs:
+                computed_extents[collection_prefix] = self.collection_extent(
+                    bucket, collection_prefix
+                )
+
         for collection_prefix in self.collection_catalogs:
             collection_catalog_key = f"{collection_prefix}/catalog.json"
             info = self.search_product_in_config(collection_prefix)
@@ -343,6 +623,10 @@ class StacCollections:
             temporal_extent = (
                 extent.get("temporal", temporal_extent) if extent else temporal_extent
             )
+            computed = computed_extents.get(collection_prefix)
+            if computed is not None:
+                spatial_extent = computed["spatial"]
+                temporal_extent = computed["temporal"]
 
             # create the collection catalog
             collection_catalog = OrderedDict(
@@ -363,6 +647,8 @@ class StacCollections:
                 "spatial": spatial_extent,
                 "temporal": temporal_extent,
             }
+            if computed is not None:
+                collection_catalog[COMPUTED_EXTENT] = True
 
             product_type = PurePosixPath(collection_prefix).parts[0]
             if (
@@ -1,16 +1,245 @@
+import csv
+import gzip
+import io
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import dateutil.parser
+from odc.aws import make_s3_client, s3_fetch
+from odc.aws.inventory import find_latest_manifest
+
+SNAPSHOT_FIELDS = ("Key", "Size", "LastModifiedDate", "ETag")
+
+
+class PrefixMatcher:
+    """
+    Precompiled matcher of S3 keys against a set of key prefixes
+
+    Prefixes are stored in a trie keyed on '/' separated path segments, so the cost of
+    matching a key depends on the depth of the configured prefixes rather than on how
+    many of them there are. Matching is equivalent to 'key.startswith(prefix)' for any
+    of the prefixes, including prefixes that end part way through a path segment.
+    """
+
+    def __init__(self, prefixes):
+        # Each trie node is a list of [children by segment, tuple of trailing segments]
+        self._root = [{}, ()]
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        """
+        Add a prefix to the matcher
+        """
+
+        *segments, tail = prefix.split("/")
+        node = self._root
+        for segment in segments:
+            node = node[0].setdefault(segment, [{}, ()])
+        if tail not in node[1]:
+            node[1] += (tail,)
+
+    def __call__(self, key):
+        """
+        Return whether the given key starts with any of the prefixes
+        """
+
+        node = self._root
+        for segment in key.split("/"):
+            children, tails = node
+            if tails and segment.startswith(tails):
+                return True
+            node = children.get(segment)
+            if node is None:
+                return False
+        return False
 
 
 def yamls_in_inventory_list(keys, cfg):
     """
     Return generator of yaml files in s3 of products that belong to 'aws-products' in GLOBAL_CONFIG
     """
-    prefixes = set(p["prefix"] for p in cfg["products"])
+    matches_prefix = PrefixMatcher(p["prefix"] for p in cfg["products"])
     for item in keys:
-        if item.key.endswith(".yaml") and any(
-            item.Key.startswith(prefix) for prefix in prefixes
-        ):
-            yield item.Key
+        key = item.Key
+        if key.endswith(".yaml") and matches_prefix(key):
+            yield key
+
+
+def yamls_in_inventory(manifest, cfg, from_date=None, workers=None):
+    """
+    Return generator of yaml files of configured products listed in the given S3 inventory
+    """
+    return list_inventory_keys(
+        manifest,
+        prefixes=[p["prefix"] for p in cfg["products"]],
+        suffix=".yaml",
+        from_date=from_date,
+        workers=workers,
+    )
+
+
+def resolve_manifest(manifest, s3=None):
+    """
+    Return the url of an S3 inventory manifest, or of the latest manifest if it is a folder
+    """
+    if manifest.endswith("/"):
+        return find_latest_manifest(manifest, s3 or make_s3_client())
+    return manifest
+
+
+def inventory_shards(manifest, s3=None):
+    """
+    Return the schema and the S3 urls of the CSV files listed in an S3 inventory manifest
+
+    If the manifest is a folder, the latest manifest in it is used.
+    """
+    s3 = s3 or make_s3_client()
+    manifest = resolve_manifest(manifest, s3)
+
+    info = json.loads(s3_fetch(manifest, s3=s3))
+    if info["fileFormat"].upper() != "CSV":
+        raise ValueError("Inventory data is not in CSV format: " + manifest)
+
+    s3_prefix = "s3://" + info["destinationBucket"].split(":")[-1] + "/"
+    schema = tuple(info["fileSchema"].split(", "))
+    return schema, [s3_prefix + f["key"] for f in info["files"]]
+
+
+def list_inventory_keys(
+    manifest, prefixes=None, suffix="", from_date=None, workers=None
+):
+    """
+    Return generator of the keys in an S3 inventory that match the given filters
+
+    The CSV files of the inventory are fetched, decompressed and filtered concurrently in
+    'workers' processes (the number of CPUs by default), so only matching keys are passed
+    back to this process. Keys are yielded as each CSV file completes.
+    """
+    return list_inventory_rows(
+        manifest, None, prefixes, suffix, from_date, workers=workers
+    )
+
+
+def list_inventory_rows(
+    manifest, fields, prefixes=None, suffix="", from_date=None, workers=None
+):
+    """
+    Return generator of tuples of the given fields of S3 inventory rows that match the filters
+
+    Fields missing from the inventory schema are returned as empty strings. If 'fields'
+    is None, only the keys are returned. See 'list_inventory_keys'.
+    """
+    schema, urls = inventory_shards(manifest)
+    prefixes = None if prefixes is None else list(prefixes)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                read_inventory_shard, url, schema, prefixes, suffix, from_date, fields
+            )
+            for url in urls
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+def read_inventory_shard(
+    url, schema, prefixes=None, suffix="", from_date=None, fields=None
+):
+    """
+    Return the keys (or rows of the given fields) in a gzipped inventory CSV file that match the filters
+    """
+    key_column = schema.index("Key")
+    date_column = schema.index("LastModifiedDate") if from_date else None
+    matches_prefix = PrefixMatcher(prefixes) if prefixes is not None else None
+    if fields is not None:
+        # Point missing fields at an empty column appended to each row
+        columns = [schema.index(f) if f in schema else -1 for f in fields]
+
+    data = gzip.GzipFile(fileobj=io.BytesIO(s3_fetch(url, s3=make_s3_client())))
+    results = []
+    for row in csv.reader(io.TextIOWrapper(data, encoding="utf8")):
+        key = row[key_column]
+        if not key.endswith(suffix):
+            continue
+        if matches_prefix is not None and not matches_prefix(key):
+            continue
+        if from_date and dateutil.parser.parse(row[date_column]) <= from_date:
+            continue
+        if fields is None:
+            results.append(key)
+        else:
+            row.append("")
+            results.append(tuple(row[c] for c in columns))
+    return results
+
+
+InventoryDiff = namedtuple("InventoryDiff", ["added", "removed", "modified"])
+
+
+def inventory_snapshot(manifest, cfg, workers=None):
+    """
+    Return a snapshot of the yaml files of configured products in the given S3 inventory
+
+    The snapshot is a dict mapping each key to a tuple of its size, last modified date and ETag.
+    """
+    rows = list_inventory_rows(
+        manifest,
+        SNAPSHOT_FIELDS,
+        prefixes=[p["prefix"] for p in cfg["products"]],
+        suffix=".yaml",
+        workers=workers,
+    )
+    return {key: tuple(values) for key, *values in rows}
+
+
+def read_snapshot(path):
+    """
+    Read an inventory snapshot saved by 'write_snapshot', or return an empty one if there is none
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with gzip.open(path, "rt", encoding="utf8") as fin:
+        return {
+            key: tuple(values)
+            for key, *values in (line.rstrip("\n").split("\t") for line in fin)
+        }
+
+
+def write_snapshot(path, snapshot):
+    """
+    Save an inventory snapshot to a local gzipped, tab separated file, sorted by key
+    """
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf8") as fout:
+        for key in sorted(snapshot):
+            fout.write("\t".join((key,) + snapshot[key]) + "\n")
+    os.replace(tmp_path, path)
+
+
+def inventory_changes(manifest, cfg, snapshot_path, workers=None):
+    """
+    Compare the yaml files in an S3 inventory with a local snapshot
+
+    Return the differences and the new snapshot, which should be saved with 'write_snapshot'
+    once the changes have been processed.
+    """
+    snapshot = inventory_snapshot(manifest, cfg, workers)
+    return diff_snapshots(read_snapshot(snapshot_path), snapshot), snapshot
+
+
+def diff_snapshots(old, new):
+    """
+    Return the sorted lists of keys added, removed and modified between two inventory snapshots
+    """
+    added = sorted(key for key in new if key not in old)
+    removed = sorted(key for key in old if key not in new)
+    modified = sorted(key for key in new if key in old and new[key] != old[key])
+    return InventoryDiff(added, removed, modified)
 
 
 def parse_date(context, param, value):
@@ -2,20 +2,82 @@
 This Pytest  script tests stac_parent_update.py, notify_to_stac_queue.py as well as
 the serverless lambda function given in stac.py
 """
+import base64
+import datetime
+import gzip
 import json
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
 
 import boto3
 import pytest
 from moto import mock_s3, mock_sqs
 from pathlib import Path
 
+from benchmark import (
+    EmulatedLambdaClient,
+    LocalLambdaClient,
+    PriceModel,
+    fit_duration_curve,
+    invocation_price,
+    pareto_frontier,
+    parse_report,
+    recommend_memory_size,
+    run_benchmark,
+    run_concurrency_sweep,
+    summarise,
+    update_configuration,
+)
+from delete_stac_parent_catalogs import delete_keys, list_catalogs
+from inventory_table import filter_inventory_table, load_inventory_table
+from notify_to_stac_queue import cli as notify_cli
+from reconcile_stac import join_stac_items, set_stac_config, stale_stac_yamls
+from stac_index import matching_chunks, read_index
 from stac_parent_update import StacCollections
+from stac_utils import (
+    PrefixMatcher,
+    diff_snapshots,
+    inventory_changes,
+    list_inventory_keys,
+    parse_date,
+    read_snapshot,
+    write_snapshot,
+    yamls_in_inventory_list,
+)
 
 
 # When using PyTest fixtures defined in the same file, they must redefine their name.
 # pylint: disable=redefined-outer-name
 
 
+def create_inventory(bucket, rows, shard_size=2, prefix="inventory"):
+    """
+    Upload a CSV S3 inventory of the given (key, last modified date) rows and return its manifest url
+    """
+
+    files = []
+    for n in range(0, len(rows), shard_size):
+        body = "".join(
+            f'"dea-public-data","{key}","1024","{date}"\n'
+            for key, date in rows[n:n + shard_size]
+        )
+        key = f"{prefix}/data/{n}.csv.gz"
+        bucket.put_object(Key=key, Body=gzip.compress(body.encode("utf8")))
+        files.append({"key": key})
+
+    manifest = {
+        "sourceBucket": "dea-public-data",
+        "destinationBucket": f"arn:aws:s3:::{bucket.name}",
+        "fileFormat": "CSV",
+        "fileSchema": "Bucket, Key, Size, LastModifiedDate",
+        "files": files,
+    }
+    bucket.put_object(Key=f"{prefix}/manifest.json", Body=json.dumps(manifest))
+    return f"s3://{bucket.name}/{prefix}/manifest.json"
+
+
 @pytest.fixture
 def s3_dataset_yamls():
     """
@@ -141,6 +203,43 @@ def test_s3_event_handler():
     assert links["parent"].endswith("catalog.json")
 
 
+def test_reduce_geometry():
+    from stac import reduce_geometry
+
+    # A square with an extra vertex part way along one side
+    square = {
+        "type": "Polygon",
+        "coordinates": [
+            [
+                [120.123456789, -30.0],
+                [120.6, -30.000000001],
+                [121.0, -30.0],
+                [121.0, -29.0],
+                [120.123456789, -29.0],
+                [120.123456789, -30.0],
+            ]
+        ],
+    }
+
+    assert reduce_geometry(square) == square
+    rounded = reduce_geometry(square, precision=3)
+    assert rounded["coordinates"][0][:2] == [[120.123, -30.0], [120.6, -30.0]]
+
+    simplified = reduce_geometry(square, precision=3, simplify_tolerance=0.001)
+    assert simplified == {
+        "type": "Polygon",
+        "coordinates": [
+            [
+                [120.123, -30.0],
+                [121.0, -30.0],
+                [121.0, -29.0],
+                [120.123, -29.0],
+                [120.123, -30.0],
+            ]
+        ],
+    }
+
+
 TEST_CONFIG = {
     "products": [
         {
@@ -212,3 +311,696 @@ def test_creating_catalogs():
         assert all("href" in link and "rel" in link for link in body["links"])
 
         assert any(link["rel"] == "self" for link in body["links"])
+
+
+def stac_item(item_id, bbox, item_datetime):
+    return {
+        "id": item_id,
+        "type": "Feature",
+        "bbox": bbox,
+        "properties": {"datetime": item_datetime},
+    }
+
+
+@mock_s3
+def test_search_index(monkeypatch):
+    monkeypatch.setattr("stac_index.CHUNK_ROWS", 2)
+    bucket_name = "dea-public-data-dev"
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket=bucket_name)
+
+    def put_item(key, item):
+        bucket.put_object(Key=key.replace(".yaml", "_STAC.json"), Body=json.dumps(item))
+
+    keys = [
+        "test-prefix/dir/x_-5/y_-23/2010/02/13/foo1.yaml",
+        "test-prefix/dir/x_-5/y_-23/2010/02/14/foo2.yaml",
+        "test-prefix/dir/x_4/y_2/2010/02/12/foo3.yaml",
+        "test-prefix/dir/x_4/y_2/2010/02/15/missing.yaml",
+    ]
+    put_item(keys[0], stac_item("a", [120, -30, 121, -29], "2010-02-13T00:00:00+00:00"))
+    put_item(keys[1], stac_item("b", [120, -30, 121, -29], "2010-02-14T00:00:00+00:00"))
+    put_item(keys[2], stac_item("c", [140, -20, 141, -19], "2010-02-12T00:00:00+00:00"))
+
+    cu = StacCollections(TEST_CONFIG, search_index=True)
+    cu.add_items(keys)
+    cu.persist_all_catalogs(bucket_name)
+
+    def read(key):
+        return bucket.Object(key).get()["Body"].read()
+
+    def read_header():
+        header = json.loads(read("test-prefix/dir/stac-index.json"))
+        return header, header["index"][len("https://sub.example.com/"):]
+
+    header, index_key = read_header()
+    assert header["collection"] == "test-product"
+    assert header["count"] == 3
+    assert re.fullmatch(r"test-prefix/dir/stac-index-[0-9a-f]{16}\.jsonl", index_key)
+    assert [chunk["count"] for chunk in header["chunks"]] == [2, 1]
+    assert header["chunks"][0]["bbox"] == [120, -30, 141, -19]
+
+    # Each chunk can be read on its own with a range request
+    body = read(index_key)
+    chunk = matching_chunks(header, start="2010-02-14T00:00:00+00:00")[0]
+    rows = read_index(body[chunk["offset"]:chunk["offset"] + chunk["length"]])
+    assert rows == [
+        [
+            "2010-02-14T00:00:00+00:00",
+            "b",
+            [120, -30, 121, -29],
+            "https://sub.example.com/test-prefix/dir/x_-5/y_-23/2010/02/14/foo2_STAC.json",
+        ]
+    ]
+    assert [row[1] for row in read_index(body)] == ["c", "a", "b"]
+    assert matching_chunks(header, bbox=[150, -40, 151, -39]) == []
+
+    # Incremental updates are merged with the existing index
+    put_item(keys[3], stac_item("d", [140, -20, 141, -19], "2010-02-15T00:00:00+00:00"))
+    put_item(keys[0], stac_item("a", [120, -30, 121, -29], "2010-02-11T00:00:00+00:00"))
+    cu = StacCollections(TEST_CONFIG, search_index=True, incremental=True)
+    cu.add_items([keys[0], keys[3]])
+    cu.persist_all_catalogs(bucket_name)
+    header, new_index_key = read_header()
+    rows = read_index(read(new_index_key))
+    assert [row[1] for row in rows] == ["a", "c", "b", "d"]
+    assert header["count"] == 4
+
+    # The new index is written under a new name, and the old one is then removed
+    assert new_index_key != index_key
+    index_keys = {
+        o.key for o in bucket.objects.filter(Prefix="test-prefix/dir/stac-index")
+    }
+    assert index_keys == {"test-prefix/dir/stac-index.json", new_index_key}
+
+    # Full updates only read the items missing from the index
+    new_key = "test-prefix/dir/x_4/y_2/2010/02/16/foo5.yaml"
+    put_item(new_key, stac_item("e", [140, -20, 141, -19], "2010-02-16T00:00:00+00:00"))
+    cu = StacCollections(TEST_CONFIG, search_index=True)
+    read_keys = []
+    read_items = cu.read_items
+    cu.read_items = lambda bucket, keys: read_items(bucket, read_keys.extend(keys) or keys)
+    cu.add_items(keys + [new_key])
+    cu.persist_all_catalogs(bucket_name)
+    assert read_keys == ["test-prefix/dir/x_4/y_2/2010/02/16/foo5_STAC.json"]
+    rows = read_index(read(read_header()[1]))
+    assert [row[1] for row in rows] == ["a", "c", "b", "d", "e"]
+
+
+@mock_s3
+def test_computed_extents():
+    bucket_name = "dea-public-data-dev"
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket=bucket_name)
+
+    items = {
+        "test-prefix/dir/x_-5/y_-23/2010/02/13/foo1": ("2010-02-13T00:00:00Z", 120),
+        "test-prefix/dir/x_4/y_2/2010/02/12/foo2": ("2010-02-12T00:00:00Z", 130),
+        "test-prefix/dir/x_4/y_2/2011/05/01/foo3": ("2011-05-01T00:00:00Z", 110),
+    }
+    for n, (key, (item_datetime, lon)) in enumerate(items.items()):
+        bucket.put_object(
+            Key=key + "_STAC.json",
+            Body=json.dumps(
+                stac_item(str(n), [lon, -30, lon + 1, -29 + n], item_datetime)
+            ),
+        )
+    keys = [key + ".yaml" for key in items]
+
+    def collection_extent():
+        catalog = json.load(bucket.Object("test-prefix/dir/catalog.json").get()["Body"])
+        assert catalog["dea:computed_extent"]
+        return catalog["extent"]
+
+    # A configured extent can't be merged with
+    cu = StacCollections(TEST_CONFIG)
+    cu.add_items(keys[:2])
+    cu.persist_all_catalogs(bucket_name)
+    cu = StacCollections(TEST_CONFIG, computed_extents=True, incremental=True)
+    cu.add_items(keys[2:])
+    with pytest.raises(ValueError, match="full update"):
+        cu.persist_all_catalogs(bucket_name)
+
+    cu = StacCollections(TEST_CONFIG, computed_extents=True)
+    cu.add_items(keys[:2])
+    cu.persist_all_catalogs(bucket_name)
+    assert collection_extent() == {
+        "spatial": [120, -30, 131, -28],
+        "temporal": ["2010-02-12T00:00:00Z", "2010-02-13T00:00:00Z"],
+    }
+
+    # Incremental updates widen the existing extent
+    cu = StacCollections(TEST_CONFIG, computed_extents=True, incremental=True)
+    cu.add_items(keys[2:])
+    cu.persist_all_catalogs(bucket_name)
+    assert collection_extent() == {
+        "spatial": [110, -30, 131, -27],
+        "temporal": ["2010-02-12T00:00:00Z", "2011-05-01T00:00:00Z"],
+    }
+
+    # Full updates replace it
+    cu = StacCollections(TEST_CONFIG, computed_extents=True)
+    cu.add_items(keys[2:])
+    cu.persist_all_catalogs(bucket_name)
+    assert collection_extent()["spatial"] == [110, -30, 111, -27]
+
+    # The rows of an existing search index are used instead of reading the items
+    cu = StacCollections(TEST_CONFIG, search_index=True)
+    cu.add_items(keys)
+    cu.persist_all_catalogs(bucket_name)
+    for key in items:
+        bucket.Object(key + "_STAC.json").delete()
+    cu = StacCollections(TEST_CONFIG, computed_extents=True)
+    cu.add_items(keys)
+    cu.persist_all_catalogs(bucket_name)
+    assert collection_extent() == {
+        "spatial": [110, -30, 131, -27],
+        "temporal": ["2010-02-12T00:00:00Z", "2011-05-01T00:00:00Z"],
+    }
+
+
+def test_prefix_matcher():
+    prefixes = [
+        "fractional-cover/fc/v2.2.1/ls5",
+        "fractional-cover/fc/v2.2.1/ls7",
+        "WOfS/summary/v2.1.0/comb",
+        "mangrove_cover/",
+    ]
+    keys = [
+        "fractional-cover/fc/v2.2.1/ls5/x_-1/y_-11/2008/11/08/LS5_TM_FC.yaml",
+        "fractional-cover/fc/v2.2.1/ls5_extra/x_-1/LS5_TM_FC.yaml",
+        "fractional-cover/fc/v2.2.1/ls8/x_-1/y_-11/LS8_OLI_FC.yaml",
+        "fractional-cover/fc/v2.2.1",
+        "WOfS/summary/v2.1.0/combined/x_-18/y_-22/WOFS_3577_-18_-22_summary.yaml",
+        "WOfS/summary/v2.1.5/combined/x_-18/y_-22/WOFS_3577_-18_-22_summary.yaml",
+        "mangrove_cover/-11_-20/MANGROVE_COVER_3577_-11_-20_20170101.yaml",
+        "mangrove_cover",
+        "",
+    ]
+
+    matcher = PrefixMatcher(prefixes)
+    for key in keys:
+        assert matcher(key) == any(key.startswith(prefix) for prefix in prefixes)
+
+    assert not PrefixMatcher([])("any/key.yaml")
+    assert PrefixMatcher([""])("any/key.yaml")
+
+
+def test_yamls_in_inventory_list():
+    items = [
+        SimpleNamespace(Key="test-prefix/dir/x_-5/y_-23/foo1.yaml"),
+        SimpleNamespace(Key="test-prefix/dir/x_-5/y_-23/foo1_STAC.json"),
+        SimpleNamespace(Key="test-prefix/other/x_-5/y_-23/foo2.yaml"),
+    ]
+
+    assert list(yamls_in_inventory_list(items, TEST_CONFIG)) == [
+        "test-prefix/dir/x_-5/y_-23/foo1.yaml"
+    ]
+
+
+@mock_s3
+def test_list_inventory_keys():
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="dea-public-data-inventory")
+    manifest = create_inventory(
+        bucket,
+        [
+            ("test-prefix/dir/x_-5/y_-23/foo1.yaml", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_-5/y_-23/foo1_STAC.json", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_4/y_2/foo2.yaml", "2020-01-01T00:00:00.000Z"),
+            ("test-prefix/other/x_4/y_2/foo3.yaml", "2020-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_4/catalog.json", "2020-01-01T00:00:00.000Z"),
+        ],
+    )
+
+    keys = list_inventory_keys(
+        manifest, prefixes=["test-prefix/dir"], suffix=".yaml", workers=1
+    )
+    assert sorted(keys) == [
+        "test-prefix/dir/x_-5/y_-23/foo1.yaml",
+        "test-prefix/dir/x_4/y_2/foo2.yaml",
+    ]
+
+    keys = list_inventory_keys(
+        manifest,
+        suffix=".yaml",
+        from_date=parse_date(None, None, "2019-06-01T00:00:00Z"),
+        workers=2,
+    )
+    assert sorted(keys) == [
+        "test-prefix/dir/x_4/y_2/foo2.yaml",
+        "test-prefix/other/x_4/y_2/foo3.yaml",
+    ]
+
+
+def test_diff_snapshots():
+    old = {
+        "a.yaml": ("10", "2019-01-01T00:00:00.000Z", "etag-a"),
+        "b.yaml": ("10", "2019-01-01T00:00:00.000Z", "etag-b"),
+        "c.yaml": ("10", "2019-01-01T00:00:00.000Z", "etag-c"),
+    }
+    new = {
+        "a.yaml": ("10", "2019-01-01T00:00:00.000Z", "etag-a"),
+        "b.yaml": ("12", "2020-01-01T00:00:00.000Z", "etag-b2"),
+        "d.yaml": ("10", "2020-01-01T00:00:00.000Z", "etag-d"),
+    }
+
+    diff = diff_snapshots(old, new)
+    assert diff.added == ["d.yaml"]
+    assert diff.removed == ["c.yaml"]
+    assert diff.modified == ["b.yaml"]
+
+
+@mock_s3
+def test_inventory_changes(tmp_path):
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="dea-public-data-inventory")
+    snapshot_path = str(tmp_path / "snapshot.tsv.gz")
+
+    manifest = create_inventory(
+        bucket,
+        [
+            ("test-prefix/dir/x_-5/y_-23/foo1.yaml", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_4/y_2/foo2.yaml", "2019-01-01T00:00:00.000Z"),
+        ],
+    )
+    diff, snapshot = inventory_changes(manifest, TEST_CONFIG, snapshot_path, workers=1)
+    assert len(diff.added) == 2
+    write_snapshot(snapshot_path, snapshot)
+
+    manifest = create_inventory(
+        bucket,
+        [
+            ("test-prefix/dir/x_-5/y_-23/foo1.yaml", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_4/y_2/foo3.yaml", "2020-01-01T00:00:00.000Z"),
+        ],
+    )
+    diff, snapshot = inventory_changes(manifest, TEST_CONFIG, snapshot_path, workers=1)
+    assert diff.added == ["test-prefix/dir/x_4/y_2/foo3.yaml"]
+    assert diff.removed == ["test-prefix/dir/x_4/y_2/foo2.yaml"]
+    assert diff.modified == []
+
+
+def test_notify_snapshot_keeps_failed_keys(tmp_path, monkeypatch):
+    snapshot = str(tmp_path / "snapshot.tsv.gz")
+    new_snapshot = {
+        "a.yaml": ("1", "2020-01-01", "e1"),
+        "b.yaml": ("2", "2020-01-01", "e2"),
+        "c.yaml": ("3", "2020-01-01", "e3"),
+    }
+    monkeypatch.setattr(
+        "notify_to_stac_queue.inventory_changes",
+        lambda *args: (diff_snapshots({}, new_snapshot), dict(new_snapshot)),
+    )
+
+    def send_message_batch(QueueUrl, Entries):  # pylint: disable=invalid-name
+        bodies = {entry["Id"]: json.loads(entry["MessageBody"]) for entry in Entries}
+        keys = {
+            n: body["Records"][0]["s3"]["object"]["key"] for n, body in bodies.items()
+        }
+        return {
+            "Successful": [{"Id": n} for n, key in keys.items() if key != "b.yaml"],
+            "Failed": [{"Id": n} for n, key in keys.items() if key == "b.yaml"],
+        }
+
+    monkeypatch.setattr(
+        "notify_to_stac_queue.boto3.client",
+        lambda service: SimpleNamespace(send_message_batch=send_message_batch),
+    )
+
+    notify_cli.callback(
+        config=str(Path(__file__).parent / "stac_config.yaml"),
+        inventory_manifest="s3://inventory/manifest.json",
+        queue_url="https://example.com/queue",
+        bucket="dea-public-data",
+        from_date=None,
+        workers=1,
+        snapshot=snapshot,
+        inventory_table=None,
+    )
+
+    # The failed key is sent again by the next run
+    assert sorted(read_snapshot(snapshot)) == ["a.yaml", "c.yaml"]
+
+
+@mock_s3
+def test_inventory_table(tmp_path):
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="dea-public-data-inventory")
+    manifest = create_inventory(
+        bucket,
+        [
+            ("test-prefix/dir/x_-5/y_-23/foo1.yaml", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_-5/y_-23/foo1_STAC.json", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_4/y_2/foo2.yaml", "2020-01-01T00:00:00.000Z"),
+            ("test-prefix/other/x_4/y_2/foo3.yaml", "2020-01-01T00:00:00.000Z"),
+        ],
+    )
+    cache = str(tmp_path / "inventory.parquet")
+
+    table = load_inventory_table(
+        manifest, prefixes=["test-prefix/dir"], suffix=".yaml", workers=1, cache=cache
+    )
+    assert table.num_rows == 2
+    assert table.column("size").to_pylist() == [1024, 1024]
+
+    # The cached table is read without the inventory
+    bucket.Object("inventory/manifest.json").delete()
+    table = load_inventory_table(
+        manifest, prefixes=["test-prefix/dir"], suffix=".yaml", cache=cache
+    )
+    assert table.num_rows == 2
+
+    recent = filter_inventory_table(
+        table, suffix=".yaml", from_date=datetime.datetime(2019, 6, 1)
+    )
+    assert recent.column("key").to_pylist() == ["test-prefix/dir/x_4/y_2/foo2.yaml"]
+    assert filter_inventory_table(table, prefixes=["test-prefix/other"]).num_rows == 0
+
+    # A newer inventory in a manifest folder replaces the cached table
+    folder = f"s3://{bucket.name}/daily/"
+    rows = [("test-prefix/dir/x_4/y_2/foo2.yaml", "2020-01-01T00:00:00.000Z")]
+    create_inventory(bucket, rows, prefix="daily/2020-01-01T00-00Z")
+    table = load_inventory_table(
+        folder, prefixes=["test-prefix/dir"], suffix=".yaml", workers=1, cache=cache
+    )
+    assert table.num_rows == 1
+
+    rows.append(("test-prefix/dir/x_5/y_2/foo4.yaml", "2020-01-02T00:00:00.000Z"))
+    newer = create_inventory(bucket, rows, prefix="daily/2020-01-02T00-00Z")
+    table = load_inventory_table(
+        folder, prefixes=["test-prefix/dir"], suffix=".yaml", workers=1, cache=cache
+    )
+    assert table.num_rows == 2
+    assert table.schema.metadata[b"manifest"] == newer.encode("utf8")
+
+
+def stac_config_domain():
+    import stac
+
+    return stac.CFG["aws-domain"]
+
+
+def test_set_stac_config():
+    # Spawned workers don't inherit the config set in the parent process
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_stac_config,
+        initargs=(TEST_CONFIG,),
+    ) as executor:
+        assert executor.submit(stac_config_domain).result() == "https://sub.example.com"
+
+
+def test_join_stac_items():
+    rows = [
+        ("x_1/y_1/foo1_STAC.json", "2019-01-02T00:00:00.000Z"),
+        ("x_1/y_1/foo1.yaml", "2019-01-01T00:00:00.000Z"),
+        ("x_1/y_1/foo2.yaml", "2019-01-01T00:00:00.000Z"),
+        ("x_1/y_1/foo3.yaml", "2019-02-01T00:00:00.000Z"),
+        ("x_1/y_1/foo3_STAC.json", "2019-01-02T00:00:00.000Z"),
+    ]
+
+    assert list(join_stac_items(rows)) == ["x_1/y_1/foo2.yaml", "x_1/y_1/foo3.yaml"]
+
+
+@mock_s3
+def test_stale_stac_yamls():
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="dea-public-data-inventory")
+    manifest = create_inventory(
+        bucket,
+        [
+            ("test-prefix/dir/product.yaml", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_-5/y_-23/foo1.yaml", "2019-01-01T00:00:00.000Z"),
+            ("test-prefix/dir/x_-5/y_-23/foo1_STAC.json", "2019-01-01T00:00:01.000Z"),
+            ("test-prefix/dir/x_4/y_2/foo2.yaml", "2020-01-01T00:00:00.000Z"),
+            ("test-prefix/other/x_4/y_2/foo3.yaml", "2020-01-01T00:00:00.000Z"),
+        ],
+    )
+
+    assert list(stale_stac_yamls(manifest, TEST_CONFIG, workers=1)) == [
+        "test-prefix/dir/x_4/y_2/foo2.yaml"
+    ]
+
+    # Prefixes may be configured with a trailing slash
+    product = dict(TEST_CONFIG["products"][0], prefix="test-prefix/dir/")
+    cfg = dict(TEST_CONFIG, products=[product])
+    assert list(stale_stac_yamls(manifest, cfg, workers=1)) == [
+        "test-prefix/dir/x_4/y_2/foo2.yaml"
+    ]
+
+
+@mock_s3
+def test_delete_keys(monkeypatch):
+    monkeypatch.setattr("delete_stac_parent_catalogs.AWS_DELETE_LIMIT", 10)
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="dea-public-data-dev")
+    keys = [f"test-prefix/dir/x_{x}/catalog.json" for x in range(25)]
+    for key in keys:
+        bucket.put_object(Key=key, Body=b"{}")
+    bucket.put_object(Key="test-prefix/dir/catalog.json", Body=b"{}")
+
+    # The final partial batch is deleted as well as the full batches
+    deleted, failed = delete_keys(
+        boto3.client("s3"), "dea-public-data-dev", iter(keys), threads=2
+    )
+    assert (deleted, failed) == (25, 0)
+    assert [o.key for o in bucket.objects.all()] == ["test-prefix/dir/catalog.json"]
+
+
+def test_delete_keys_retries_errors():
+    class FlakyS3:
+        def __init__(self):
+            self.calls = []
+
+        def delete_objects(self, Bucket, Delete):
+            keys = [o["Key"] for o in Delete["Objects"]]
+            self.calls.append(keys)
+            if len(self.calls) == 1:
+                return {"Errors": [{"Key": keys[0], "Code": "SlowDown"}]}
+            return {}
+
+    s3_client = FlakyS3()
+    assert delete_keys(s3_client, "bucket", ["a", "b", "c"], threads=1) == (3, 0)
+    assert s3_client.calls == [["a", "b", "c"], ["a"]]
+
+
+@mock_s3
+def test_list_catalogs():
+    s3 = boto3.resource("s3")
+    bucket = s3.create_bucket(Bucket="dea-public-data-dev")
+    keys = [
+        "test-prefix/dir/catalog.json",
+        "test-prefix/dir/x_1/catalog.json",
+        "test-prefix/dir/x_1/y_1/catalog.json",
+        "test-prefix/dir/x_2/y_1/catalog.json",
+        "test-prefix/dir/x_2/y_1/2010/02/13/catalog.json",
+        "test-prefix/dir2/x_1/catalog.json",
+        "test-prefix/dir/x_2/y_1/foo1.yaml",
+    ]
+    for key in keys:
+        bucket.put_object(Key=key, Body=b"{}")
+
+    for threads in (1, 2, 8):
+        assert sorted(
+            list_catalogs(
+                boto3.client("s3"), "dea-public-data-dev", "test-prefix/dir", threads
+            )
+        ) == sorted(key for key in keys if key.endswith("/catalog.json"))
+
+    assert sorted(
+        list_catalogs(boto3.client("s3"), "dea-public-data-dev", "test-prefix/dir/", 8)
+    ) == sorted(keys[:5])
+
+
+def test_parse_report():
+    log = (
+        "START RequestId: 1234 Version: $LATEST\n"
+        "REPORT RequestId: 1234\tDuration: 102.25 ms\tBilled Duration: 200 ms\t"
+        "Memory Size: 512 MB\tMax Memory Used: 91 MB\tInit Duration: 350.12 ms\t\n"
+    )
+    assert parse_report(log) == {
+        "duration": 102.25,
+        "billed_duration": 200.0,
+        "memory_size": 512.0,
+        "max_memory_used": 91.0,
+        "init_duration": 350.12,
+    }
+
+    warm = parse_report(log.replace("\tInit Duration: 350.12 ms", ""))
+    assert warm["init_duration"] is None
+    assert warm["duration"] == 102.25
+
+
+def test_summarise():
+    summary = summarise([float(n) for n in range(1, 101)])
+    assert summary["count"] == 100
+    assert summary["mean"] == 50.5
+    assert summary["p50"] == 50.5
+    assert summary["p90"] == pytest.approx(90.1)
+    assert summary["p99"] == pytest.approx(99.01)
+
+    assert summarise([]) == {
+        "count": 0,
+        "mean": None,
+        "p50": None,
+        "p90": None,
+        "p99": None,
+    }
+
+
+def test_run_concurrency_sweep(tmp_path):
+    payload_file = tmp_path / "payload.json"
+    payload_file.write_text(json.dumps({"fail": False}))
+    args = SimpleNamespace(
+        function_name="test",
+        payload_file=str(payload_file),
+        output_file=str(tmp_path / "results.csv"),
+        concurrency="4,1",
+        invocations=6,
+    )
+
+    def handler(event, context):
+        if event["fail"]:
+            raise ValueError("failed")
+        return {"memory": context.memory_limit_in_mb}
+
+    results = run_concurrency_sweep(args, LocalLambdaClient(handler))
+    assert sorted(results) == [1, 4]
+    assert results[4]["invocations"] == 6
+    assert results[4]["errors"] == results[4]["throttles"] == 0
+    assert results[4]["latency"]["count"] == results[4]["duration"]["count"] == 6
+    assert results[4]["throughput"] > 0
+    lines = (tmp_path / "results.csv").read_text().splitlines()
+    assert [line.split(",")[0] for line in lines[1:]] == ["1", "4"]
+
+    payload_file.write_text(json.dumps({"fail": True}))
+    results = run_concurrency_sweep(args, LocalLambdaClient(handler))
+    assert results[4]["errors"] == 6
+    assert results[4]["latency"]["count"] == 0
+
+
+def test_run_benchmark_local(tmp_path):
+    payload_file = tmp_path / "payload.json"
+    payload_file.write_text("{}")
+    args = SimpleNamespace(
+        function_name="test",
+        payload_file=str(payload_file),
+        output_file=str(tmp_path / "results.csv"),
+        invocations=3,
+        cold_starts=1,
+        memory_sizes="1024,128,3008",
+        architecture=None,
+        price_per_gb_second=None,
+        billing_interval=1,
+        latency_target=None,
+        latency_percentile=90,
+    )
+    client = LocalLambdaClient(lambda event, context: None, memory_size=512)
+
+    analysis = run_benchmark(args, client)
+    lines = (tmp_path / "results.csv").read_text().splitlines()
+    assert [line.split(",")[0] for line in lines[1:]] == ["128MB", "1024MB", "3008MB"]
+    assert sorted(analysis["points"]) == [128, 1024, 3008]
+    assert analysis["recommendation"] is not None
+    assert client.config["MemorySize"] == 512
+
+
+def test_update_configuration(monkeypatch):
+    monkeypatch.setattr("benchmark.UPDATE_POLL_INTERVAL", 0)
+    client = LocalLambdaClient(lambda event, context: None)
+    statuses = ["InProgress", "InProgress", "Successful"]
+    get_configuration = client.get_function_configuration
+    client.get_function_configuration = lambda FunctionName: dict(
+        get_configuration(FunctionName), LastUpdateStatus=statuses.pop(0)
+    )
+
+    update_configuration(client, "test", MemorySize=1024)
+    assert statuses == []
+    assert client.config["MemorySize"] == 1024
+
+    monkeypatch.setattr("benchmark.UPDATE_TIMEOUT", 0)
+    statuses = ["InProgress"] * 3
+    with pytest.raises(TimeoutError):
+        update_configuration(client, "test", MemorySize=128)
+
+
+def test_invocation_price():
+    model = PriceModel(0.0000166667, 0.0000002, 1)
+    assert invocation_price(model, 1024, 999.2) == pytest.approx(0.0000168667)
+    assert invocation_price(model, 2048, 999.2) == pytest.approx(0.0000335334)
+
+    model = PriceModel(0.0000166667, 0.0, 100)
+    assert invocation_price(model, 1024, 101) == pytest.approx(0.00000333334)
+
+
+def test_recommend_memory_size():
+    # Durations of 20ms of I/O and 200000 / memory ms of compute
+    points = [(m, 20 + 200000 / min(m, 1769)) for m in (128, 512, 1024, 3008)]
+    curve = fit_duration_curve(points)
+    assert curve == pytest.approx((20, 200000))
+
+    model = PriceModel(0.0000166667, 0.0000002, 1)
+    memory_size, latency, _ = recommend_memory_size(curve, curve, model, target=250)
+    assert memory_size == 896
+    assert latency <= 250
+    assert recommend_memory_size(curve, curve, model)[0] == 128
+    assert recommend_memory_size(curve, curve, model, target=100) is None
+
+    assert pareto_frontier(
+        {
+            128: (1000, 1.0),
+            256: (600, 1.2),
+            512: (600, 2.0),
+            1024: (300, 3.0),
+            2048: (310, 5.0),
+        }
+    ) == [128, 256, 1024]
+
+
+def test_emulated_lambda_client(tmp_path, monkeypatch):
+    # Environments are spawned subprocesses, which import the handler from sys.path
+    (tmp_path / "emulated_handler.py").write_text(
+        "import os\n"
+        "def handler(event, context):\n"
+        "    data = bytearray(event['allocate_mb'] * 1024 * 1024)\n"
+        "    return [context.memory_limit_in_mb, os.environ.get('STAGE'), len(data)]\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    client = EmulatedLambdaClient("emulated_handler.handler", memory_size=256)
+
+    def invoke(allocate_mb=0):
+        response = client.invoke(
+            FunctionName="test", Payload=json.dumps({"allocate_mb": allocate_mb})
+        )
+        report = parse_report(base64.b64decode(response["LogResult"]).decode())
+        return response.get("FunctionError"), json.load(response["Payload"]), report
+
+    try:
+        error, result, report = invoke()
+        assert (error, result) == (None, [256, None, 0])
+        assert report["init_duration"] is not None
+        assert report["memory_size"] == 256
+
+        # The idle environment is reused
+        assert invoke()[2]["init_duration"] is None
+
+        # A configuration change starts a new environment with it
+        client.update_function_configuration(
+            FunctionName="test",
+            MemorySize=128,
+            Environment={"Variables": {"STAGE": "dev"}},
+        )
+        error, result, report = invoke()
+        assert (error, result) == (None, [128, "dev", 0])
+        assert report["init_duration"] is not None
+
+        # Exceeding the memory size fails the invocation and discards the environment
+        error, result, report = invoke(allocate_mb=200)
+        assert error == "Unhandled"
+        assert result["errorType"] == "Runtime.OutOfMemory"
+        assert report["max_memory_used"] > 128
+        assert invoke()[2]["init_duration"] is not None
+    finally:
+        client.close()
@@ -1,56 +1,166 @@
-import os
+"""
+Report how old the latest time of each layer in WMS GetCapabilities documents is.
+
+The documents of all the given endpoints are fetched concurrently and parsed as they
+are read, so only the layer being parsed is held in memory. One JSON object is
+printed per layer, with its endpoint, name, latest time and age in seconds.
+"""
+
+import argparse
+import json
+import sys
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from urllib.request import urlopen
+from urllib.request import ProxyHandler, build_opener
 
 import dateutil.parser
 
-del os.environ["http_proxy"]
-
 URLS = [
     "http://gsky.nci.org.au/ows?service=WMS&version=1.3.0&request=GetCapabilities",
     "https://ows.services.dea.ga.gov.au/?service=WMS&version=1.3.0&request=GetCapabilities",
 ]
 
-NS = {"wms": "http://www.opengis.net/wms"}
-
-
-def layer_name_and_age(node, now):
-    layer_name = node.find("wms:Name", NS).text
-    dates = node.find("wms:Dimension", NS).text
-    latest = dates.split(",")[-1]
-    latest_date = dateutil.parser.parse(latest)
-
-    delta = now - latest_date
-
-    print(layer_name, latest_date, delta)
+WMS = "{http://www.opengis.net/wms}"
+LAYER = WMS + "Layer"
+NAME = WMS + "Name"
+TITLE = WMS + "Title"
+DIMENSION = WMS + "Dimension"
 
+TIMEOUT = 60
+WORKERS = 8
 
-def get_ages_gsky(url):
-    # with open(FILE) as f:
-    with urlopen(url) as f:
-        tree = ET.parse(f)
 
-    now = datetime.now(timezone.utc)
+def latest_time(dimension):
+    """
+    Return the latest time of a WMS time dimension value, without splitting the whole list
 
-    for node in tree.findall(".//wms:Layer/wms:Layer", NS):
-        layer_name_and_age(node, now)
-
-
-def get_ages_dea_nrt(url):
-    with urlopen(url) as f:
-        tree = ET.parse(f)
-
-    now = datetime.now()
-
-    nrt_node = tree.find('.//wms:Layer[wms:Title="Near Real-Time"]', NS)
-    for node in nrt_node.findall("wms:Layer", NS):
-        layer_name_and_age(node, now)
-
-
-get_ages_dea_nrt(URLS[1])
-
-# for url in URLS:
-#    print(url)
-#    get_ages(url)
-#    print('\n\n')
+    The value is a comma separated list of times or 'start/end/period' intervals, in
+    ascending order. Times without a time zone are taken to be in UTC.
+    """
+    latest = dimension[dimension.rfind(",") + 1:].strip()
+    if "/" in latest:
+        latest = latest.split("/")[1]
+    latest_date = dateutil.parser.parse(latest)
+    if latest_date.tzinfo is None:
+        latest_date = latest_date.replace(tzinfo=timezone.utc)
+    return latest_date
+
+
+def layer_times(source, parent_title=None):
+    """
+    Yield the name and latest time of each named layer with a time dimension
+
+    :param source: a file name or binary file object of a GetCapabilities document
+    :param parent_title: only include layers directly inside a layer with this title
+    """
+    path = []  # tags of the open elements
+    layers = []  # name, title and time dimension of the open layers
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            if elem.tag == LAYER:
+                layers.append({"name": None, "title": None, "time": None})
+            continue
+
+        path.pop()
+        if elem.tag == LAYER:
+            layer = layers.pop()
+            if (
+                layer["name"]
+                and layer["time"]
+                and (
+                    parent_title is None
+                    or (layers and layers[-1]["title"] == parent_title)
+                )
+            ):
+                yield layer["name"], latest_time(layer["time"])
+            elem.clear()
+        elif path and path[-1] == LAYER:
+            if elem.tag == NAME:
+                layers[-1]["name"] = elem.text
+            elif elem.tag == TITLE:
+                layers[-1]["title"] = elem.text
+            elif elem.tag == DIMENSION and elem.get("name", "").lower() == "time":
+                layers[-1]["time"] = elem.text
+            elem.clear()
+
+
+def layer_ages(url, parent_title=None, now=None, opener=None, timeout=TIMEOUT):
+    """
+    Return a list of dicts of the latest time and age of each layer of a WMS endpoint
+    """
+    opener = opener or build_opener()
+    now = now or datetime.now(timezone.utc)
+    with opener.open(url, timeout=timeout) as response:
+        return [
+            {
+                "url": url,
+                "layer": name,
+                "latest": latest.isoformat(),
+                "age_seconds": (now - latest).total_seconds(),
+            }
+            for name, latest in layer_times(response, parent_title)
+        ]
+
+
+def check_endpoints(urls, parent_title=None, workers=WORKERS, **kwargs):
+    """
+    Yield the layer ages of each endpoint, fetched concurrently, in the order given
+
+    Endpoints that could not be fetched or parsed yield a single dict with the error.
+    """
+
+    def check(url):
+        try:
+            return layer_ages(url, parent_title, **kwargs)
+        except (OSError, ET.ParseError, ValueError) as error:
+            return [{"url": url, "error": str(error)}]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for ages in executor.map(check, urls):
+            yield from ages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "urls", nargs="*", default=URLS, help="GetCapabilities URLs to check"
+    )
+    parser.add_argument(
+        "--parent-title",
+        help="Only check layers directly inside the layer with this title, "
+        "e.g. 'Near Real-Time'",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of endpoints fetched at once",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=TIMEOUT, help="Timeout of requests in seconds"
+    )
+    parser.add_argument(
+        "--no-proxy", action="store_true", help="Ignore proxy environment variables"
+    )
+    args = parser.parse_args()
+
+    opener = build_opener(ProxyHandler({})) if args.no_proxy else build_opener()
+    failed = False
+    for record in check_endpoints(
+        args.urls,
+        args.parent_title,
+        args.workers,
+        opener=opener,
+        timeout=args.timeout,
+    ):
+        failed = failed or "error" in record
+        print(json.dumps(record))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import io
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from parse_getcaps import check_endpoints, latest_time, layer_ages, layer_times
+
+GETCAPS = Path(__file__).parent / "getcaps.xml"
+URL = "https://example.com/ows?request=GetCapabilities"
+
+
+class FileOpener:
+    """
+    Opens any URL as the test GetCapabilities document, or fails with the given error
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def open(self, url, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return io.BytesIO(GETCAPS.read_bytes())
+
+
+@pytest.mark.parametrize(
+    "dimension,expected",
+    [
+        ("2019-01-01", datetime(2019, 1, 1, tzinfo=timezone.utc)),
+        (
+            "2019-01-01,2019-01-02T10:00:00Z",
+            datetime(2019, 1, 2, 10, tzinfo=timezone.utc),
+        ),
+        (
+            "2018-01-01, 2019-01-02T10:00:00+10:00 ",
+            datetime(2019, 1, 2, tzinfo=timezone.utc),
+        ),
+        (
+            "2017-01-01,2018-01-01/2019-01-31/P1D",
+            datetime(2019, 1, 31, tzinfo=timezone.utc),
+        ),
+    ],
+)
+def test_latest_time(dimension, expected):
+    assert latest_time(dimension) == expected
+
+
+def test_layer_times():
+    # Nested layers are yielded before the layers holding them
+    assert list(layer_times(str(GETCAPS))) == [
+        ("nrt_a", datetime(2019, 1, 2, 10, tzinfo=timezone.utc)),
+        ("nrt_b_child", datetime(2019, 2, 1, tzinfo=timezone.utc)),
+        ("nrt_b", datetime(2019, 1, 31, tzinfo=timezone.utc)),
+        ("archive", datetime(2000, 12, 31, 14, tzinfo=timezone.utc)),
+    ]
+
+    # Only the layers directly inside the titled layer, not the layers they hold, or
+    # the layers with a style of that title
+    with GETCAPS.open("rb") as getcaps:
+        names = [name for name, _ in layer_times(getcaps, "Near Real-Time")]
+    assert names == ["nrt_a", "nrt_b"]
+    assert [name for name, _ in layer_times(str(GETCAPS), "NRT B")] == ["nrt_b_child"]
+    assert list(layer_times(str(GETCAPS), "Missing")) == []
+
+
+def test_layer_ages():
+    now = datetime(2019, 2, 1, 10, tzinfo=timezone.utc)
+    ages = layer_ages(URL, "Near Real-Time", now=now, opener=FileOpener())
+    assert ages == [
+        {
+            "url": URL,
+            "layer": "nrt_a",
+            "latest": "2019-01-02T10:00:00+00:00",
+            "age_seconds": timedelta(days=30).total_seconds(),
+        },
+        {
+            "url": URL,
+            "layer": "nrt_b",
+            "latest": "2019-01-31T00:00:00+00:00",
+            "age_seconds": timedelta(days=1, hours=10).total_seconds(),
+        },
+    ]
+
+
+def test_check_endpoints():
+    records = list(check_endpoints([URL, URL + "&other"], opener=FileOpener()))
+    assert [record["url"] for record in records] == [URL] * 4 + [URL + "&other"] * 4
+
+    records = list(check_endpoints([URL], opener=FileOpener(OSError("refused"))))
+    assert records == [{"url": URL, "error": "refused"}]